@@ -0,0 +1,365 @@
+"""
+HAR record/replay harness for the SIH automation flows.
+
+Record a real session once (patient data is scrubbed before anything is
+written next to the code), then replay it offline through Playwright
+routing with the recorded per-response latency and check the step timings
+against per-flow budgets and a stored baseline.
+
+    python har_harness.py record run --ipp 123456,789012 --bookings NFS,CRP
+    python har_harness.py record fetch --filter today --bookings NFS
+    python har_harness.py replay run                     # exit code 1 on regression
+    python har_harness.py replay fetch --update-baseline
+    python har_harness.py replay run --postback-savings  # time saved versus networkidle
+
+Recordings live in har/<flow>.har with the arguments needed to replay them
+in har/<flow>.meta.json; baselines in har/baseline.json. Scrubbing replaces
+credentials, IPPs, patient names, ViewState blobs and cookies with
+same-length placeholders (ASP.NET partial postback responses are
+length-prefixed). Review a recording before sharing it anyway: free text
+typed into the SIH by hand cannot be detected.
+"""
+import argparse
+import base64
+import getpass
+import json
+import os
+import re
+import statistics
+import sys
+import time
+import urllib.parse
+from collections import defaultdict
+
+import script
+
+HAR_DIR = "har"
+BASELINE_FILE = os.path.join(HAR_DIR, "baseline.json")
+
+# Absolute per-step budgets (seconds, worst case over a replay)
+BUDGETS = {
+    "login": 20.0,
+    "booking": 45.0,
+    "booking_open": 20.0,
+    "history_lookup": 10.0,
+}
+# A step regresses when its median exceeds baseline median * (1 + tolerance) + slack
+BASELINE_TOLERANCE = 0.25
+BASELINE_SLACK_S = 0.5
+
+_TEXT_MIME = ("text/", "application/json", "application/javascript", "application/x-javascript", "application/xml")
+
+
+# =========================
+# SCRUBBING
+# =========================
+def _same_length(placeholder, original):
+    """Pad or cut placeholder to the length of original."""
+    return (placeholder * (len(original) // max(len(placeholder), 1) + 1))[:len(original)]
+
+
+def build_replacements(username, password, ipps, names):
+    """Map every sensitive string to a same-length placeholder."""
+    replacements = {}
+    if username:
+        replacements[username] = _same_length("replay", username)
+    if password:
+        replacements[password] = _same_length("x", password)
+    for index, ipp in enumerate(sorted(set(ipps), key=len, reverse=True)):
+        fake = str(900000 + index).rjust(len(ipp), "9")[-len(ipp):]
+        replacements[ipp] = fake
+    for index, name in enumerate(sorted({n for n in names if n}, key=len, reverse=True)):
+        replacements[name] = _same_length(f"PATIENT {index:04d} ", name)
+    # URL-encoded variants as they appear in form posts
+    for original, fake in list(replacements.items()):
+        encoded = urllib.parse.quote_plus(original)
+        if encoded != original:
+            replacements[encoded] = urllib.parse.quote_plus(fake)
+    return replacements
+
+
+_HIDDEN_FIELD_RE = re.compile(r'(id="__(?:VIEWSTATE|EVENTVALIDATION)"\s+value=")([^"]*)(")')
+_DELTA_FIELD_RE = re.compile(r"(\|hiddenField\|__(?:VIEWSTATE|EVENTVALIDATION)\|)([^|]*)(\|)")
+_FORM_FIELD_RE = re.compile(r"((?:^|&)__(?:VIEWSTATE|EVENTVALIDATION)=)([^&]*)")
+
+
+def scrub_text(text, replacements):
+    for original in sorted(replacements, key=len, reverse=True):
+        text = text.replace(original, replacements[original])
+    # ViewState can embed anything the page showed; keep only its length
+    text = _HIDDEN_FIELD_RE.sub(lambda m: m.group(1) + "A" * len(m.group(2)) + m.group(3), text)
+    text = _DELTA_FIELD_RE.sub(lambda m: m.group(1) + "A" * len(m.group(2)) + m.group(3), text)
+    text = _FORM_FIELD_RE.sub(lambda m: m.group(1) + "A" * len(m.group(2)), text)
+    return text
+
+
+def _scrub_headers(headers, replacements):
+    for header in headers:
+        name = header["name"].lower()
+        if name in ("cookie", "set-cookie"):
+            header["value"] = re.sub(r"=([^;]*)", lambda m: "=" + "0" * len(m.group(1)), header["value"])
+        else:
+            header["value"] = scrub_text(header["value"], replacements)
+
+
+def scrub_har(raw_path, out_path, replacements):
+    """Write a scrubbed copy of a HAR file and delete the raw recording."""
+    with open(raw_path, "r", encoding="utf-8") as fh:
+        har = json.load(fh)
+    for entry in har["log"]["entries"]:
+        req, resp = entry["request"], entry["response"]
+        req["url"] = scrub_text(req["url"], replacements)
+        for item in req.get("queryString", []):
+            item["value"] = scrub_text(item["value"], replacements)
+        _scrub_headers(req.get("headers", []), replacements)
+        _scrub_headers(req.get("cookies", []), replacements)
+        post = req.get("postData")
+        if post:
+            if "text" in post:
+                post["text"] = scrub_text(post["text"], replacements)
+            for param in post.get("params", []):
+                param["value"] = scrub_text(param.get("value", ""), replacements)
+        _scrub_headers(resp.get("headers", []), replacements)
+        _scrub_headers(resp.get("cookies", []), replacements)
+        content = resp.get("content", {})
+        mime = content.get("mimeType", "")
+        if "text" in content and mime.startswith(_TEXT_MIME):
+            if content.get("encoding") == "base64":
+                decoded = base64.b64decode(content["text"]).decode("utf-8", errors="replace")
+                content["text"] = base64.b64encode(scrub_text(decoded, replacements).encode("utf-8")).decode("ascii")
+            else:
+                content["text"] = scrub_text(content["text"], replacements)
+    with open(out_path, "w", encoding="utf-8") as fh:
+        json.dump(har, fh, ensure_ascii=False)
+    os.remove(raw_path)
+
+
+# =========================
+# REPLAY
+# =========================
+class HarReplayer:
+    """
+    Answers every request of a context from a HAR file. Entries are matched
+    by method and URL in recorded order (postbacks to the same page replay in
+    sequence) and delivered after their recorded time * latency_scale.
+    """
+
+    def __init__(self, har_path, latency_scale=1.0):
+        with open(har_path, "r", encoding="utf-8") as fh:
+            entries = json.load(fh)["log"]["entries"]
+        self.latency_scale = latency_scale
+        self._by_url = defaultdict(list)
+        self._by_path = defaultdict(list)
+        for entry in entries:
+            method, url = entry["request"]["method"], entry["request"]["url"].split("#")[0]
+            self._by_url[(method, url)].append(entry)
+            self._by_path[(method, url.split("?")[0])].append(entry)
+        self._cursor = defaultdict(int)
+        self.unmatched = []
+
+    def attach(self, context):
+        context.route("**/*", self._handle)
+
+    def _next(self, table, key):
+        entries = table.get(key)
+        if not entries:
+            return None
+        index = self._cursor[(id(table), key)]
+        self._cursor[(id(table), key)] += 1
+        return entries[min(index, len(entries) - 1)]
+
+    def _handle(self, route):
+        request = route.request
+        url = request.url.split("#")[0]
+        entry = self._next(self._by_url, (request.method, url)) or \
+            self._next(self._by_path, (request.method, url.split("?")[0]))
+        if entry is None:
+            self.unmatched.append(f"{request.method} {url}")
+            route.fulfill(status=404, body="")
+            return
+
+        delay_ms = max(entry.get("time", 0), 0) * self.latency_scale
+        if delay_ms:
+            try:
+                # Yields to Playwright so other in-flight requests keep flowing
+                request.frame.page.wait_for_timeout(delay_ms)
+            except Exception:
+                time.sleep(delay_ms / 1000)
+
+        resp = entry["response"]
+        content = resp.get("content", {})
+        body = content.get("text", "")
+        body = base64.b64decode(body) if content.get("encoding") == "base64" else body.encode("utf-8")
+        headers = {
+            h["name"]: h["value"] for h in resp.get("headers", [])
+            if h["name"].lower() not in ("content-encoding", "content-length", "transfer-encoding")
+        }
+        route.fulfill(status=resp.get("status") or 200, headers=headers, body=body)
+
+
+# =========================
+# FLOWS
+# =========================
+def _run_flow(flow, meta, username, password):
+    if flow == "run":
+        script.run_job(meta["ipp_list"], meta["date"], meta["time"], meta["bookings"], username, password)
+        return None
+    return script.fetch_patients_without_bilans(username, password, meta["filter"], meta["codes"])
+
+
+class StepCollector:
+    """Observer collecting successful step durations (see script.timed_step) and postback savings."""
+
+    def __init__(self):
+        self.steps = defaultdict(list)
+        self.savings = defaultdict(list)
+
+    def __call__(self, kind, name, value, labels):
+        if kind == "step" and labels.get("ok"):
+            self.steps[name].append(value)
+        elif kind == "postback_saving":
+            self.savings[name].append(value)
+
+
+def record(flow, meta):
+    """Run a flow against the real SIH, then store a scrubbed HAR of it."""
+    os.makedirs(HAR_DIR, exist_ok=True)
+    username = input("Username: ")
+    password = getpass.getpass("Password: ")
+
+    # The episodes list maps every hospitalised IPP to a name to scrub
+    print("[INFO] Fetching patient list for scrubbing...")
+    patients = script.fetch_all_patients(username, password)
+    names = [p["name"] for p in patients]
+    ipps = [p["ip"] for p in patients] + meta.get("ipp_list", [])
+
+    raw_path = os.path.join(HAR_DIR, f"{flow}.raw.har")
+    script.CONTEXT_OPTIONS = {"record_har_path": raw_path, "record_har_content": "embed"}
+    script.ASSET_CACHE_ENABLED = False  # record real network timings for every asset
+    try:
+        print(f"[INFO] Recording flow '{flow}'...")
+        _run_flow(flow, meta, username, password)
+    finally:
+        script.CONTEXT_OPTIONS = {}
+        script.ASSET_CACHE_ENABLED = True
+
+    replacements = build_replacements(username, password, ipps, names)
+    scrub_har(raw_path, os.path.join(HAR_DIR, f"{flow}.har"), replacements)
+    if "ipp_list" in meta:
+        meta["ipp_list"] = [replacements.get(ipp, ipp) for ipp in meta["ipp_list"]]
+    with open(os.path.join(HAR_DIR, f"{flow}.meta.json"), "w", encoding="utf-8") as fh:
+        json.dump(meta, fh, indent=2, ensure_ascii=False)
+    print(f"[INFO] Scrubbed recording written to {HAR_DIR}/{flow}.har")
+
+
+def replay(flow, latency_scale=1.0, update_baseline=False, postback_savings=False):
+    """
+    Replay a recorded flow offline; return the list of budget violations.
+    With postback_savings, every postback wait also waits for networkidle
+    and the difference is printed per step (step timings then include it).
+    """
+    with open(os.path.join(HAR_DIR, f"{flow}.meta.json"), "r", encoding="utf-8") as fh:
+        meta = json.load(fh)
+    replayer = HarReplayer(os.path.join(HAR_DIR, f"{flow}.har"), latency_scale)
+    collector = StepCollector()
+
+    script.CONTEXT_HOOKS.append(replayer.attach)
+    script.OBSERVERS.append(collector)
+    script.POSTBACK_MEASURE_SAVINGS = postback_savings
+    started = time.perf_counter()
+    try:
+        _run_flow(flow, meta, "replay", "replay")
+    finally:
+        script.CONTEXT_HOOKS.remove(replayer.attach)
+        script.OBSERVERS.remove(collector)
+        script.POSTBACK_MEASURE_SAVINGS = False
+    total = time.perf_counter() - started
+
+    measured = {
+        name: {"median": statistics.median(values), "max": max(values), "count": len(values)}
+        for name, values in collector.steps.items()
+    }
+    print(f"[INFO] Replay '{flow}' finished in {total:.1f} s")
+    for name, m in sorted(measured.items()):
+        print(f"  {name:<16} n={m['count']:<3} median={m['median']:.2f}s max={m['max']:.2f}s")
+    if collector.savings:
+        print("[INFO] Saved per postback wait versus networkidle:")
+        for name, values in sorted(collector.savings.items()):
+            print(f"  {name:<16} n={len(values):<3} median={statistics.median(values):.2f}s "
+                  f"total={sum(values):.2f}s")
+    if replayer.unmatched:
+        print(f"[WARNING] {len(replayer.unmatched)} request(s) not in the recording, e.g. {replayer.unmatched[0]}")
+
+    baselines = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, "r", encoding="utf-8") as fh:
+            baselines = json.load(fh)
+
+    violations = []
+    baseline = baselines.get(flow, {})
+    for name, m in measured.items():
+        budget = BUDGETS.get(name)
+        if budget is not None and m["max"] > budget:
+            violations.append(f"{name}: max {m['max']:.2f}s over budget {budget:.2f}s")
+        if name in baseline:
+            limit = baseline[name]["median"] * (1 + BASELINE_TOLERANCE) + BASELINE_SLACK_S
+            if m["median"] > limit:
+                violations.append(
+                    f"{name}: median {m['median']:.2f}s regressed past baseline "
+                    f"{baseline[name]['median']:.2f}s (limit {limit:.2f}s)"
+                )
+
+    if update_baseline:
+        baselines[flow] = measured
+        with open(BASELINE_FILE, "w", encoding="utf-8") as fh:
+            json.dump(baselines, fh, indent=2)
+        print(f"[INFO] Baseline for '{flow}' updated.")
+    return violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record/replay SIH sessions with performance budgets.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    rec = sub.add_parser("record", help="record a real session (scrubbed)")
+    rec.add_argument("flow", choices=("run", "fetch"))
+    rec.add_argument("--ipp", default="", help="comma-separated IPPs (run)")
+    rec.add_argument("--bookings", default="NFS", help="comma-separated analyses from MENU_CONFIG")
+    rec.add_argument("--date", default=time.strftime("%d/%m/%Y"), help="dd/mm/yyyy (run)")
+    rec.add_argument("--time", default="08:00:00", help="HH:MM:SS (run)")
+    rec.add_argument("--filter", default="today", choices=("today", "yesterday"), help="(fetch)")
+
+    rep = sub.add_parser("replay", help="replay a recording offline and check budgets")
+    rep.add_argument("flow", choices=("run", "fetch"))
+    rep.add_argument("--latency", type=float, default=1.0, help="scale recorded latencies (0 = none)")
+    rep.add_argument("--update-baseline", action="store_true")
+    rep.add_argument("--postback-savings", action="store_true",
+                     help="also wait for networkidle after each postback and report the difference")
+
+    args = parser.parse_args()
+    if args.command == "record":
+        bookings = [b.strip() for b in args.bookings.split(",") if b.strip()]
+        if args.flow == "run":
+            meta = {
+                "ipp_list": [i for i in re.sub(r"\s+", "", args.ipp).split(",") if i],
+                "date": args.date,
+                "time": args.time,
+                "bookings": bookings,
+            }
+            if not meta["ipp_list"]:
+                parser.error("--ipp is required for the run flow")
+        else:
+            meta = {"filter": args.filter, "codes": sorted({script.MENU_CONFIG[b]["code"] for b in bookings})}
+        record(args.flow, meta)
+        return 0
+
+    if args.postback_savings and args.update_baseline:
+        parser.error("--postback-savings slows every step down; do not combine it with --update-baseline")
+    violations = replay(args.flow, args.latency, args.update_baseline, args.postback_savings)
+    for violation in violations:
+        print(f"[FAIL] {violation}")
+    return 1 if violations else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
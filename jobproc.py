@@ -0,0 +1,25 @@
+"""
+Entry points of HOSIX job processes (web.py, JOB_BACKEND = "process").
+
+web.py starts run() in a spawn-context child process for each job, and
+call() for each patient list or bilan sweep, and drives it over a pipe (see
+script.run_job_process). The targets live here rather than in web.py or
+script.py so the child has a small module to load them from; spawn still
+imports the parent's main script as __mp_main__, so that script must keep
+its module-level work light.
+"""
+import script
+
+
+def run(conn, settings, args, kwargs, flow="run_job", setup=None):
+    """Call setup() if given (loadtest installs its fake SIH), then run the job flow."""
+    if setup is not None:
+        setup()
+    script.run_job_process(conn, settings, args, kwargs, flow)
+
+
+def call(conn, settings, flow, args, kwargs, setup=None):
+    """As run(), for a flow that returns a value (script.run_call_process)."""
+    if setup is not None:
+        setup()
+    script.run_call_process(conn, settings, flow, args, kwargs)
@@ -0,0 +1,592 @@
+"""
+Load test of the web layer (web.py) with simulated tablets and a fake SIH.
+
+web.py runs in a child process (`loadtest.py serve`) with the real Flask
+threaded server, admission, job processes, caches and polling; only the
+browser flows of script.py are replaced by a fake SIH. Its run_job,
+auto_book, fetch_bilan_matrix and fetch_all_patients sleep for SIH-like step
+durations (the medians of har/baseline.json when a replay baseline exists),
+call the same JobControl hooks and observers, and return synthetic
+patients. No Chromium is started, so memory figures leave out the browsers
+(web.py budgets BROWSER_MEMORY_MB for each).
+
+    python loadtest.py                          # ward mix: 10 tablets, 3 /run, 2 /fetch-patients
+    python loadtest.py --mix rush --duration 120
+    python loadtest.py --ramp 1,2,4,8           # the mix x1, x2, ... until it saturates
+    python loadtest.py --speed 1 --max-browsers 4
+
+Each stage gets a fresh server and reports request latency percentiles per
+endpoint, job throughput, peak RSS, thread and process counts of the
+server tree and the deepest admission queue. A stage is saturated when the
+pages tablets poll get slow, requests fail or are turned away with a 503,
+or /run jobs wait for a browser most of the time; a ramp stops at the first one.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from datetime import date, timedelta
+
+import script
+
+try:
+    import psutil
+except ImportError:  # optional: falls back to /proc (Linux), else no process figures
+    psutil = None
+
+BASELINE_FILE = os.path.join("har", "baseline.json")
+FAKE_SIH_ENV = "HOSIX_FAKE_SIH"  # JSON config of the fake SIH, inherited by job processes
+
+# Real-time SIH step durations (seconds); login/booking/history_lookup come from the replay baseline when present
+SIH_STEPS_S = {
+    "launch": 3.0,          # browser start
+    "login": 6.0,
+    "ipp": 8.0,             # IPP search and tool window
+    "booking": 25.0,        # one code at one date
+    "extra_date": 5.0,      # each further date of a series
+    "patient_list": 4.0,    # episodes table
+    "history_lookup": 1.5,  # one patient history page
+    "history_postback": 0.4,  # one in-page history postback (batched lookups)
+}
+SIH_JITTER = 0.2  # each step lasts its duration +/- 20%
+
+# Traffic mixes: tablets poll /jobs (and load / once); runners keep one /run job
+# each in flight; fetchers keep one /fetch-patients sweep each in flight
+MIXES = {
+    "ward": {"tablets": 10, "runners": 3, "fetchers": 2},
+    "polling": {"tablets": 10, "runners": 0, "fetchers": 0},
+    "rush": {"tablets": 20, "runners": 6, "fetchers": 4},
+}
+POLL_S = 5             # /jobs polling period of the UI
+THINK_S = 5            # pause of a runner/fetcher between two requests
+IPPS_PER_RUN = 5
+REQUEST_TIMEOUT_S = 120
+
+# Saturation thresholds
+SATURATION_POLL_P95_S = 1.0   # p95 of GET / and GET /jobs
+SATURATION_ERROR_RATE = 0.01  # failed requests (no answer, 5xx other than 503)
+SATURATION_BUSY_RATE = 0.05   # requests turned away with 503
+SATURATION_QUEUED_SHARE = 0.5  # share of the samples with /run jobs waiting for a browser
+
+
+# =========================
+# FAKE SIH
+# =========================
+def _config():
+    return json.loads(os.environ.get(FAKE_SIH_ENV) or "{}")
+
+
+def _sih_sleep(step, factor=1.0):
+    config = _config()
+    seconds = config.get("steps", SIH_STEPS_S)[step] * factor * config.get("speed", 1.0)
+    seconds *= random.uniform(1 - SIH_JITTER, 1 + SIH_JITTER)
+    time.sleep(seconds)
+    return seconds
+
+
+def _fake_patients(count=None):
+    count = _config().get("patients", 60) if count is None else count
+    return [{"ip": str(1000001 + i), "name": f"PATIENT {i:04d}"} for i in range(count)]
+
+
+def _fake_book_ipp(ipp, dates_08, selected_bookings, control):
+    control.ipp_started(ipp)
+    # The IPP search postback feeds web.py's SIH load control like a real one
+    seconds = _sih_sleep("ipp")
+    script.notify("postback", "ipp", seconds, outcome="postback", server_s=seconds)
+    for code, _ in script.compute_booking_plan(selected_bookings):
+        control.checkpoint()
+        control.booking_started(ipp, code)
+        with script.timed_step("booking", code=code):
+            _sih_sleep("booking")
+            for _ in dates_08[1:]:
+                _sih_sleep("extra_date")
+        control.booking_done(ipp, code)
+    control.ipp_done(ipp)
+
+
+def fake_run_job(ipp_list, selected_date, selected_hour, selected_bookings, username, password, browser_tag=None,
+                 control=None, series=None):
+    """script.run_job against the fake SIH: same hooks, checkpoints and steps, no browser."""
+    dates_08 = list(series) if series else [f"{selected_date} {selected_hour}"]
+    control = control or script.JobControl()
+    _sih_sleep("launch")
+    with script.timed_step("login"):
+        _sih_sleep("login")
+
+    def run_ipps(ipps, ipp_dates_08, bookings, ipp_control):
+        for ipp in ipps:
+            ipp_control.checkpoint()
+            _fake_book_ipp(ipp, ipp_dates_08, bookings, ipp_control)
+
+    for ipp in ipp_list:
+        control.between_ipps(run_ipps)
+        control.checkpoint()
+        _fake_book_ipp(ipp, dates_08, selected_bookings, control)
+    control.between_ipps(run_ipps)
+
+
+def fake_fetch_all_patients(username, password, filter_option="all", browser_tag=None):
+    _sih_sleep("launch")
+    with script.timed_step("login"):
+        _sih_sleep("login")
+    _sih_sleep("patient_list")
+    return [dict(p, has_bilan=False) for p in _fake_patients()]
+
+
+def _fake_history(window_days=script.HISTORY_WINDOW_DAYS):
+    """A random subset of codes, booked on random recent days: {code: [date, ...]}, newest first."""
+    codes = sorted({c["code"] for c in script.MENU_CONFIG.values()})
+    return {code: sorted((date.today() - timedelta(days=random.randrange(max(window_days, 1)))
+                          for _ in range(random.randint(0, 2))), reverse=True)
+            for code in random.sample(codes, random.randint(0, len(codes)))}
+
+
+def fake_fetch_bilan_matrix(username, password, window_days=script.HISTORY_WINDOW_DAYS, browser_tag=None):
+    """A sweep: every patient has a random history."""
+    patients = fake_fetch_all_patients(username, password, browser_tag=browser_tag)
+    matrix = []
+    for patient in patients:
+        with script.timed_step("history_lookup", mode="navigate"):
+            _sih_sleep("history_lookup")
+        matrix.append({"ip": patient["ip"], "name": patient["name"], "dates": _fake_history(window_days), "error": False})
+    return matrix
+
+
+class _FakeSweep:
+    """script.HistorySweep on the fake SIH: random histories read one postback at a time by a background thread."""
+
+    def __init__(self, ipps):
+        self.pending = len(ipps)
+        self.results = []
+        self.lock = threading.Lock()
+        threading.Thread(target=self._run, args=(list(ipps),), daemon=True).start()
+
+    def _run(self, ipps):
+        for ip in ipps:
+            seconds = _sih_sleep("history_postback")
+            rows = [(d.strftime("%d/%m/%Y 08:00"), f"Analyse ({code})")
+                    for code, dates in _fake_history().items() for d in dates]
+            script.notify("step", "history_lookup", seconds, ok=True, mode="batched")
+            with self.lock:
+                self.results.append((ip, rows))
+
+    @property
+    def finished(self):
+        with self.lock:
+            return self.pending == 0 and not self.results
+
+    def take(self):
+        with self.lock:
+            results, self.results = self.results, []
+            self.pending -= len(results)
+        return results
+
+
+def fake_auto_book(username, password, filter_option, selected_date, selected_hour, selected_bookings, rules=None,
+                   browser_tag=None, control=None, series=None):
+    """script.auto_book against the fake SIH: the real sweep_and_book() fed by a _FakeSweep."""
+    dates_08 = list(series) if series else [f"{selected_date} {selected_hour}"]
+    control = control or script.JobControl()
+    patients = {p["ip"]: p["name"] for p in fake_fetch_all_patients(username, password)}
+
+    def run_ipps(ipps, ipp_dates_08, bookings, ipp_control):
+        for ipp in ipps:
+            ipp_control.checkpoint()
+            _fake_book_ipp(ipp, ipp_dates_08, bookings, ipp_control)
+
+    script.sweep_and_book(_FakeSweep(list(patients)), patients, script.bilan_target_date(filter_option),
+                          selected_bookings, rules or {}, control,
+                          lambda ipp, items: _fake_book_ipp(ipp, dates_08, items, control), run_ipps,
+                          lambda ms: time.sleep(ms / 1000))
+
+
+def install_fake_sih():
+    script.run_job = fake_run_job
+    script.auto_book = fake_auto_book
+    script.fetch_all_patients = fake_fetch_all_patients
+    script.fetch_bilan_matrix = fake_fetch_bilan_matrix
+
+
+# =========================
+# SERVER
+# =========================
+def serve(port, backend, max_browsers):
+    """Run web.py on 127.0.0.1:port against the fake SIH (the `serve` command)."""
+    import logging
+    from werkzeug.serving import make_server
+    import web
+
+    install_fake_sih()
+    web.JOB_PROCESS_SETUP = install_fake_sih
+    web.JOB_BACKEND = backend
+    web.MAX_BROWSERS = max_browsers
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", port, web.app, threaded=True)
+    web._engine()
+    threading.Thread(target=web._watchdog.run_forever, daemon=True).start()
+    print("READY", flush=True)
+    server.serve_forever()
+
+
+def _steps_from_baseline():
+    steps = dict(SIH_STEPS_S)
+    try:
+        with open(BASELINE_FILE, "r", encoding="utf-8") as fh:
+            baselines = json.load(fh)
+    except (OSError, ValueError):
+        return steps
+    for flow in baselines.values():
+        for name in ("login", "booking", "history_lookup"):
+            if name in flow:
+                steps[name] = flow[name]["median"]
+    return steps
+
+
+def start_server(port, speed, patients, backend, max_browsers):
+    """Start `loadtest.py serve` in a scratch directory (its own jobs.json, patients.db...); return the process."""
+    env = dict(os.environ)
+    env[FAKE_SIH_ENV] = json.dumps({"speed": speed, "patients": patients, "steps": _steps_from_baseline()})
+    here = os.path.dirname(os.path.abspath(__file__))
+    env["PYTHONPATH"] = os.pathsep.join(p for p in (here, env.get("PYTHONPATH")) if p)
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(here, "loadtest.py"), "serve", "--port", str(port),
+         "--backend", backend, "--max-browsers", str(max_browsers)],
+        cwd=tempfile.mkdtemp(prefix="hosix-loadtest-"), env=env, stdout=subprocess.PIPE, text=True,
+    )
+    if proc.stdout.readline().strip() != "READY":
+        proc.kill()
+        raise RuntimeError("web.py did not start (see the output above)")
+    return proc
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _tree_usage(pid):
+    """(RSS MB, threads, processes) of a process and its children; None when unknown."""
+    if psutil is not None:
+        try:
+            root = psutil.Process(pid)
+            procs = [root] + root.children(recursive=True)
+            rss = threads = 0
+            for proc in procs:
+                try:
+                    rss += proc.memory_info().rss
+                    threads += proc.num_threads()
+                except psutil.Error:
+                    pass
+            return rss / 2**20, threads, len(procs)
+        except psutil.Error:
+            return None
+    try:
+        with open(f"/proc/{pid}/status", "r", encoding="utf-8") as fh:
+            status = dict(line.split(":", 1) for line in fh if ":" in line)
+        return int(status["VmRSS"].split()[0]) / 1024, int(status["Threads"]), 1
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+# =========================
+# LOAD
+# =========================
+class Stats:
+    """Latencies and outcomes of every request, per endpoint, plus job and server samples."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(list)  # "GET /jobs" -> [(seconds, status), ...]
+        self.jobs = []                     # (status, seconds from /run to finished)
+        self.submitted = 0
+        self.samples = []                  # (rss_mb, threads, processes, queued)
+
+    def request(self, endpoint, seconds, status):
+        with self._lock:
+            self.requests[endpoint].append((seconds, status))
+
+    def job(self, status, seconds):
+        with self._lock:
+            self.jobs.append((status, seconds))
+
+    def job_submitted(self):
+        with self._lock:
+            self.submitted += 1
+
+    def sample(self, usage, queued):
+        with self._lock:
+            self.samples.append((*(usage or (None, None, None)), queued))
+
+
+class Client:
+    def __init__(self, base_url, stats, stop, patients):
+        self.base_url = base_url
+        self.stats = stats
+        self.stop = stop
+        self.ipps = [p["ip"] for p in _fake_patients(patients)]
+
+    def call(self, method, path, form=None, headers=None, label=None):
+        """(status, headers, parsed JSON or None); status 0 when the server did not answer."""
+        data = urllib.parse.urlencode(form, doseq=True).encode("utf-8") if form is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method, headers=headers or {})
+        t0 = time.perf_counter()
+        status, reply_headers, body = 0, {}, b""
+        try:
+            with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT_S) as resp:
+                status, reply_headers, body = resp.status, resp.headers, resp.read()
+        except urllib.error.HTTPError as exc:  # also 304 Not Modified
+            status, reply_headers, body = exc.code, exc.headers, exc.read()
+        except (urllib.error.URLError, OSError):
+            pass
+        self.stats.request(label or f"{method} {path}", time.perf_counter() - t0, status)
+        try:
+            return status, reply_headers, json.loads(body) if body else None
+        except ValueError:
+            return status, reply_headers, None
+
+
+def _tablet(client, index):
+    """A tablet with the UI open: loads the page, then polls /jobs with the ETag like the browser does."""
+    client.stop.wait(random.uniform(0, POLL_S))
+    client.call("GET", "/")
+    etag = None
+    while not client.stop.is_set():
+        status, headers, _ = client.call("GET", "/jobs", headers={"If-None-Match": etag} if etag else {})
+        if status == 200:
+            etag = headers.get("ETag")
+        client.stop.wait(POLL_S)
+
+
+def _wait_job(client, job_id, submitted):
+    while not client.stop.wait(POLL_S):
+        status, _, jobs = client.call("GET", "/jobs")
+        if status != 200 or jobs is None:
+            continue
+        job = next((j for j in jobs if j["id"] == job_id), None)
+        if job is None or job["status"] in ("completed", "failed", "cancelled"):
+            client.stats.job(job["status"] if job else "unknown", time.monotonic() - submitted)
+            return
+
+
+def _runner(client, index):
+    """A nurse submitting a batch, waiting for it to finish, then submitting the next one."""
+    client.stop.wait(random.uniform(0, THINK_S))
+    while not client.stop.is_set():
+        form = {
+            "ipp_list": ",".join(random.sample(client.ipps, min(IPPS_PER_RUN, len(client.ipps)))),
+            "username": f"infirmier{index}",
+            "password": "loadtest",
+            "bookings": random.sample(list(script.MENU_CONFIG), 2),
+            "date_choice": "today",
+            "time_choice": "now",
+        }
+        submitted = time.monotonic()
+        status, headers, reply = client.call("POST", "/run", form)
+        if status == 400 and reply and reply.get("invalid_ipps"):
+            status, headers, reply = client.call("POST", "/run", dict(form, force="1"), label="POST /run (force)")
+        if status == 200 and reply:
+            client.stats.job_submitted()
+            _wait_job(client, reply["job_id"], submitted)
+        elif status == 503:
+            client.stop.wait(float(headers.get("Retry-After") or THINK_S))
+        client.stop.wait(THINK_S)
+
+
+def _fetcher(client, index):
+    """A nurse refreshing the list of patients without bilans (a full sweep each time)."""
+    client.stop.wait(random.uniform(0, THINK_S))
+    while not client.stop.is_set():
+        status, headers, _ = client.call("POST", "/fetch-patients", {
+            "username": f"infirmier{index}", "password": "loadtest", "filter": "today",
+            "bookings": ["NFS", "CRP"], "refresh": "1",
+        })
+        client.stop.wait(float(headers.get("Retry-After") or THINK_S) if status == 503 else THINK_S)
+
+
+def _sampler(client, pid):
+    while not client.stop.is_set():
+        usage = _tree_usage(pid)
+        _, _, status = client.call("GET", "/status", label="GET /status (sampler)")
+        queued = (status or {}).get("resources", {}).get("queued")
+        client.stats.sample(usage, queued)
+        client.stop.wait(1.0)
+
+
+def run_stage(mix, factor, duration, speed, patients, backend, max_browsers):
+    """Drive mix x factor against a fresh server for duration seconds; return its Stats."""
+    port = _free_port()
+    proc = start_server(port, speed, patients, backend, max_browsers)
+    stats = Stats()
+    stop = threading.Event()
+    client = Client(f"http://127.0.0.1:{port}", stats, stop, patients)
+    threads = [threading.Thread(target=_sampler, args=(client, proc.pid), daemon=True)]
+    for role, target in (("tablets", _tablet), ("runners", _runner), ("fetchers", _fetcher)):
+        threads += [threading.Thread(target=target, args=(client, i), daemon=True)
+                    for i in range(mix[role] * factor)]
+    try:
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join(REQUEST_TIMEOUT_S)
+        # Job processes still running die with the server (without psutil, on their next pipe write)
+        children = []
+        if psutil is not None:
+            try:
+                children = psutil.Process(proc.pid).children(recursive=True)
+            except psutil.Error:
+                pass
+        proc.kill()
+        proc.wait()
+        for child in children:
+            try:
+                child.kill()
+            except psutil.Error:
+                pass
+    return stats
+
+
+# =========================
+# REPORT
+# =========================
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[math.ceil(q * len(ordered)) - 1] if ordered else None
+
+
+def summarize(stats, duration, speed):
+    """Per-endpoint latencies, job throughput, server peaks and the saturation reasons (empty: fine)."""
+    endpoints = {}
+    for endpoint, results in sorted(stats.requests.items()):
+        latencies = [s for s, _ in results]
+        endpoints[endpoint] = {
+            "count": len(results),
+            "errors": sum(1 for _, status in results if status == 0 or (status >= 500 and status != 503)),
+            "busy": sum(1 for _, status in results if status == 503),
+            **{f"p{q}_s": round(_percentile(latencies, q / 100), 4) for q in (50, 95, 99)},
+            "max_s": round(max(latencies), 4),
+        }
+    completed = [s for status, s in stats.jobs if status == "completed"]
+    samples = stats.samples
+
+    def peak(i):
+        values = [s[i] for s in samples if s[i] is not None]
+        return round(max(values), 1) if values else None
+
+    summary = {
+        "endpoints": endpoints,
+        "jobs": {
+            "submitted": stats.submitted,
+            "completed": len(completed),
+            "failed": sum(1 for status, _ in stats.jobs if status in ("failed", "cancelled", "unknown")),
+            "per_min": round(len(completed) * 60 / duration, 2),
+            # Fake SIH time runs `speed` times real time
+            "per_min_real_sih": round(len(completed) * 60 / duration * speed, 2),
+            "mean_time_in_system_s": round(sum(completed) / len(completed), 1) if completed else None,
+        },
+        "server": {"peak_rss_mb": peak(0), "peak_threads": peak(1), "peak_processes": peak(2),
+                   "peak_queued": peak(3)},
+    }
+
+    reasons = []
+    for endpoint in ("GET /", "GET /jobs"):
+        p95 = endpoints.get(endpoint, {}).get("p95_s")
+        if p95 is not None and p95 > SATURATION_POLL_P95_S:
+            reasons.append(f"{endpoint} p95 {p95:.2f}s > {SATURATION_POLL_P95_S}s")
+    total = sum(e["count"] for e in endpoints.values())
+    errors = sum(e["errors"] for e in endpoints.values())
+    busy = sum(e["busy"] for e in endpoints.values())
+    if total and errors / total > SATURATION_ERROR_RATE:
+        reasons.append(f"{errors}/{total} requests failed")
+    if total and busy / total > SATURATION_BUSY_RATE:
+        reasons.append(f"{busy}/{total} requests turned away (503)")
+    queued = [s[3] for s in samples if s[3] is not None]
+    if queued and sum(1 for q in queued if q) / len(queued) > SATURATION_QUEUED_SHARE:
+        reasons.append(f"jobs waited for a browser {100 * sum(1 for q in queued if q) // len(queued)}% of the time")
+    summary["saturated"] = reasons
+    return summary
+
+
+def print_summary(title, summary):
+    print(f"\n{title}")
+    print(f"  {'endpoint':<28}{'n':>6}{'err':>5}{'503':>5}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for endpoint, e in summary["endpoints"].items():
+        print(f"  {endpoint:<28}{e['count']:>6}{e['errors']:>5}{e['busy']:>5}"
+              f"{e['p50_s']:>9.3f}{e['p95_s']:>9.3f}{e['p99_s']:>9.3f}{e['max_s']:>9.3f}")
+    jobs, server = summary["jobs"], summary["server"]
+    print(f"  jobs: {jobs['submitted']} submitted, {jobs['completed']} completed, {jobs['failed']} failed, "
+          f"{jobs['per_min']}/min ({jobs['per_min_real_sih']}/min at real SIH speed), "
+          f"mean {jobs['mean_time_in_system_s']} s from /run to done")
+    print(f"  server: peak RSS {server['peak_rss_mb']} MB (no browsers), {server['peak_threads']} threads, "
+          f"{server['peak_processes']} processes, queue {server['peak_queued']}")
+    print("  saturated: " + ("; ".join(summary["saturated"]) if summary["saturated"] else "no"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test web.py with simulated tablets and a fake SIH.")
+    sub = parser.add_subparsers(dest="command")
+    srv = sub.add_parser("serve", help="(internal) run web.py against the fake SIH")
+    srv.add_argument("--port", type=int, required=True)
+    srv.add_argument("--backend", default="process")
+    srv.add_argument("--max-browsers", type=int, default=2)
+
+    parser.add_argument("--mix", choices=sorted(MIXES), default="ward")
+    parser.add_argument("--ramp", default="1", help="comma-separated multipliers of the mix, e.g. 1,2,4,8")
+    parser.add_argument("--duration", type=float, default=60, help="seconds per stage")
+    parser.add_argument("--speed", type=float, default=0.1, help="fake SIH step durations x this (1 = real time)")
+    parser.add_argument("--patients", type=int, default=60, help="hospitalised patients in the fake SIH")
+    parser.add_argument("--backend", choices=("process", "thread"), default="process", help="web.JOB_BACKEND")
+    parser.add_argument("--max-browsers", type=int, default=2, help="web.MAX_BROWSERS")
+    parser.add_argument("--json", help="also write the results to this file")
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        serve(args.port, args.backend, args.max_browsers)
+        return 0
+
+    try:
+        factors = [int(f) for f in args.ramp.split(",") if f.strip()]
+    except ValueError:
+        parser.error("--ramp takes comma-separated integers")
+    mix = MIXES[args.mix]
+    results = []
+    saturation = None
+    for factor in factors:
+        title = (f"Stage x{factor}: {mix['tablets'] * factor} tablets, {mix['runners'] * factor} runners, "
+                 f"{mix['fetchers'] * factor} fetchers, {args.duration:g} s, SIH speed x{args.speed:g}")
+        print(f"[INFO] {title}...", flush=True)
+        stats = run_stage(mix, factor, args.duration, args.speed, args.patients, args.backend, args.max_browsers)
+        summary = summarize(stats, args.duration, args.speed)
+        print_summary(title, summary)
+        results.append({"factor": factor, **summary})
+        if summary["saturated"]:
+            saturation = factor
+            break
+
+    if len(factors) > 1:
+        print("\n" + (f"Saturation at x{saturation} of the '{args.mix}' mix." if saturation
+                      else f"No saturation up to x{factors[-1]} of the '{args.mix}' mix."))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump({"mix": args.mix, "speed": args.speed, "stages": results, "saturation": saturation}, fh,
+                      indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,11 +9,11 @@ title Script Launcher
 cd /d "%~dp0"
 
 REM ============================================
-REM CONFIGURATION - Set your GitHub raw URL here
+REM CONFIGURATION
 REM ============================================
-set "GITHUB_RAW_URL=https://raw.githubusercontent.com/kamatil-dev/hosix/main/script.py"
-set "WEB_PY_URL=https://raw.githubusercontent.com/kamatil-dev/hosix/main/web.py"
-set "RUN_BAT_URL=https://raw.githubusercontent.com/kamatil-dev/hosix/main/run.bat"
+REM Python packages required by the app. Changing this list changes the
+REM environment fingerprint and triggers a reinstall on next launch.
+set "DEPS=playwright beaupy flask brotli psutil cryptography"
 
 echo.
 echo ========================================
@@ -21,8 +21,16 @@ echo        Script Launcher (Windows)
 echo ========================================
 echo.
 
+REM Apply updates staged by the web server during the previous run
+for %%f in (script.py web.py jobproc.py) do (
+    if exist "%%f.new" (
+        move /y "%%f.new" "%%f" >nul 2>&1
+        echo %%f updated successfully!
+    )
+)
+
 REM Check if Python is installed
-echo [1/5] Checking Python installation...
+echo [1/4] Checking Python installation...
 python --version >nul 2>&1
 if %errorlevel% neq 0 (
     echo.
@@ -81,7 +89,7 @@ python --version
 
 REM Check/Create virtual environment
 echo.
-echo [2/5] Setting up virtual environment...
+echo [2/4] Setting up virtual environment...
 if not exist "venv" (
     echo Creating virtual environment...
     python -m venv venv
@@ -95,15 +103,23 @@ if not exist "venv" (
 REM Activate virtual environment
 call venv\Scripts\activate.bat
 
-REM Upgrade pip
+REM Dependencies and browser: skipped entirely when the fingerprint is unchanged
 echo.
-echo [3/5] Upgrading pip...
+echo [3/4] Checking dependencies...
+set "FINGERPRINT_FILE=venv\.hosix_fingerprint"
+set "SAVED_FP="
+if exist "%FINGERPRINT_FILE%" set /p SAVED_FP=<"%FINGERPRINT_FILE%"
+call :env_fingerprint
+if defined SAVED_FP if not "!ENV_FP!"=="none" if "!SAVED_FP!"=="!ENV_FP!" (
+    echo Environment unchanged, skipping dependency and browser checks.
+    goto :deps_ready
+)
+
+echo Upgrading pip...
 python -m pip install --upgrade pip --quiet
 
-REM Install dependencies
-echo.
-echo [4/5] Installing/checking dependencies...
-python -m pip install playwright beaupy flask
+echo Installing/checking dependencies...
+python -m pip install %DEPS%
 if %errorlevel% neq 0 (
     echo.
     echo [ERROR] Failed to install Python packages!
@@ -113,9 +129,7 @@ if %errorlevel% neq 0 (
 )
 echo Dependencies installed successfully.
 
-REM Install Playwright browsers
-echo.
-echo [4.5/5] Installing Playwright browsers (skipped if already installed)...
+echo Installing Playwright browsers (skipped if already installed)...
 python -m playwright install chromium
 if %errorlevel% neq 0 (
     echo.
@@ -125,21 +139,20 @@ if %errorlevel% neq 0 (
     exit /b 1
 )
 
-REM Update script and launcher from GitHub
-echo.
-echo [5/5] Checking for updates...
-    powershell -Command "try { (New-Object System.Net.WebClient).DownloadFile('%GITHUB_RAW_URL%', 'script.py.tmp'); Move-Item -Force 'script.py.tmp' 'script.py'; Write-Host 'script.py updated successfully!' } catch { Write-Host 'script.py update check failed, using local version.' }"
-    powershell -Command "try { (New-Object System.Net.WebClient).DownloadFile('%WEB_PY_URL%', 'web.py.tmp'); Move-Item -Force 'web.py.tmp' 'web.py'; Write-Host 'web.py updated successfully!' } catch { Write-Host 'web.py update check failed, using local version.' }"
-    powershell -Command "try { (New-Object System.Net.WebClient).DownloadFile('%RUN_BAT_URL%', 'run.bat.new'); Write-Host 'Launcher update downloaded.' } catch { Write-Host 'Launcher update check failed, using local version.' }"
+call :env_fingerprint
+>"%FINGERPRINT_FILE%" echo !ENV_FP!
 
+:deps_ready
+REM Updates are checked by web.py in the background once the server is up;
+REM downloaded files are applied at the top of this script on next launch.
 echo.
 echo ========================================
-echo      Starting Web Interface...
+echo [4/4] Starting Web Interface...
 echo ========================================
 echo.
 
 REM Run the web server
-python web.py
+python web.py %*
 set exit_code=%errorlevel%
 
 REM Apply launcher update now that python has exited (safe to replace run.bat here)
@@ -159,3 +172,12 @@ if %exit_code% neq 0 (
 echo.
 echo Press any key to close...
 pause >nul
+goto :eof
+
+REM Fingerprint of everything the dependency steps would change: Python
+REM version, requested packages, installed package versions and the
+REM Playwright Chromium build. Result in ENV_FP ("none" = no browser yet).
+:env_fingerprint
+set "ENV_FP=none"
+for /f "delims=" %%F in ('python -c "import glob,hashlib,os,sys,importlib.metadata as m;i={(d.metadata['Name'] or '').lower():d.version for d in m.distributions()};b=os.environ.get('PLAYWRIGHT_BROWSERS_PATH') or os.path.join(os.environ.get('LOCALAPPDATA',''),'ms-playwright');c=sorted(os.path.basename(p) for p in glob.glob(os.path.join(b,'chromium*')));print(hashlib.sha1('|'.join([sys.version]+[n+'='+i.get(n,'-') for n in os.environ['DEPS'].split()]+c).encode()).hexdigest() if c else 'none')" 2^>nul') do set "ENV_FP=%%F"
+exit /b 0
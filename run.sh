@@ -5,11 +5,14 @@
 # ============================================
 
 # ============================================
-# CONFIGURATION - Set your GitHub raw URL here
+# CONFIGURATION
 # ============================================
-GITHUB_RAW_URL="https://raw.githubusercontent.com/kamatil-dev/hosix/main/script.py"
-WEB_PY_URL="https://raw.githubusercontent.com/kamatil-dev/hosix/main/web.py"
-RUN_SH_URL="https://raw.githubusercontent.com/kamatil-dev/hosix/main/run.sh"
+# Python packages required by the app. Changing this list changes the
+# environment fingerprint and triggers a reinstall on next launch.
+DEPS="playwright beaupy flask brotli psutil cryptography"
+
+# Launch timestamp, used by web.py to report total startup time
+export HOSIX_LAUNCH_T0="${HOSIX_LAUNCH_T0:-$(date +%s.%N 2>/dev/null || date +%s)}"
 
 # Change to script directory
 cd "$(dirname "$0")"
@@ -20,11 +23,46 @@ echo "       Script Launcher (Linux)"
 echo "========================================"
 echo ""
 
+# Apply updates staged by the web server during the previous run
+if [ -f run.sh.new ]; then
+    chmod +x run.sh.new
+    mv run.sh.new run.sh
+    echo "Launcher updated! Restarting with new version..."
+    exec bash ./run.sh "$@"
+fi
+for f in script.py web.py jobproc.py; do
+    if [ -f "$f.new" ]; then
+        mv "$f.new" "$f"
+        echo "$f updated successfully!"
+    fi
+done
+
 # Function to check if a command exists
 command_exists() {
     command -v "$1" >/dev/null 2>&1
 }
 
+# Fingerprint of everything the dependency steps would change: Python
+# version, requested packages, installed package versions and the
+# Playwright Chromium build. Unchanged fingerprint = nothing to install.
+env_fingerprint() {
+    DEPS="$DEPS" python - <<'EOF' 2>/dev/null
+import glob, hashlib, os, sys
+import importlib.metadata as md
+
+installed = {(d.metadata["Name"] or "").lower(): d.version for d in md.distributions()}
+deps = os.environ["DEPS"].split()
+if sys.platform == "darwin":
+    default_browsers = os.path.expanduser("~/Library/Caches/ms-playwright")
+else:
+    default_browsers = os.path.expanduser("~/.cache/ms-playwright")
+browsers = os.environ.get("PLAYWRIGHT_BROWSERS_PATH") or default_browsers
+chromium = sorted(os.path.basename(p) for p in glob.glob(os.path.join(browsers, "chromium*")))
+parts = [sys.version, *(f"{d}={installed.get(d, '-')}" for d in deps), *chromium]
+print(hashlib.sha1("|".join(parts).encode()).hexdigest() if chromium else "none")
+EOF
+}
+
 # Function to install Python
 install_python() {
     echo ""
@@ -59,7 +97,7 @@ install_python() {
 }
 
 # Check if Python is installed
-echo "[1/5] Checking Python installation..."
+echo "[1/4] Checking Python installation..."
 if command_exists python3; then
     PYTHON=python3
     PIP=pip3
@@ -99,7 +137,7 @@ $PYTHON --version
 
 # Check/Create virtual environment
 echo ""
-echo "[2/5] Setting up virtual environment..."
+echo "[2/4] Setting up virtual environment..."
 if [ ! -d "venv" ]; then
     echo "Creating virtual environment..."
     $PYTHON -m venv venv
@@ -114,102 +152,48 @@ fi
 # Activate virtual environment
 source venv/bin/activate
 
-# Upgrade pip
-echo ""
-echo "[3/5] Upgrading pip..."
-python -m pip install --upgrade pip --quiet
-
-# Install dependencies
+# Dependencies and browser: skipped entirely when the fingerprint is unchanged
 echo ""
-echo "[4/5] Installing/checking dependencies..."
-python -m pip install playwright beaupy flask --quiet
-if [ $? -ne 0 ]; then
-    echo "[ERROR] Failed to install Python packages!"
-    read -p "Press Enter to close..."
-    exit 1
-fi
-
-# Install Playwright browsers
-echo ""
-echo "[4.5/5] Installing Playwright browsers (skipped if already installed)..."
-python -m playwright install chromium
-if [ $? -ne 0 ]; then
-    echo "[ERROR] Failed to install Playwright browsers!"
-    echo "You may need to install system dependencies:"
-    echo "  python -m playwright install-deps chromium"
-    read -p "Press Enter to close..."
-    exit 1
-fi
+echo "[3/4] Checking dependencies..."
+FINGERPRINT_FILE="venv/.hosix_fingerprint"
+CURRENT_FP="$(env_fingerprint)"
+if [ "$CURRENT_FP" != "none" ] && [ -f "$FINGERPRINT_FILE" ] && [ "$CURRENT_FP" = "$(cat "$FINGERPRINT_FILE")" ]; then
+    echo "Environment unchanged, skipping dependency and browser checks."
+else
+    echo "Upgrading pip..."
+    python -m pip install --upgrade pip --quiet
 
-# Update script and launcher from GitHub
-echo ""
-echo "[5/5] Checking for updates..."
-if command_exists curl; then
-    if curl -fsSL -H "Cache-Control: no-cache, no-store" -H "Pragma: no-cache" "$GITHUB_RAW_URL" -o script.py.tmp 2>/dev/null; then
-        mv script.py.tmp script.py
-        echo "script.py updated successfully!"
-    else
-        echo "script.py update check failed, using local version."
-        rm -f script.py.tmp
-    fi
-    if curl -fsSL -H "Cache-Control: no-cache, no-store" -H "Pragma: no-cache" "$WEB_PY_URL" -o web.py.tmp 2>/dev/null; then
-        mv web.py.tmp web.py
-        echo "web.py updated successfully!"
-    else
-        echo "web.py update check failed, using local version."
-        rm -f web.py.tmp
-    fi
-    if [ -z "$_HOSIX_LAUNCHER_UPDATED" ]; then
-        if curl -fsSL -H "Cache-Control: no-cache, no-store" -H "Pragma: no-cache" "$RUN_SH_URL" -o run.sh.tmp 2>/dev/null; then
-            chmod +x run.sh.tmp
-            mv run.sh.tmp run.sh
-            echo "Launcher updated! Restarting with new version..."
-            export _HOSIX_LAUNCHER_UPDATED=1
-            exec bash ./run.sh
-        else
-            echo "Launcher update check failed, using local version."
-            rm -f run.sh.tmp
-        fi
-    fi
-elif command_exists wget; then
-    if wget -q --no-cache "$GITHUB_RAW_URL" -O script.py.tmp 2>/dev/null; then
-        mv script.py.tmp script.py
-        echo "script.py updated successfully!"
-    else
-        echo "script.py update check failed, using local version."
-        rm -f script.py.tmp
-    fi
-    if wget -q --no-cache "$WEB_PY_URL" -O web.py.tmp 2>/dev/null; then
-        mv web.py.tmp web.py
-        echo "web.py updated successfully!"
-    else
-        echo "web.py update check failed, using local version."
-        rm -f web.py.tmp
+    echo "Installing/checking dependencies..."
+    python -m pip install $DEPS --quiet
+    if [ $? -ne 0 ]; then
+        echo "[ERROR] Failed to install Python packages!"
+        read -p "Press Enter to close..."
+        exit 1
     fi
-    if [ -z "$_HOSIX_LAUNCHER_UPDATED" ]; then
-        if wget -q --no-cache "$RUN_SH_URL" -O run.sh.tmp 2>/dev/null; then
-            chmod +x run.sh.tmp
-            mv run.sh.tmp run.sh
-            echo "Launcher updated! Restarting with new version..."
-            export _HOSIX_LAUNCHER_UPDATED=1
-            exec bash ./run.sh
-        else
-            echo "Launcher update check failed, using local version."
-            rm -f run.sh.tmp
-        fi
+
+    echo "Installing Playwright browsers (skipped if already installed)..."
+    python -m playwright install chromium
+    if [ $? -ne 0 ]; then
+        echo "[ERROR] Failed to install Playwright browsers!"
+        echo "You may need to install system dependencies:"
+        echo "  python -m playwright install-deps chromium"
+        read -p "Press Enter to close..."
+        exit 1
     fi
-else
-    echo "Neither curl nor wget found, skipping update check."
+
+    env_fingerprint > "$FINGERPRINT_FILE"
 fi
 
+# Updates are checked by web.py in the background once the server is up;
+# downloaded files are applied at the top of this script on next launch.
 echo ""
 echo "========================================"
-echo "      Starting Web Interface..."
+echo "[4/4] Starting Web Interface..."
 echo "========================================"
 echo ""
 
 # Run the web server
-python web.py
+python web.py "$@"
 exit_code=$?
 
 echo ""
@@ -1,11 +1,18 @@
 from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime, date, timedelta
-from beaupy import select, select_multiple
+import email.utils
 import getpass
+import hashlib
+import json
+import math
 import re
 import os
 import subprocess
+import threading
 import time
+import urllib.parse
 
 # =========================
 # CONFIG
@@ -81,14 +88,85 @@ USE_XDOTOOL = True          # True = use xdotool to press Enter on print dialog
 # Browser
 USE_PRIVATE_MODE = True     # True = launch in incognito/private mode
 HEADLESS = True             # False = show the browser window (disable headless mode)
+LAUNCH_PROFILE = "standard" # "lean" = low-memory Chromium flags (applied to headless runs only)
+
+# Chromium flags for the "lean" profile (old 4 GB ward PCs)
+LEAN_CHROMIUM_ARGS = [
+    # Reduced process model: share renderers instead of one per site/frame
+    "--renderer-process-limit=2",
+    "--process-per-site",
+    # No GPU process, extensions or background services
+    "--disable-gpu",
+    "--disable-software-rasterizer",
+    "--disable-extensions",
+    "--disable-component-extensions-with-background-pages",
+    "--disable-background-networking",
+    "--disable-default-apps",
+    "--disable-sync",
+    "--no-first-run",
+    "--mute-audio",
+    # Small caches
+    "--disk-cache-size=1048576",
+    "--media-cache-size=1048576",
+]
+
+# Marker added to the browser command line so its process tree can be found
+BROWSER_TAG_ARG = "--hosix-tag="
 
 # Safety/timeouts
 DEFAULT_TIMEOUT_MS = 0  # 0 = no timeout, wait indefinitely
 SOFT_TIMEOUT_MS = 30000  # Soft timeout for optional waits (30 seconds)
 
+# Adaptive timeouts: learned from observed wait latencies (see LatencyTracker)
+ADAPTIVE_TIMEOUTS = True
+LATENCY_FILE = "latency.json"
+LATENCY_WINDOW = 200          # latest successful waits kept per key
+LATENCY_MIN_SAMPLES = 20      # fewer samples = configured timeout is used
+LATENCY_MARGIN = 1.5          # optional waits: p99 * margin + floor
+LATENCY_FLOOR_MS = 500
+REQUIRED_WAIT_FACTOR = 10     # required waits: p99 * factor, at least REQUIRED_WAIT_MIN_MS
+REQUIRED_WAIT_MIN_MS = 60000
+
+# Races (see wait_first): how often outcomes are polled, and how long the page
+# must stay free of postbacks/loads before "nothing more is coming" wins
+RACE_POLL_MS = 50
+RACE_SETTLE_MS = 300
+
+# Postbacks (see wait_postback): ASP.NET AJAX begin/endRequest and document loads
+# are tracked in every frame instead of waiting for networkidle
+POSTBACK_POLL_MS = 25
+POSTBACK_START_MS = 500        # nothing started by then = the action triggered no postback
+POSTBACK_TIMEOUT_MS = 120000   # then fall back to networkidle
+POSTBACK_MEASURE_SAVINGS = False  # also wait networkidle afterwards and report the difference
+
+# Booking modal reuse (see book_codes): keep the modal open across the codes of
+# an IPP; steps of that path give up after this long and the classic path runs
+REUSE_BOOKING_MODAL = True
+MODAL_REUSE_TIMEOUT_MS = 5000
+
+# Static asset cache (see AssetCache): ExtJS bundles, themes and ASP.NET
+# WebResource/ScriptResource.axd files, kept on disk across incognito contexts.
+# Other .axd handlers (charts, report viewers...) are dynamic and never cached.
+ASSET_CACHE_ENABLED = True
+ASSET_CACHE_DIR = "asset_cache"
+ASSET_CACHE_MAX_MB = 200
+ASSET_CACHE_MAX_ENTRY_MB = 10
+ASSET_CACHE_FRESH_S = 24 * 3600  # cap on the max-age/Expires freshness; then revalidated (ETag/Last-Modified)
+ASSET_CACHE_AXD_HANDLERS = ("webresource.axd", "scriptresource.axd")
+ASSET_CACHE_EXTENSIONS = (".js", ".css", ".png", ".gif", ".jpg", ".jpeg", ".svg", ".ico",
+                          ".woff", ".woff2", ".ttf", ".eot")
+# Path segments static files are served from; files with the extensions above elsewhere are not cached
+ASSET_CACHE_STATIC_PATHS = ("/extjs/", "/ext/", "/resources/", "/scripts/", "/js/", "/content/", "/css/",
+                            "/app_themes/", "/themes/", "/images/", "/img/", "/fonts/")
+
 # Logging
 VERBOSE = False  # Set to True to show debug/info logs
 
+# Extension points (used by web.py and har_harness.py)
+CONTEXT_OPTIONS = {}  # extra keyword arguments for browser.new_context(), e.g. record_har_path
+CONTEXT_HOOKS = []    # callables run on every new browser context, e.g. request routing
+OBSERVERS = []        # callables notified as observer(kind, name, value, labels)
+
 
 # =========================
 # HELPERS
@@ -98,6 +176,368 @@ def log(message):
     if VERBOSE:
         print(message)
 
+def notify(kind, name, value, **labels):
+    """Pass a measurement to every registered observer; observers must not break a job."""
+    for observer in list(OBSERVERS):
+        try:
+            observer(kind, name, value, labels)
+        except Exception as e:
+            log(f"[WARNING] Observer failed: {e}")
+
+class LatencyTracker:
+    """
+    Rolling window of successful wait latencies per key (usually a selector)
+    and the timeouts derived from their p99. Timeouts only shrink optional
+    waits and only bound required waits that had none; an element that
+    never showed up teaches nothing, so the configured value stays.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.persist = True  # False in job processes: their samples are sent to web.py, which saves them
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._dirty = False
+        try:
+            with open(path, "r", encoding="utf-8") as fh:
+                self._samples = {k: list(v)[-LATENCY_WINDOW:] for k, v in json.load(fh).items()}
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    def record(self, key, ms):
+        with self._lock:
+            samples = self._samples.setdefault(key, [])
+            samples.append(round(ms, 1))
+            del samples[:-LATENCY_WINDOW]
+            self._dirty = True
+
+    def _p99(self, key):
+        samples = sorted(self._samples.get(key, ()))
+        if len(samples) < LATENCY_MIN_SAMPLES:
+            return None
+        return samples[math.ceil(0.99 * len(samples)) - 1]
+
+    def timeout_ms(self, key, default_ms, required=False):
+        """Timeout for a wait on key; default_ms 0 means no limit."""
+        if not ADAPTIVE_TIMEOUTS:
+            return default_ms
+        with self._lock:
+            p99 = self._p99(key)
+        if p99 is None:
+            return default_ms
+        if required:
+            learned = max(p99 * REQUIRED_WAIT_FACTOR, REQUIRED_WAIT_MIN_MS)
+        else:
+            learned = p99 * LATENCY_MARGIN + LATENCY_FLOOR_MS
+        return int(learned if default_ms == 0 else min(default_ms, learned))
+
+    def snapshot(self):
+        """{key: {"samples", "p50_ms", "p99_ms"}} for reporting."""
+        with self._lock:
+            result = {}
+            for key, samples in self._samples.items():
+                ordered = sorted(samples)
+                result[key] = {
+                    "samples": len(ordered),
+                    "p50_ms": ordered[len(ordered) // 2] if ordered else None,
+                    "p99_ms": ordered[math.ceil(0.99 * len(ordered)) - 1] if ordered else None,
+                }
+            return result
+
+    def save(self):
+        with self._lock:
+            if not self._dirty or not self.persist:
+                return
+            data = json.dumps(self._samples)
+            self._dirty = False
+        tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as fh:
+                fh.write(data)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log(f"[WARNING] Could not save latencies: {e}")
+
+
+LATENCY = LatencyTracker(LATENCY_FILE)
+
+
+def learned_wait(locator, key, default_ms, required=False):
+    """
+    Wait for locator to be visible with a timeout learned for key.
+    Return True once visible; on timeout return False, or raise if required.
+    """
+    timeout = LATENCY.timeout_ms(key, default_ms, required)
+    start = time.perf_counter()
+    try:
+        locator.wait_for(state="visible", timeout=timeout)
+    except PlaywrightTimeoutError:
+        notify("wait", key, time.perf_counter() - start, found=False)
+        if required:
+            raise
+        return False
+    elapsed = time.perf_counter() - start
+    LATENCY.record(key, elapsed * 1000)
+    notify("wait", key, elapsed, found=True)
+    return True
+
+@contextmanager
+def timed_step(name, **labels):
+    """Time the enclosed block and notify observers with kind "step" and ok=True/False."""
+    start = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        notify("step", name, time.perf_counter() - start, ok=ok, **labels)
+
+class Outcome:
+    """One possible result of an action, raced by wait_first()."""
+
+    def arm(self, page):
+        """Start listening; called before the action runs."""
+
+    def poll(self, page):
+        """Return a truthy value once this outcome happened, else None."""
+        return None
+
+    def disarm(self, page):
+        """Stop listening."""
+
+class Visible(Outcome):
+    """An element (optionally inside the iframe frame_id) is visible; resolves to its locator."""
+
+    def __init__(self, selector, frame_id=None):
+        self.selector = selector
+        self.frame_id = frame_id
+
+    def poll(self, page):
+        root = page.frame_locator(f"#{self.frame_id}") if self.frame_id else page
+        locator = root.locator(self.selector).first
+        try:
+            return locator if locator.is_visible() else None
+        except Exception:
+            return None  # frame detached or replaced by a postback
+
+class Popup(Outcome):
+    """A new page opens in the context (window.open popups included); resolves to that page."""
+
+    def arm(self, page):
+        self.pages = []
+        self._handler = self.pages.append
+        page.context.on("page", self._handler)
+
+    def poll(self, page):
+        return self.pages[0] if self.pages else None
+
+    def disarm(self, page):
+        page.context.remove_listener("page", self._handler)
+
+class Dialog(Outcome):
+    """
+    A JavaScript alert/confirm fires; it is accepted (or dismissed) and
+    resolves to the dialog. With accept=None it is left to the page's own
+    "dialog" handler, which must then be registered.
+    """
+
+    def __init__(self, accept=True):
+        self.accept = accept
+
+    def arm(self, page):
+        self.dialog = None
+        page.on("dialog", self._on_dialog)
+
+    def _on_dialog(self, dialog):
+        self.dialog = self.dialog or dialog
+        if self.accept is None:
+            return
+        log(f"[INFO] Alert detected: {dialog.message}")
+        try:
+            if self.accept:
+                dialog.accept()
+            else:
+                dialog.dismiss()
+        except Exception as e:
+            log(f"[WARNING] Failed to answer dialog: {e}")
+
+    def poll(self, page):
+        return self.dialog
+
+    def disarm(self, page):
+        page.remove_listener("dialog", self._on_dialog)
+
+# Injected into every page and frame (see new_context): counts ASP.NET AJAX
+# postbacks through the PageRequestManager events, adds up the time from
+# each beginRequest to its endRequest (the SIH's share of a postback) and
+# flags documents that are being unloaded by a full postback or navigation.
+POSTBACK_HOOK_SCRIPT = """
+    (() => {
+        if (window.__hosixPostback) return;
+        const s = window.__hosixPostback = {
+            pending: 0, ended: 0, serverMs: 0, began: null, unloading: false, hooked: false };
+        window.addEventListener('beforeunload', () => { s.unloading = true; });
+        function hook() {
+            const prm = window.Sys && Sys.WebForms && Sys.WebForms.PageRequestManager
+                && Sys.WebForms.PageRequestManager.getInstance();
+            if (!prm || s.hooked) return;
+            s.hooked = true;
+            prm.add_beginRequest(() => { s.pending++; s.began = performance.now(); });
+            prm.add_endRequest(() => {
+                s.pending = Math.max(0, s.pending - 1);
+                s.ended++;
+                if (s.began !== null) s.serverMs += performance.now() - s.began;
+                s.began = null;
+            });
+        }
+        document.addEventListener('DOMContentLoaded', hook);
+        window.addEventListener('load', hook);
+    })();
+"""
+
+# Marks the current document of a frame and returns its postback counters
+POSTBACK_ARM_JS = """
+    () => {
+        window.__hosixArmed = true;
+        const s = window.__hosixPostback;
+        return { ended: s ? s.ended : 0, serverMs: s ? s.serverMs : 0 };
+    }
+"""
+
+POSTBACK_STATE_JS = """
+    () => {
+        const s = window.__hosixPostback;
+        const prm = window.Sys && Sys.WebForms && Sys.WebForms.PageRequestManager
+            && Sys.WebForms.PageRequestManager.getInstance();
+        return {
+            armed: window.__hosixArmed === true,
+            ended: s ? s.ended : 0,
+            serverMs: s ? s.serverMs : 0,
+            busy: document.readyState !== 'complete' || !!(s && (s.pending > 0 || s.unloading))
+                || !!(prm && prm.get_isInAsyncPostBack()),
+        };
+    }
+"""
+
+# True when a frame has no postback in flight and has finished loading
+FRAME_IDLE_JS = f"() => !({POSTBACK_STATE_JS.strip()})().busy"
+
+class Settled(Outcome):
+    """
+    No frame of the page has had a postback or load pending for grace_ms:
+    whatever the action triggers has arrived. Meant to be raced against the
+    optional outcomes above so that "nothing appeared" costs the real
+    postback latency instead of a timeout.
+    """
+
+    def __init__(self, grace_ms=None):
+        self.grace_ms = RACE_SETTLE_MS if grace_ms is None else grace_ms
+
+    def arm(self, page):
+        self.since = None
+
+    def poll(self, page):
+        try:
+            idle = all(frame.evaluate(FRAME_IDLE_JS) for frame in page.frames)
+        except Exception:
+            idle = False  # a frame is navigating
+        now = time.perf_counter()
+        if not idle:
+            self.since = None
+            return None
+        self.since = self.since or now
+        return True if (now - self.since) * 1000 >= self.grace_ms else None
+
+def wait_first(page, outcomes, timeout_ms, action=None, key=None):
+    """
+    Run action (if any) and wait until the first of outcomes ({name: Outcome})
+    happens. Outcomes are armed before the action, so events it fires are not
+    missed, and polled in insertion order. Returns (name, value), or
+    (None, None) after timeout_ms (0 = no limit).
+    """
+    for outcome in outcomes.values():
+        outcome.arm(page)
+    start = time.perf_counter()
+    try:
+        if action:
+            action()
+        while True:
+            for name, outcome in outcomes.items():
+                value = outcome.poll(page)
+                if value:
+                    notify("race", key or "/".join(outcomes), time.perf_counter() - start, outcome=name)
+                    return name, value
+            if timeout_ms and (time.perf_counter() - start) * 1000 >= timeout_ms:
+                notify("race", key or "/".join(outcomes), time.perf_counter() - start, outcome="timeout")
+                return None, None
+            page.wait_for_timeout(RACE_POLL_MS)  # also lets Playwright dispatch events
+    finally:
+        for outcome in outcomes.values():
+            outcome.disarm(page)
+
+def wait_postback(page, step, action=None, timeout_ms=POSTBACK_TIMEOUT_MS):
+    """
+    Run action and return as soon as the postback or navigation it triggered
+    has finished in every frame: endRequest for ASP.NET AJAX postbacks, a
+    loaded new document for full ones. Without an action, wait until every
+    frame is loaded and idle. Returns the outcome: "postback", "navigation",
+    "none" (nothing started within POSTBACK_START_MS), "idle" or "timeout"
+    (after which networkidle is awaited as before).
+
+    The "postback" notification times the whole wait, action included; for
+    AJAX postbacks it also carries server_s, the beginRequest-to-endRequest
+    time alone, which is what web.py's SIH load control judges.
+    """
+    armed = {}
+    if action:
+        for frame in page.frames:
+            try:
+                armed[frame] = frame.evaluate(POSTBACK_ARM_JS)
+            except Exception:
+                pass  # frame navigating; its next document counts as activity
+    start = time.perf_counter()
+    if action:
+        action()
+
+    while True:
+        busy, activity, server_ms = False, None, 0.0
+        for frame in page.frames:
+            try:
+                state = frame.evaluate(POSTBACK_STATE_JS)
+            except Exception:
+                busy = True  # execution context replaced by a navigation
+                continue
+            busy = busy or state["busy"]
+            if frame not in armed or not state["armed"]:
+                activity = "navigation"
+            elif state["ended"] > armed[frame]["ended"]:
+                activity = activity or "postback"
+                server_ms += state["serverMs"] - armed[frame]["serverMs"]
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if not busy and not action:
+            outcome = "idle"
+        elif not busy and activity:
+            outcome = activity
+        elif not busy and elapsed_ms >= POSTBACK_START_MS:
+            outcome = "none"
+        elif timeout_ms and elapsed_ms >= timeout_ms:
+            outcome = "timeout"
+        else:
+            page.wait_for_timeout(POSTBACK_POLL_MS)
+            continue
+        break
+
+    labels = {"server_s": server_ms / 1000} if outcome == "postback" else {}
+    notify("postback", step, time.perf_counter() - start, outcome=outcome, **labels)
+    if outcome == "timeout":
+        log(f"[WARNING] Postback for {step} not detected after {timeout_ms} ms, waiting for networkidle")
+        page.wait_for_load_state("networkidle")
+    elif POSTBACK_MEASURE_SAVINGS:
+        idle_start = time.perf_counter()
+        page.wait_for_load_state("networkidle")
+        notify("postback_saving", step, time.perf_counter() - idle_start, outcome=outcome)
+    return outcome
+
 def parse_ddmmyyyy_strict(s: str) -> date:
     """Parse 'dd/mm/yyyy' after removing whitespace."""
     s = re.sub(r"\s+", "", s)
@@ -113,7 +553,8 @@ def get_second_td_date(page) -> date:
     for frame in frames:
         try:
             td2 = frame.locator("#_ctl0_cph_tablaResultados > tbody > tr:nth-child(1) > td").nth(2)
-            td2.wait_for(state="visible", timeout=5000)
+            if not learned_wait(td2, "tablaResultados date", 5000):
+                continue
             raw = td2.text_content() or ""
             log(f"\n--- Found date in iframe: {raw} ---")
             return parse_ddmmyyyy_strict(raw)
@@ -123,7 +564,7 @@ def get_second_td_date(page) -> date:
     # Then try the original selector on page
     try:
         td2 = page.locator("#_ctl0_cph_tablaResultados > tbody > tr:nth-child(1) > td").nth(2)
-        td2.wait_for(state="visible", timeout=5000)
+        learned_wait(td2, "tablaResultados date", 5000, required=True)
         raw = td2.text_content() or ""
         log(f"\n--- Found date: {raw} ---")
         return parse_ddmmyyyy_strict(raw)
@@ -134,49 +575,36 @@ def get_second_td_date(page) -> date:
     raise Exception("Could not find date element in page or iframes")
 
 def click_row_with_wait(page, row_locator):
-    """
-    ASPX row click may do full postback navigation or partial update.
-    Try expect_navigation first; fallback to networkidle.
-    """
+    """ASPX row click may do full postback navigation or partial update; wait_postback handles both."""
     row_locator.scroll_into_view_if_needed()
-    try:
-        with page.expect_navigation(wait_until="networkidle", timeout=8000):
-            row_locator.click()
-    except PlaywrightTimeoutError:
-        row_locator.click()
-        page.wait_for_load_state("networkidle")
+    wait_postback(page, "row", action=row_locator.click)
 
 def safe_click(page, selector: str):
-    """Click element, wait indefinitely for it to appear."""
-    if DEFAULT_TIMEOUT_MS > 0:
-        page.wait_for_selector(selector, timeout=DEFAULT_TIMEOUT_MS)
-    else:
-        page.wait_for_selector(selector)
+    """Click element, wait for it to appear (indefinitely until a timeout is learned)."""
+    learned_wait(page.locator(selector).first, selector, DEFAULT_TIMEOUT_MS, required=True)
     page.click(selector)
 
 def try_click(page, selector: str, timeout_ms: int = None):
-    """Try to click element, skip if not found within timeout."""
-    try:
-        timeout = timeout_ms or SOFT_TIMEOUT_MS
-        page.wait_for_selector(selector, timeout=timeout)
-        page.click(selector)
-        return True
-    except PlaywrightTimeoutError:
+    """Try to click element, skip if not found within timeout (or its learned one)."""
+    if not learned_wait(page.locator(selector).first, selector, timeout_ms or SOFT_TIMEOUT_MS):
         log(f"[INFO] Element {selector} not found, continuing...")
         return False
+    page.click(selector)
+    return True
 
 def safe_click_in_iframe(page, selector: str):
     """Click element inside an iframe within #panelDatos-body"""
     try:
         # Wait for the container
-        page.wait_for_selector("#panelDatos-body", timeout=DEFAULT_TIMEOUT_MS)
+        learned_wait(page.locator("#panelDatos-body").first, "#panelDatos-body", DEFAULT_TIMEOUT_MS, required=True)
         
         # Get all frames and search for the selector
         frames = page.frames
         for frame in frames:
             try:
                 # Try to find and click in this frame
-                frame.wait_for_selector(selector, timeout=5000)
+                if not learned_wait(frame.locator(selector).first, f"frame {selector}", 5000):
+                    continue
                 frame.click(selector)
                 log(f"[DEBUG] Clicked button in frame")
                 return
@@ -194,80 +622,48 @@ def safe_click_in_iframe(page, selector: str):
         except Exception as e2:
             log(f"[DEBUG] Direct click also failed: {e2}")
 
+def wait_in_iframe(page, selector: str, frame_id: str, default_ms=DEFAULT_TIMEOUT_MS, required=True):
+    """Wait for the iframe, then for selector inside it; return its locator (None if optional and absent)."""
+    if not learned_wait(page.locator(f"#{frame_id}").first, f"#{frame_id}", default_ms, required):
+        return None
+    element = page.frame_locator(f"#{frame_id}").locator(selector).first
+    if not learned_wait(element, f"#{frame_id} {selector}", default_ms, required):
+        return None
+    return element
+
 def safe_click_in_iframe_by_id(page, selector: str, frame_id: str):
-    """Click element inside a specific iframe by id. Waits indefinitely."""
-    if DEFAULT_TIMEOUT_MS > 0:
-        page.wait_for_selector(f"#{frame_id}", timeout=DEFAULT_TIMEOUT_MS)
-    else:
-        page.wait_for_selector(f"#{frame_id}")
-    frame = page.frame_locator(f"#{frame_id}")
-    if DEFAULT_TIMEOUT_MS > 0:
-        frame.locator(selector).wait_for(state="visible", timeout=DEFAULT_TIMEOUT_MS)
-    else:
-        frame.locator(selector).wait_for(state="visible")
-    frame.locator(selector).click()
+    """Click element inside a specific iframe by id. Waits indefinitely until a timeout is learned."""
+    wait_in_iframe(page, selector, frame_id).click()
 
 def try_click_in_iframe_by_id(page, selector: str, frame_id: str, timeout_ms: int = None):
     """Try to click element in iframe, skip if not found."""
-    try:
-        timeout = timeout_ms or SOFT_TIMEOUT_MS
-        page.wait_for_selector(f"#{frame_id}", timeout=timeout)
-        frame = page.frame_locator(f"#{frame_id}")
-        frame.locator(selector).wait_for(state="visible", timeout=timeout)
-        frame.locator(selector).click()
-        return True
-    except PlaywrightTimeoutError:
+    element = wait_in_iframe(page, selector, frame_id, timeout_ms or SOFT_TIMEOUT_MS, required=False)
+    if element is None:
         log(f"[INFO] Element {selector} in iframe not found, continuing...")
         return False
+    element.click()
+    return True
 
-def safe_click_with_nav(page, selector: str):
-    """Click and expect navigation"""
-    page.wait_for_selector(selector, timeout=DEFAULT_TIMEOUT_MS)
-    try:
-        with page.expect_navigation(wait_until="networkidle", timeout=0):
-            page.click(selector)
-    except PlaywrightTimeoutError:
-        pass
+def safe_click_with_nav(page, selector: str, step: str = "navigation"):
+    """Click and wait for the navigation (or postback) it triggers"""
+    learned_wait(page.locator(selector).first, selector, DEFAULT_TIMEOUT_MS, required=True)
+    wait_postback(page, step, action=lambda: page.click(selector))
 
 def safe_check(page, selector: str):
-    if DEFAULT_TIMEOUT_MS > 0:
-        page.wait_for_selector(selector, timeout=DEFAULT_TIMEOUT_MS)
-    else:
-        page.wait_for_selector(selector)
+    learned_wait(page.locator(selector).first, selector, DEFAULT_TIMEOUT_MS, required=True)
     page.locator(selector).check()
 
 def safe_check_in_iframe(page, selector: str, frame_id: str):
     """Check element inside a specific iframe by id."""
-    if DEFAULT_TIMEOUT_MS > 0:
-        page.wait_for_selector(f"#{frame_id}", timeout=DEFAULT_TIMEOUT_MS)
-    else:
-        page.wait_for_selector(f"#{frame_id}")
-    frame = page.frame_locator(f"#{frame_id}")
-    if DEFAULT_TIMEOUT_MS > 0:
-        frame.locator(selector).wait_for(state="visible", timeout=DEFAULT_TIMEOUT_MS)
-    else:
-        frame.locator(selector).wait_for(state="visible")
-    frame.locator(selector).check()
+    wait_in_iframe(page, selector, frame_id).check()
 
 def safe_fill(page, selector: str, value: str):
-    if DEFAULT_TIMEOUT_MS > 0:
-        page.wait_for_selector(selector, timeout=DEFAULT_TIMEOUT_MS)
-    else:
-        page.wait_for_selector(selector)
+    learned_wait(page.locator(selector).first, selector, DEFAULT_TIMEOUT_MS, required=True)
     page.fill(selector, value)
 
 def safe_fill_in_iframe(page, selector: str, value: str, frame_id: str):
     """Fill input inside a specific iframe by id."""
-    if DEFAULT_TIMEOUT_MS > 0:
-        page.wait_for_selector(f"#{frame_id}", timeout=DEFAULT_TIMEOUT_MS)
-    else:
-        page.wait_for_selector(f"#{frame_id}")
-    frame = page.frame_locator(f"#{frame_id}")
-    if DEFAULT_TIMEOUT_MS > 0:
-        frame.locator(selector).wait_for(state="visible", timeout=DEFAULT_TIMEOUT_MS)
-    else:
-        frame.locator(selector).wait_for(state="visible")
-    frame.locator(selector).fill(value)
+    wait_in_iframe(page, selector, frame_id).fill(value)
 
 def press_ctrl_p(page):
     """Send Ctrl+P keyboard shortcut to trigger print dialog."""
@@ -289,7 +685,8 @@ def enter_opens_popup_and_print(page):
         page.keyboard.press("Enter")
         print_page = page
 
-    print_page.wait_for_load_state("networkidle")
+    print_page.wait_for_load_state("load")  # a popup starts on about:blank
+    wait_postback(print_page, "print_popup")
 
     press_ctrl_p(print_page)
 
@@ -305,6 +702,269 @@ def enter_opens_popup_and_print(page):
         except Exception:
             pass
 
+def launch_browser(p, kiosk_printing=False, tag=None):
+    """
+    Launch Chromium with the configured privacy mode and launch profile.
+    tag is added as --hosix-tag=<tag> so callers can account for the process tree.
+    """
+    launch_args = []
+    if kiosk_printing and USE_KIOSK_PRINTING:
+        launch_args.append("--kiosk-printing")
+    if USE_PRIVATE_MODE:
+        launch_args.append("--incognito")
+    if HEADLESS and LAUNCH_PROFILE == "lean":
+        launch_args.extend(LEAN_CHROMIUM_ARGS)
+    if tag:
+        launch_args.append(f"{BROWSER_TAG_ARG}{tag}")
+    return p.chromium.launch(headless=HEADLESS, args=launch_args)
+
+# Injected into every page and frame of booking contexts: hides the ExtJS
+# modals/overlays that otherwise intercept clicks.
+OVERLAY_HIDE_SCRIPT = """
+    (() => {
+        const CSS = '.x-window-closable, .x-mask, .x-css-shadow { display: none!important }';
+        const STYLE_ID = 'hosix-overlay-hide';
+        const mo = new MutationObserver(function(mutations) {
+            for (const m of mutations) {
+                for (const node of m.removedNodes) {
+                    if (node.id === STYLE_ID) { injectStyle(); return; }
+                }
+            }
+        });
+        function injectStyle() {
+            if (!document.getElementById(STYLE_ID)) {
+                const s = document.createElement('style');
+                s.id = STYLE_ID;
+                s.textContent = CSS;
+                const container = document.head || document.documentElement;
+                container.appendChild(s);
+                mo.observe(container, { childList: true });
+            }
+        }
+        injectStyle();
+        // Re-inject after ASP.NET AJAX partial postbacks (UpdatePanel)
+        document.addEventListener('DOMContentLoaded', function() {
+            if (window.Sys && Sys.WebForms && Sys.WebForms.PageRequestManager) {
+                Sys.WebForms.PageRequestManager.getInstance().add_endRequest(injectStyle);
+            }
+        });
+    })();
+"""
+
+class AssetCache:
+    """
+    Serves static SIH assets to new contexts from disk. Only GET requests for
+    the WebResource/ScriptResource handlers and for ASSET_CACHE_EXTENSIONS
+    files under ASSET_CACHE_STATIC_PATHS are routed here; pages (.aspx),
+    other handlers, services and postbacks never are. Only complete 200
+    responses without cookies, Vary, no-store, no-cache or private are
+    stored, keyed by URL. An entry is served for the freshness its response
+    gave (max-age, else Expires; at most ASSET_CACHE_FRESH_S), then
+    revalidated with its ETag/Last-Modified. Every request is
+    notified as kind "asset_cache" (hit, revalidated, miss, bypass) with the
+    bytes served from disk. Job processes share the directory; writes are
+    atomic, the size limit is approximate.
+    """
+
+    _DROPPED_HEADERS = ("content-encoding", "content-length", "transfer-encoding", "date", "connection")
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def attach(self, context):
+        context.route(self._matches, self._handle)
+
+    @staticmethod
+    def _matches(url):
+        path = urllib.parse.urlsplit(url).path.lower()
+        if path.endswith(".axd"):
+            return path.rsplit("/", 1)[-1] in ASSET_CACHE_AXD_HANDLERS
+        return path.endswith(ASSET_CACHE_EXTENSIONS) and any(p in path for p in ASSET_CACHE_STATIC_PATHS)
+
+    @staticmethod
+    def _directives(headers):
+        directives = {}
+        for part in headers.get("cache-control", "").lower().split(","):
+            name, _, value = part.strip().partition("=")
+            if name:
+                directives[name] = value.strip('"')
+        return directives
+
+    @classmethod
+    def _lifetime(cls, headers):
+        """Seconds a response may be served without revalidation: max-age, else Expires - Date."""
+        directives = cls._directives(headers)
+        if "max-age" in directives:
+            try:
+                seconds = int(directives["max-age"])
+            except ValueError:
+                seconds = 0
+        elif headers.get("expires"):
+            try:
+                expires = email.utils.parsedate_to_datetime(headers["expires"]).timestamp()
+                now = email.utils.parsedate_to_datetime(headers["date"]).timestamp() if headers.get("date") else time.time()
+                seconds = expires - now
+            except (TypeError, ValueError):
+                seconds = 0  # "Expires: -1" and the like: already stale
+        else:
+            seconds = 0
+        return max(0, min(seconds, ASSET_CACHE_FRESH_S))
+
+    def _files(self, url):
+        key = os.path.join(self.path, hashlib.sha1(url.encode("utf-8")).hexdigest())
+        return key + ".json", key + ".body"
+
+    def _load(self, url):
+        meta_file, body_file = self._files(url)
+        try:
+            with open(meta_file, "r", encoding="utf-8") as fh:
+                meta = json.load(fh)
+            with open(body_file, "rb") as fh:
+                body = fh.read()
+        except (OSError, ValueError):
+            return None, None
+        if meta.get("url") != url or meta.get("size") != len(body):
+            return None, None  # hash collision or a write cut short
+        return meta, body
+
+    @classmethod
+    def _storable(cls, response, body):
+        headers = response.headers
+        directives = cls._directives(headers)
+        return (response.status == 200 and "set-cookie" not in headers
+                and not {"no-store", "no-cache", "private"} & set(directives)
+                and headers.get("vary", "accept-encoding").lower() in ("accept-encoding", "")
+                and len(body) <= ASSET_CACHE_MAX_ENTRY_MB * 2**20
+                # worth keeping only if it can be served fresh or revalidated
+                and (cls._lifetime(headers) > 0 or "etag" in headers or "last-modified" in headers))
+
+    def _write(self, file, data):
+        tmp = f"{file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp, file)
+
+    def _store(self, url, response, body):
+        headers = {k: v for k, v in response.headers.items() if k.lower() not in self._DROPPED_HEADERS}
+        meta = {"url": url, "headers": headers, "size": len(body), "stored_at": time.time(),
+                "fresh_s": self._lifetime(response.headers),
+                "etag": response.headers.get("etag"), "last_modified": response.headers.get("last-modified")}
+        meta_file, body_file = self._files(url)
+        try:
+            self._write(body_file, body)
+            self._write(meta_file, json.dumps(meta).encode("utf-8"))
+        except OSError as e:
+            log(f"[WARNING] Could not cache {url}: {e}")
+            return
+        self._prune()
+
+    def _refresh(self, url, meta, response):
+        meta["stored_at"] = time.time()
+        if "cache-control" in response.headers or "expires" in response.headers:
+            meta["fresh_s"] = self._lifetime(response.headers)
+        try:
+            self._write(self._files(url)[0], json.dumps(meta).encode("utf-8"))
+        except OSError:
+            pass
+
+    def _prune(self):
+        """Delete the least recently used entries once the directory is over ASSET_CACHE_MAX_MB."""
+        try:
+            entries = [e for e in os.scandir(self.path) if e.name.endswith(".body")]
+            stats = [(e.stat().st_mtime, e.stat().st_size, e.path) for e in entries]
+        except OSError:
+            return
+        total = sum(size for _, size, _ in stats)
+        for _, size, body_file in sorted(stats):
+            if total <= ASSET_CACHE_MAX_MB * 2**20:
+                break
+            for file in (body_file, body_file[:-len(".body")] + ".json"):
+                try:
+                    os.remove(file)
+                except OSError:
+                    pass
+            total -= size
+
+    def _serve(self, route, url, meta, body, outcome):
+        try:
+            os.utime(self._files(url)[1])  # recently used, for _prune
+        except OSError:
+            pass
+        route.fulfill(status=200, headers=meta["headers"], body=body)
+        notify("asset_cache", outcome, len(body))
+
+    def _handle(self, route):
+        request = route.request
+        url = request.url.split("#")[0]
+        if request.method != "GET":
+            notify("asset_cache", "bypass", 0)
+            route.fallback()
+            return
+        meta, body = self._load(url)
+        try:
+            if meta is not None and time.time() - meta["stored_at"] < meta.get("fresh_s", 0):
+                self._serve(route, url, meta, body, "hit")
+                return
+            headers = dict(request.headers)
+            if meta is not None and meta.get("etag"):
+                headers["if-none-match"] = meta["etag"]
+            if meta is not None and meta.get("last_modified"):
+                headers["if-modified-since"] = meta["last_modified"]
+            response = route.fetch(headers=headers)
+            if meta is not None and response.status == 304:
+                self._refresh(url, meta, response)
+                self._serve(route, url, meta, body, "revalidated")
+                return
+            fresh = response.body()
+            if self._storable(response, fresh):
+                self._store(url, response, fresh)
+            route.fulfill(response=response, body=fresh)
+            notify("asset_cache", "miss", 0)
+        except Exception as e:
+            # Let the browser load it itself (also reports network errors as usual)
+            log(f"[WARNING] Asset cache skipped for {url}: {e}")
+            try:
+                route.fallback()
+            except Exception:
+                pass
+
+_asset_cache = None
+
+def asset_cache():
+    """The AssetCache of this process, created on first use."""
+    global _asset_cache
+    if _asset_cache is None:
+        _asset_cache = AssetCache(ASSET_CACHE_DIR)
+    return _asset_cache
+
+def new_context(browser):
+    """
+    Create a browser context with CONTEXT_OPTIONS, the postback hooks, the
+    static asset cache and CONTEXT_HOOKS (routes added by hooks take
+    precedence over the cache's).
+    """
+    context = browser.new_context(ignore_https_errors=True, **CONTEXT_OPTIONS)
+    context.add_init_script(POSTBACK_HOOK_SCRIPT)
+    if ASSET_CACHE_ENABLED:
+        asset_cache().attach(context)
+    for hook in CONTEXT_HOOKS:
+        hook(context)
+    return context
+
+def close_browser(browser):
+    """Close the browser on every exit path; it may already be gone after a crash."""
+    # Closing contexts first flushes recordings such as HAR files
+    for context in list(browser.contexts):
+        try:
+            context.close()
+        except Exception as e:
+            log(f"[WARNING] Failed to close context: {e}")
+    try:
+        browser.close()
+    except Exception as e:
+        log(f"[WARNING] Failed to close browser: {e}")
+
 def compute_booking_plan(selected_items):
     """Group selected items by booking code and return ordered list of (code, checkboxes) tuples."""
     code_to_checkboxes = {}
@@ -324,8 +984,8 @@ def handle_print_popup(print_page):
     """Handle the print popup window."""
     log(f"[INFO] Popup URL: {print_page.url}")
     print_page.bring_to_front()
-    print_page.wait_for_load_state("networkidle")
-    print_page.wait_for_load_state("load")
+    print_page.wait_for_load_state("load")  # a popup starts on about:blank
+    wait_postback(print_page, "print_popup")
     print_page.wait_for_timeout(3000)
 
     log("[INFO] Triggering print dialog via JavaScript...")
@@ -343,62 +1003,62 @@ def handle_print_popup(print_page):
         log("[INFO] Print dialog should be open. Waiting for user to print...")
         print_page.wait_for_timeout(30000)
 
-def perform_booking(page, context, code, checkboxes, selected_date_08):
-    """Perform a single booking with the given code and checkboxes."""
-    log(f"[INFO] Starting booking ({code})...")
-
-    safe_fill(page, TXT_CONSULTA, code)
-    page.keyboard.press("Enter")
-    time.sleep(2)
-    safe_fill(page, TXT_OBS, "     ")
-    page.keyboard.press("Enter")
-    safe_click(page, CMD_HORAS)
-    page.wait_for_load_state("networkidle")
+def close_tool_window(page):
+    """Click the tool button if the IPP postback brought one; skip once the page has settled without it."""
+    outcome, tool = wait_first(page, {"tool": Visible(BTN_TOOL_1031), "settled": Settled()}, 3000,
+                               key=BTN_TOOL_1031)
+    if outcome != "tool":
+        log(f"[INFO] Element {BTN_TOOL_1031} not found, continuing...")
+        return False
+    tool.click()
+    return True
 
-    # Check all checkboxes in iframe
-    for chk in checkboxes:
-        safe_check_in_iframe(page, chk, "VentanaModal_1_ifrm")
+def add_appointments(page, checkboxes, dates_08):
+    """In the open modal: one extra appointment per date-time of dates_08 with checkboxes ticked."""
+    for date_08 in dates_08:
+        # Check all checkboxes in iframe (again after each add: cheap if still checked)
+        for chk in checkboxes:
+            safe_check_in_iframe(page, chk, "VentanaModal_1_ifrm")
 
-    # Fill date
-    log(f"[INFO] Setting date: {selected_date_08}")
-    safe_fill_in_iframe(page, TXT_FECHA_EXTRA, selected_date_08, "VentanaModal_1_ifrm")
+        # Fill date
+        log(f"[INFO] Setting date: {date_08}")
+        safe_fill_in_iframe(page, TXT_FECHA_EXTRA, date_08, "VentanaModal_1_ifrm")
 
-    # Add cita extra
-    safe_click_in_iframe_by_id(page, BTN_ADD_CITA_EXTRA, "VentanaModal_1_ifrm")
-    page.wait_for_load_state("networkidle")
+        # Add cita extra
+        wait_postback(page, "add_cita_extra",
+                      action=lambda: safe_click_in_iframe_by_id(page, BTN_ADD_CITA_EXTRA, "VentanaModal_1_ifrm"))
 
-    # Zoom out
+def zoom_out(page):
     log("[INFO] Zooming out...")
     page.keyboard.down("Control")
     page.keyboard.press("Minus")
     page.keyboard.up("Control")
     page.wait_for_timeout(500)
 
-    # Dialog handler
-    def handle_dialog(dialog):
-        try:
-            log(f"[INFO] Alert detected: {dialog.message}")
-            dialog.accept()
-        except Exception as e:
-            log(f"[WARNING] Failed to accept dialog: {e}")
-
-    page.once("dialog", handle_dialog)
-
-    # Apply and handle print popup
-    print_page = None
-    try:
-        with page.expect_popup(timeout=10000) as popup_info:
-            safe_click_in_iframe_by_id(page, BTN_APLICAR, "VentanaModal_1_ifrm")
-        print_page = popup_info.value
-        handle_print_popup(print_page)
-    except PlaywrightTimeoutError:
+def apply_booking(page, context, code):
+    """
+    Click Aplicar in the modal and print the ticket popup it opens. Alerts
+    are answered by the accept_dialog handler book_codes() keeps registered.
+    """
+    # The print popup, an alert, or a settled page with neither, whichever comes first
+    outcome, value = wait_first(
+        page, {"popup": Popup(), "dialog": Dialog(accept=None), "settled": Settled()}, 10000,
+        action=lambda: safe_click_in_iframe_by_id(page, BTN_APLICAR, "VentanaModal_1_ifrm"),
+        key="aplicar")
+    if outcome == "dialog":
+        # The answered alert lets the postback finish; the popup may still follow
+        outcome, value = wait_first(page, {"popup": Popup(), "settled": Settled()}, 10000, key="aplicar")
+
+    print_page = value if outcome == "popup" else None
+    if not print_page:
         log(f"[WARNING] No popup detected for {code} booking. Checking for new pages...")
         pages = context.pages
         if len(pages) > 1:
             print_page = pages[-1]
-            handle_print_popup(print_page)
         else:
             log("[WARNING] No new page found")
+    if print_page:
+        handle_print_popup(print_page)
 
     # Cleanup
     if print_page:
@@ -409,10 +1069,97 @@ def perform_booking(page, context, code, checkboxes, selected_date_08):
 
     page.bring_to_front()
     page.wait_for_timeout(1000)
-    safe_click_in_iframe_by_id(page, BTN_CERRAR, "VentanaModal_1_ifrm")
-    page.wait_for_load_state("networkidle")
 
-    log(f"[INFO] Booking ({code}) completed.")
+def close_booking_modal(page):
+    wait_postback(page, "cerrar", action=lambda: safe_click_in_iframe_by_id(page, BTN_CERRAR, "VentanaModal_1_ifrm"))
+
+def perform_booking(page, context, code, checkboxes, dates_08):
+    """
+    Perform a single booking with the given code and checkboxes, with one
+    extra appointment per date-time of dates_08 (a string is one date-time)
+    added in the same modal before a single Aplicar.
+    """
+    if isinstance(dates_08, str):
+        dates_08 = [dates_08]
+    with timed_step("booking", code=code):
+        log(f"[INFO] Starting booking ({code})...")
+
+        safe_fill(page, TXT_CONSULTA, code)
+        page.keyboard.press("Enter")
+        time.sleep(2)
+        safe_fill(page, TXT_OBS, "     ")
+        page.keyboard.press("Enter")
+        wait_postback(page, "horas", action=lambda: safe_click(page, CMD_HORAS))
+
+        add_appointments(page, checkboxes, dates_08)
+        zoom_out(page)
+        apply_booking(page, context, code)
+        close_booking_modal(page)
+
+        log(f"[INFO] Booking ({code}) completed.")
+
+def open_booking_modal(page, code, modal_open):
+    """
+    Reuse path: select code on the patient's booking page and (re)load the
+    modal with CMD_HORAS, in place when it is still open from the previous
+    code. Raises when the SIH does not go along; nothing is booked by then.
+    """
+    t0 = time.perf_counter()
+    page.fill(TXT_CONSULTA, code, timeout=MODAL_REUSE_TIMEOUT_MS)
+    if wait_postback(page, "consulta", action=lambda: page.keyboard.press("Enter")) == "none":
+        time.sleep(max(0.0, 2 - (time.perf_counter() - t0)))  # no postback to wait for: the classic delay
+    if page.input_value(TXT_OBS, timeout=MODAL_REUSE_TIMEOUT_MS) != "     ":
+        page.fill(TXT_OBS, "     ", timeout=MODAL_REUSE_TIMEOUT_MS)
+    page.keyboard.press("Enter")
+
+    outcome = wait_postback(page, "horas", action=lambda: page.click(CMD_HORAS, timeout=MODAL_REUSE_TIMEOUT_MS))
+    if modal_open and outcome == "none":
+        raise RuntimeError("CMD_HORAS did not reload the open modal")
+    if wait_in_iframe(page, TXT_FECHA_EXTRA, "VentanaModal_1_ifrm", MODAL_REUSE_TIMEOUT_MS, required=False) is None:
+        raise RuntimeError("booking modal not shown")
+
+def book_codes(page, context, ipp, dates_08, booking_plan, control):
+    """
+    Book the codes of one IPP. With REUSE_BOOKING_MODAL the modal opened for
+    the first code stays open: each next code is selected and the modal
+    reloaded in place, and it is closed once at the end. When the SIH does
+    not allow it, the modal is closed and the remaining codes (this one
+    included) go through the classic perform_booking().
+    """
+    # Alerts may follow Aplicar (after the raced one) or Cerrar: accept them
+    # until the modal is closed, or Playwright dismisses them
+    page.on("dialog", accept_dialog)
+    try:
+        reuse, modal_open = REUSE_BOOKING_MODAL, False
+        for code, checkboxes in booking_plan:
+            control.checkpoint()
+            control.booking_started(ipp, code)
+            if reuse:
+                try:
+                    with timed_step("booking_open", code=code):
+                        open_booking_modal(page, code, modal_open)
+                except Exception as e:
+                    log(f"[WARNING] Booking modal not reusable for {code} ({e}), using the classic path")
+                    reuse = False
+                    if page.locator("#VentanaModal_1_ifrm").count():
+                        wait_postback(page, "cerrar", action=lambda: try_click_in_iframe_by_id(
+                            page, BTN_CERRAR, "VentanaModal_1_ifrm", MODAL_REUSE_TIMEOUT_MS))
+                    modal_open = False
+            if reuse:
+                with timed_step("booking", code=code, path="reuse"):
+                    if not modal_open:
+                        zoom_out(page)
+                    modal_open = True
+                    add_appointments(page, checkboxes, dates_08)
+                    apply_booking(page, context, code)
+                    log(f"[INFO] Booking ({code}) completed.")
+            else:
+                perform_booking(page, context, code, checkboxes, dates_08)
+            control.booking_done(ipp, code)
+        if modal_open:
+            close_booking_modal(page)
+    finally:
+        page.remove_listener("dialog", accept_dialog)
 
 
 # =========================
@@ -422,157 +1169,340 @@ PATIENTS_LOGIN_URL = "https://sih/login.aspx?ReturnUrl=%2fApps%2fmed%2fdefault.a
 PATIENT_HISTORY_URL = "https://sih/Apps/adm/Historias/historialPaciente.aspx"
 HISTORY_IPP_INPUT = "#_ctl0_cph_UcHistoria1_1"
 HISTORY_TABLE_BODY = "#_ctl0_cph_GrdHistorial-body"
+HISTORY_WINDOW_DAYS = 7  # days of history kept per patient by fetch_bilan_matrix()
+HISTORY_BATCH_SIZE = 5   # in-page history postbacks per call (see HISTORY_BATCH_JS); 0 = navigate per patient
+HISTORY_LOOKUP_TIMEOUT_MS = 15000  # per in-page lookup, until its grid store is readable
+
+# (date cell, activity cell) of every history row; the activity cell ends with "(CODE)"
+HISTORY_ROWS_JS = """
+    () => {
+        const tbody = document.querySelector('#_ctl0_cph_GrdHistorial-body tbody');
+        if (!tbody) return [];
+        const rows = [];
+        for (const row of tbody.querySelectorAll('tr')) {
+            const tds = row.querySelectorAll('td');
+            if (tds.length >= 5) rows.push([tds[1].textContent.trim(), tds[4].textContent.trim()]);
+        }
+        return rows;
+    }
+"""
+_HISTORY_CODE_RE = re.compile(r"\(([^()]+)\)")
+
+# Sends the IPP field's postback for each IPP in turn from the loaded history
+# page, as the page's own partial (UpdatePanel) postback: one XHR carrying the
+# current ViewState, whose delta response the PageRequestManager applies in
+# place (no page load, no ExtJS start-up). The grid has no data endpoint of
+# its own: its store is filled by the scripts of that delta, so the rows are
+# read from the store (date and activity columns, through their renderers).
+# One at a time: the ASP.NET session serves a page's requests in turn anyway.
+# Pages whose IPP field does a full postback get no results (navigate instead).
+HISTORY_BATCH_JS = """
+    async ({ ipps, input, timeout }) => {
+        const field = document.querySelector(input);
+        const prm = window.Sys && Sys.WebForms && Sys.WebForms.PageRequestManager
+            && Sys.WebForms.PageRequestManager.getInstance();
+        if (!field || !prm || !window.__doPostBack || !prm._getPostBackSettings(field, field.name).async) {
+            return ipps.map(ipp => ({ ipp, ok: false, found: false, rows: [], ms: 0,
+                                      error: 'IPP field does not do partial postbacks' }));
+        }
+        const text = (value) => {
+            const div = document.createElement('div');
+            div.innerHTML = value == null ? '' : String(value);
+            return div.textContent.trim();
+        };
+        const historyGrid = () => window.Ext && Ext.getCmp && Ext.getCmp('_ctl0_cph_GrdHistorial');
+        // The previous patient's store stays stale until the postback replaces or reloads it
+        const markStale = () => {
+            const grid = historyGrid();
+            const store = grid && grid.getStore();
+            if (!store) return;
+            store.__hosixStale = true;
+            const fresh = () => { store.__hosixStale = false; };
+            store.on({ datachanged: fresh, load: fresh, single: true });
+        };
+        const readGrid = () => {
+            const grid = historyGrid();
+            if (!grid) return null;
+            const store = grid.getStore();
+            if (!store || store.__hosixStale || (store.isLoading && store.isLoading())) return null;
+            const columns = grid.headerCt ? grid.headerCt.getGridColumns() : grid.columns;
+            if (!columns || columns.length < 5) return [];
+            const cell = (col, rec, i) => {
+                let value = rec.get(col.dataIndex);
+                if (typeof col.renderer === 'function') {
+                    value = col.renderer.call(col.scope || col, value, {}, rec, i, columns.indexOf(col), store, grid.getView());
+                } else if (value instanceof Date) {
+                    value = Ext.Date.format(value, 'd/m/Y H:i');
+                }
+                return text(value);
+            };
+            return store.getRange().map((rec, i) => [cell(columns[1], rec, i), cell(columns[4], rec, i)]);
+        };
+        const postback = (ipp) => new Promise((resolve, reject) => {
+            const timer = setTimeout(() => {
+                prm.remove_endRequest(ended);
+                prm.abortPostBack();
+                reject(new Error('postback timed out'));
+            }, timeout);
+            function ended(sender, args) {
+                prm.remove_endRequest(ended);
+                clearTimeout(timer);
+                const error = args.get_error();
+                if (error) {
+                    args.set_errorHandled(true);
+                    reject(error);
+                } else {
+                    resolve();
+                }
+            }
+            prm.add_endRequest(ended);
+            field.value = ipp;
+            window.__doPostBack(field.name, '');
+        });
+        const gridRows = async (deadline) => {
+            for (;;) {
+                const rows = readGrid();
+                if (rows || performance.now() > deadline) return rows;
+                await new Promise(r => setTimeout(r, 50));
+            }
+        };
+        const results = [];
+        for (const ipp of ipps) {
+            const t0 = performance.now();
+            try {
+                markStale();
+                await postback(ipp);
+                const rows = await gridRows(t0 + timeout);
+                results.push({ ipp, ok: true, found: !!rows, rows: rows || [], ms: performance.now() - t0 });
+            } catch (e) {
+                results.push({ ipp, ok: false, found: false, rows: [], error: String(e.message || e),
+                               ms: performance.now() - t0 });
+            }
+        }
+        return results;
+    }
+"""
+
+
+def history_matrix(rows, window_start):
+    """
+    Reduce history rows to {code: [dates, newest first]} for dates on or
+    after window_start. Rows whose date cannot be parsed are ignored.
+    """
+    matrix = {}
+    for date_text, activity in rows:
+        try:
+            row_date = datetime.strptime(date_text.split()[0], "%d/%m/%Y").date()  # "04/03/2026 8:33"
+        except (ValueError, IndexError):
+            continue
+        if row_date < window_start:
+            continue
+        for code in _HISTORY_CODE_RE.findall(activity):
+            dates = matrix.setdefault(code.strip(), [])
+            if row_date not in dates:
+                dates.append(row_date)
+    for dates in matrix.values():
+        dates.sort(reverse=True)
+    return matrix
 
 
-def fetch_patients_without_bilans(username, password, filter_option, booking_codes=None):
+def bilan_status(matrix_entry, booking_codes, target_date):
     """
-    Fetch all patients from SIH and determine which ones already have bilans
-    for the specified period.
-
-    filter_option: "today" or "yesterday"
-    booking_codes: list of booking codes to check (e.g. ['CYTO', 'BES']).
-                   Defaults to ['CYTO'] if not provided.
-    Returns: list of dicts {"ip": str, "name": str, "has_bilan": bool}
+    Per-code status of one fetch_bilan_matrix() entry for target_date:
+    {"has_bilan": bool, "codes": {code: {"has_bilan": bool, "last": "dd/mm/yyyy" | None}}}.
     """
+    codes = {}
+    for code in booking_codes:
+        dates = matrix_entry["dates"].get(code, [])
+        codes[code] = {
+            "has_bilan": target_date in dates,
+            "last": dates[0].strftime("%d/%m/%Y") if dates else None,
+        }
+    return {"has_bilan": any(c["has_bilan"] for c in codes.values()), "codes": codes}
+
+
+def bilan_target_date(filter_option):
+    """The day whose bilans count for filter_option ("today" or "yesterday")."""
     if filter_option == "today":
-        target_date = date.today()
-    elif filter_option == "yesterday":
-        target_date = date.today() - timedelta(days=1)
-    else:
-        raise ValueError(f"Invalid filter option: {filter_option}")
+        return date.today()
+    if filter_option == "yesterday":
+        return date.today() - timedelta(days=1)
+    raise ValueError(f"Invalid filter option: {filter_option}")
 
-    if not booking_codes:
-        booking_codes = ["CYTO"]
 
-    with sync_playwright() as p:
-        launch_args = ["--incognito"] if USE_PRIVATE_MODE else []
-        browser = p.chromium.launch(headless=HEADLESS, args=launch_args)
-        context = browser.new_context(ignore_https_errors=True)
-        page = context.new_page()
-        page.set_default_timeout(60000)
-
-        try:
-            # Auto-accept any JS alert dialogs that may appear
-            def handle_dialog(dialog):
-                try:
-                    log(f"[INFO] Alert detected: {dialog.message}")
-                    dialog.accept()
-                except Exception as e:
-                    log(f"[WARNING] Failed to accept dialog: {e}")
+def accept_dialog(dialog):
+    """page.on("dialog") handler: accept JS alerts so they never block a page."""
+    try:
+        log(f"[INFO] Alert detected: {dialog.message}")
+        dialog.accept()
+    except Exception as e:
+        log(f"[WARNING] Failed to accept dialog: {e}")
 
-            page.on("dialog", handle_dialog)
 
-            # Login
-            page.goto(PATIENTS_LOGIN_URL, timeout=60000)
-            page.wait_for_selector('input[name="txtUsername"]', timeout=60000)
-            page.fill('input[name="txtUsername"]', username)
-            page.fill('input[name="txtPassword"]', password)
-            page.click("#cmdLogin")
-            page.wait_for_load_state("networkidle")
-
-            # Wait for episodes table
-            page.wait_for_selector("#GrdEpisodios-body", timeout=60000)
-
-            # Get all patients from the table (ip from 2nd td, name from 5th td)
-            all_patients = page.evaluate("""
-                () => {
-                    const tbody = document.querySelector('#GrdEpisodios-body tbody');
-                    if (!tbody) return [];
-                    const rows = tbody.querySelectorAll('tr');
-                    const patients = [];
-                    rows.forEach(row => {
-                        const tds = row.querySelectorAll('td');
-                        if (tds.length >= 2) {
-                            const ip = tds[1].textContent.trim();
-                            const name = tds.length >= 4 ? tds[3].textContent.trim() : '';
-                            if (ip) patients.push({ ip, name });
-                        }
-                    });
-                    return patients;
+def login_patients(page, username, password):
+    """Log in to the medical app and wait for the episodes table."""
+    with timed_step("login"):
+        page.goto(PATIENTS_LOGIN_URL, timeout=60000)
+        page.wait_for_selector('input[name="txtUsername"]', timeout=60000)
+        page.fill('input[name="txtUsername"]', username)
+        page.fill('input[name="txtPassword"]', password)
+        wait_postback(page, "login", action=lambda: page.click("#cmdLogin"))
+
+    page.wait_for_selector("#GrdEpisodios-body", timeout=60000)
+
+
+def list_episode_patients(page):
+    """Patients of the episodes table (ip from 2nd td, name from 4th td)."""
+    return page.evaluate("""
+        () => {
+            const tbody = document.querySelector('#GrdEpisodios-body tbody');
+            if (!tbody) return [];
+            const rows = tbody.querySelectorAll('tr');
+            const patients = [];
+            rows.forEach(row => {
+                const tds = row.querySelectorAll('td');
+                if (tds.length >= 2) {
+                    const ip = tds[1].textContent.trim();
+                    const name = tds.length >= 4 ? tds[3].textContent.trim() : '';
+                    if (ip) patients.push({ ip, name });
                 }
-            """)
+            });
+            return patients;
+        }
+    """)
 
-            if not all_patients:
-                return []
+
+def lookup_history_by_navigation(page, ip):
+    """Open the history page, type the IPP and return its history rows."""
+    page.goto(PATIENT_HISTORY_URL, timeout=60000)
+    wait_postback(page, "history_page")
+
+    # Type IP in the input and blur
+    page.wait_for_selector(HISTORY_IPP_INPUT, timeout=60000)
+    page.fill(HISTORY_IPP_INPUT, ip)
+    wait_postback(page, "history_ipp", action=lambda: page.keyboard.press("Tab"))
+
+    # Dismiss any alert that may appear after blur
+    page.keyboard.press("Escape")
+    page.keyboard.press("Enter")
+    page.keyboard.press("Escape")
+
+    if not learned_wait(page.locator(HISTORY_TABLE_BODY).first, HISTORY_TABLE_BODY, 15000):
+        return []
+    return page.evaluate(HISTORY_ROWS_JS)
+
+
+def lookup_history_batched(page, ipps):
+    """
+    Look up history rows for many IPPs from one loaded history page,
+    HISTORY_BATCH_SIZE partial postbacks per call (see HISTORY_BATCH_JS).
+
+    Returns {ip: rows} for the IPPs whose history grid could be read;
+    callers navigate for the others. Stops early when a whole batch comes
+    back without a grid (session lost, or no partial postback on the page).
+    """
+    rows_by_ip = {}
+    page.goto(PATIENT_HISTORY_URL, timeout=60000)
+    page.wait_for_selector(HISTORY_IPP_INPUT, timeout=60000)
+
+    for start in range(0, len(ipps), HISTORY_BATCH_SIZE):
+        batch = ipps[start:start + HISTORY_BATCH_SIZE]
+        results = page.evaluate(HISTORY_BATCH_JS, {"ipps": batch, "input": HISTORY_IPP_INPUT,
+                                                   "timeout": HISTORY_LOOKUP_TIMEOUT_MS})
+        for r in results:
+            notify("step", "history_lookup", r["ms"] / 1000, ok=r["found"], mode="batched")
+            if r["found"]:
+                rows_by_ip[r["ipp"]] = r["rows"]
+            elif not r["ok"]:
+                log(f"[WARNING] Batched history lookup failed for {r['ipp']}: {r.get('error')}")
+        if not any(r["found"] for r in results):
+            log("[WARNING] Batched history lookup returned no grid, navigating per patient instead.")
+            break
+
+    return rows_by_ip
+
+
+def fetch_bilan_matrix(username, password, window_days=HISTORY_WINDOW_DAYS, browser_tag=None):
+    """
+    Fetch all patients from SIH and read each history page once.
+
+    window_days: how many days back (today included) dates are kept.
+    browser_tag: optional marker passed to launch_browser().
+    Returns: list of dicts {"ip": str, "name": str, "dates": {code: [date, ...]}, "error": bool}
+             where dates are newest first; answer questions with bilan_status().
+    """
+    window_start = date.today() - timedelta(days=max(window_days, 1) - 1)
+
+    with sync_playwright() as p:
+        browser = launch_browser(p, tag=browser_tag)
+        try:
+            context = new_context(browser)
+            page = context.new_page()
+            page.set_default_timeout(60000)
+            page.on("dialog", accept_dialog)  # auto-accept any JS alert that may appear
+
+            login_patients(page, username, password)
+            all_patients = [(pt.get("ip", ""), pt.get("name", "")) for pt in list_episode_patients(page) if pt.get("ip")]
+
+            rows_by_ip = {}
+            if HISTORY_BATCH_SIZE > 0 and all_patients:
+                try:
+                    rows_by_ip = lookup_history_batched(page, [ip for ip, _ in all_patients])
+                except Exception as e:
+                    log(f"[WARNING] Batched history lookup unavailable: {e}")
 
             result = []
-            for patient in all_patients:
-                ip = patient.get("ip", "")
-                name = patient.get("name", "")
-                if not ip:
-                    continue
+            for ip, name in all_patients:
                 try:
-                    page.goto(PATIENT_HISTORY_URL, timeout=60000)
-                    page.wait_for_load_state("networkidle")
-
-                    # Type IP in the input and blur
-                    page.wait_for_selector(HISTORY_IPP_INPUT, timeout=60000)
-                    page.fill(HISTORY_IPP_INPUT, ip)
-                    page.keyboard.press("Tab")
-                    page.wait_for_load_state("networkidle")
-
-                    # Dismiss any alert that may appear after blur
-                    page.keyboard.press("Escape")
-                    page.keyboard.press("Enter")
-                    page.keyboard.press("Escape")
-
-                    # Look for any of the booking codes in the history table
-                    has_bilan_on_target = False
-                    try:
-                        page.wait_for_selector(HISTORY_TABLE_BODY, timeout=15000)
-
-                        bilan_date_str = page.evaluate("""
-                            (codes) => {
-                                const tbody = document.querySelector('#_ctl0_cph_GrdHistorial-body tbody');
-                                if (!tbody) return null;
-                                const rows = tbody.querySelectorAll('tr');
-                                for (const row of rows) {
-                                    const tds = row.querySelectorAll('td');
-                                    if (tds.length >= 5) {
-                                        const fourthTd = tds[4].textContent.trim();
-                                        for (const code of codes) {
-                                            if (fourthTd.includes('(' + code + ')')) {
-                                                return tds[1].textContent.trim();
-                                            }
-                                        }
-                                    }
-                                }
-                                return null;
-                            }
-                        """, booking_codes)
-
-                        if bilan_date_str:
-                            # Parse date from format like "04/03/2026 8:33"
-                            try:
-                                bilan_date = datetime.strptime(
-                                    bilan_date_str.split()[0], "%d/%m/%Y"
-                                ).date()
-                                if bilan_date == target_date:
-                                    has_bilan_on_target = True
-                            except (ValueError, IndexError):
-                                pass
-
-                    except PlaywrightTimeoutError:
-                        pass
-
-                    result.append({"ip": ip, "name": name, "has_bilan": has_bilan_on_target})
+                    rows = rows_by_ip.get(ip)
+                    if rows is None:
+                        with timed_step("history_lookup", mode="navigate"):
+                            rows = lookup_history_by_navigation(page, ip)
+
+                    result.append({"ip": ip, "name": name, "dates": history_matrix(rows, window_start), "error": False})
 
                 except Exception as e:
                     log(f"[WARNING] Error checking IP {ip}, skipping: {e}")
-                    result.append({"ip": ip, "name": name, "has_bilan": False})
+                    result.append({"ip": ip, "name": name, "dates": {}, "error": True})
 
             return result
         finally:
-            browser.close()
+            close_browser(browser)
+            LATENCY.save()
+
 
+def fetch_patients_without_bilans(username, password, filter_option, booking_codes=None, browser_tag=None):
+    """
+    Fetch all patients from SIH and determine which ones already have bilans
+    for the specified period.
 
-def fetch_all_patients(username, password, filter_option="all"):
+    filter_option: "today" or "yesterday"
+    booking_codes: list of booking codes to check (e.g. ['CYTO', 'BES']).
+                   Defaults to ['CYTO'] if not provided.
+    browser_tag: optional marker passed to launch_browser().
+    Returns: list of dicts {"ip": str, "name": str, "has_bilan": bool, "codes": {code: status}}
+             (see bilan_status()).
+    """
+    target_date = bilan_target_date(filter_option)
+
+    if not booking_codes:
+        booking_codes = ["CYTO"]
+
+    matrix = fetch_bilan_matrix(username, password, browser_tag=browser_tag)
+    return [
+        {"ip": entry["ip"], "name": entry["name"], **bilan_status(entry, booking_codes, target_date)}
+        for entry in matrix
+    ]
+
+
+def fetch_all_patients(username, password, filter_option="all", browser_tag=None):
     """
     Fetch all patients from SIH without checking bilan history.
 
     filter_option: "all" (default), "today", or "yesterday"
                    All options navigate to the default.aspx page and return
                    the full list of hospitalized patients as displayed.
+    browser_tag: optional marker passed to launch_browser().
     Returns: list of dicts {"ip": str, "name": str, "has_bilan": bool}
              has_bilan is always False since no bilan check is performed.
     """
@@ -580,46 +1510,19 @@ def fetch_all_patients(username, password, filter_option="all"):
         raise ValueError(f"Invalid filter option: {filter_option}")
 
     with sync_playwright() as p:
-        launch_args = ["--incognito"] if USE_PRIVATE_MODE else []
-        browser = p.chromium.launch(headless=HEADLESS, args=launch_args)
-        context = browser.new_context(ignore_https_errors=True)
-        page = context.new_page()
-        page.set_default_timeout(60000)
-
+        browser = launch_browser(p, tag=browser_tag)
         try:
-            # Login
-            page.goto(PATIENTS_LOGIN_URL, timeout=60000)
-            page.wait_for_selector('input[name="txtUsername"]', timeout=60000)
-            page.fill('input[name="txtUsername"]', username)
-            page.fill('input[name="txtPassword"]', password)
-            page.click("#cmdLogin")
-            page.wait_for_load_state("networkidle")
-
-            # Wait for episodes table
-            page.wait_for_selector("#GrdEpisodios-body", timeout=60000)
-
-            # Get all patients from the table (ip from 2nd td, name from 5th td)
-            all_patients = page.evaluate("""
-                () => {
-                    const tbody = document.querySelector('#GrdEpisodios-body tbody');
-                    if (!tbody) return [];
-                    const rows = tbody.querySelectorAll('tr');
-                    const patients = [];
-                    rows.forEach(row => {
-                        const tds = row.querySelectorAll('td');
-                        if (tds.length >= 2) {
-                            const ip = tds[1].textContent.trim();
-                            const name = tds.length >= 4 ? tds[3].textContent.trim() : '';
-                            if (ip) patients.push({ ip, name });
-                        }
-                    });
-                    return patients;
-                }
-            """)
+            context = new_context(browser)
+            page = context.new_page()
+            page.set_default_timeout(60000)
+
+            login_patients(page, username, password)
+            all_patients = list_episode_patients(page)
 
             return [{"ip": p["ip"], "name": p["name"], "has_bilan": False} for p in all_patients if p.get("ip")]
         finally:
-            browser.close()
+            close_browser(browser)
+            LATENCY.save()
 
 
 # =========================
@@ -643,6 +1546,8 @@ def get_ipp_list():
 
 def get_selected_date():
     """Show date selection menu and return selected date as dd/mm/yyyy string."""
+    from beaupy import select
+
     today = date.today()
     tomorrow = today + timedelta(days=1)
 
@@ -675,6 +1580,8 @@ def get_selected_date():
 
 def get_selected_hour():
     """Show hour selection menu and return selected time as HH:MM:SS string."""
+    from beaupy import select
+
     PRESET_HOURS = ["06:00", "08:00", "09:00"]
     CUSTOM_LABEL = "Personnalisé    (saisir l'heure)"
     NOW_IDX = 0
@@ -710,6 +1617,8 @@ def get_selected_hour():
 
 def get_selected_bookings():
     """Show multi-select menu for test types."""
+    from beaupy import select_multiple
+
     options = list(MENU_CONFIG.keys())
     
     print()
@@ -723,87 +1632,478 @@ def get_selected_bookings():
     print(f"\n[INFO] Analyses sélectionnées: {', '.join(selected)}")
     return selected
 
-def run_job(ipp_list, selected_date, selected_hour, selected_bookings, username, password):
-    """Run the booking automation without interactive prompts."""
-    selected_date_08 = f"{selected_date} {selected_hour}"
+class JobCancelled(Exception):
+    """Raised from JobControl.checkpoint() to stop a job between two steps."""
+
+
+class JobControl:
+    """
+    Hooks run_job() calls at safe points; this default does nothing.
+
+    checkpoint(): before each IPP and each booking code. May block (pause)
+        or raise JobCancelled; run_job() then closes the browser at once.
+    ipp_started(ipp) / booking_started(ipp, code): once the checkpoint of an
+        IPP / a code has passed.
+    booking_done(ipp, code) / ipp_done(ipp): after a code, after a whole IPP.
+    between_ipps(run_ipps): at every IPP boundary (booking modal closed, page
+        idle). Extra work may run here on the same logged-in page through
+        run_ipps(ipp_list, dates_08, selected_bookings, control).
+
+    auto_book() also calls:
+    patients_swept(found, swept, total): after each set of histories read.
+        found lists {"ip", "name", "bookings", "state"} for the patients that
+        lack analyses ("queued", or "to_confirm" when held for confirmation)
+        or whose history could not be read ("error").
+    confirmations(): {ip: approved} decided since the last call for the
+        patients held "to_confirm".
+    """
+
+    def checkpoint(self):
+        pass
+
+    def ipp_started(self, ipp):
+        pass
+
+    def booking_started(self, ipp, code):
+        pass
+
+    def booking_done(self, ipp, code):
+        pass
+
+    def ipp_done(self, ipp):
+        pass
+
+    def between_ipps(self, run_ipps):
+        pass
+
+    def patients_swept(self, found, swept, total):
+        pass
+
+    def confirmations(self):
+        return {}
+
+
+def book_ipp(page, context, ipp, dates_08, selected_bookings, control):
+    """Book every selected analysis at every date-time of dates_08 for one IPP on the logged-in booking page."""
+    control.ipp_started(ipp)
+    learned_wait(page.locator(BOOKING).first, BOOKING, DEFAULT_TIMEOUT_MS, required=True)
+    page.keyboard.press("Escape")
+    page.keyboard.press("Enter")
+    page.keyboard.press("Escape")
+
+    safe_fill(page, TXT_IPP, ipp)
+    wait_postback(page, "ipp", action=lambda: page.locator(TXT_IPP).press("Tab"))
+
+    page.keyboard.press("Escape")
+    page.keyboard.press("Enter")
+    page.keyboard.press("Escape")
+
+    safe_check(page, CHK_MANTENER)
+    close_tool_window(page)
+
+    book_codes(page, context, ipp, dates_08, compute_booking_plan(selected_bookings), control)
+    control.ipp_done(ipp)
+
+
+def run_job(ipp_list, selected_date, selected_hour, selected_bookings, username, password, browser_tag=None,
+            control=None, series=None):
+    """
+    Run the booking automation without interactive prompts. series, a list of
+    "dd/mm/yyyy HH:MM:SS" date-times, books each analysis of each IPP at all
+    of them (one login, one modal per code) instead of selected_date/hour.
+    """
+    dates_08 = list(series) if series else [f"{selected_date} {selected_hour}"]
+    control = control or JobControl()
 
     with sync_playwright() as p:
-        launch_args = []
-        if USE_KIOSK_PRINTING:
-            launch_args.append("--kiosk-printing")
-        if USE_PRIVATE_MODE:
-            launch_args.append("--incognito")
-
-        browser = p.chromium.launch(headless=HEADLESS, args=launch_args)
-        context = browser.new_context(ignore_https_errors=True)
-        context.set_default_timeout(0)  # unlimited; inherited by popups
-
-        context.add_init_script("""
-            (() => {
-                const CSS = '.x-window-closable, .x-mask, .x-css-shadow { display: none!important }';
-                const STYLE_ID = 'hosix-overlay-hide';
-                const mo = new MutationObserver(function(mutations) {
-                    for (const m of mutations) {
-                        for (const node of m.removedNodes) {
-                            if (node.id === STYLE_ID) { injectStyle(); return; }
-                        }
-                    }
-                });
-                function injectStyle() {
-                    if (!document.getElementById(STYLE_ID)) {
-                        const s = document.createElement('style');
-                        s.id = STYLE_ID;
-                        s.textContent = CSS;
-                        const container = document.head || document.documentElement;
-                        container.appendChild(s);
-                        mo.observe(container, { childList: true });
-                    }
+        browser = launch_browser(p, kiosk_printing=True, tag=browser_tag)
+        try:
+            context = new_context(browser)
+            context.set_default_timeout(0)  # unlimited; inherited by popups
+
+            context.add_init_script(OVERLAY_HIDE_SCRIPT)
+
+            page = context.new_page()
+
+            with timed_step("login"):
+                page.goto(LOGIN_URL, timeout=0)
+                page.wait_for_selector('input[name="txtUsername"]', timeout=DEFAULT_TIMEOUT_MS)
+                page.fill('input[name="txtUsername"]', username)
+                page.fill('input[name="txtPassword"]', password)
+                safe_click_with_nav(page, "#cmdLogin", step="login")
+
+            def run_ipps(ipps, ipp_dates_08, bookings, ipp_control):
+                for ipp in ipps:
+                    ipp_control.checkpoint()
+                    book_ipp(page, context, ipp, ipp_dates_08, bookings, ipp_control)
+
+            for ipp_index, current_ipp in enumerate(ipp_list):
+                control.between_ipps(run_ipps)
+                control.checkpoint()
+                log(f"[INFO] Traitement IPP {ipp_index + 1}/{len(ipp_list)}: {current_ipp}")
+                book_ipp(page, context, current_ipp, dates_08, selected_bookings, control)
+                log(f"[INFO] IPP {current_ipp} terminé avec succès!")
+            control.between_ipps(run_ipps)
+
+            log(f"[INFO] Tous les {len(ipp_list)} IPP ont été traités!")
+        finally:
+            close_browser(browser)
+            LATENCY.save()
+
+
+# =========================
+# AUTO-BOOK (sweep and book in one session)
+# =========================
+BOOKING_URL = "https://sih/Apps/adm/Citas/citax.aspx"
+AUTO_BOOK_POLL_MS = 500         # idle wait for sweep results or confirmations
+AUTO_BOOK_CONFIRM_WAIT_S = 600  # once the sweep is over, how long held patients may wait for a decision
+
+# Runs HISTORY_BATCH_JS in the background of the history page, HISTORY_BATCH_SIZE
+# IPPs at a time, and queues the results in window.__hosixSweep until
+# HISTORY_SWEEP_TAKE_JS collects them. Stops early like lookup_history_batched().
+HISTORY_SWEEP_JS = """
+    ({ ipps, input, size, timeout }) => {
+        const lookupBatch = LOOKUP_BATCH;
+        const sweep = window.__hosixSweep = { results: [], done: false };
+        (async () => {
+            try {
+                for (let i = 0; i < ipps.length; i += size) {
+                    const batch = await lookupBatch({ ipps: ipps.slice(i, i + size), input, timeout });
+                    sweep.results.push(...batch);
+                    if (!batch.some(r => r.found)) break;
                 }
-                injectStyle();
-                // Re-inject after ASP.NET AJAX partial postbacks (UpdatePanel)
-                document.addEventListener('DOMContentLoaded', function() {
-                    if (window.Sys && Sys.WebForms && Sys.WebForms.PageRequestManager) {
-                        Sys.WebForms.PageRequestManager.getInstance().add_endRequest(injectStyle);
-                    }
-                });
-            })();
-        """)
-
-        page = context.new_page()
-
-        page.goto(LOGIN_URL, timeout=0)
-        page.wait_for_selector('input[name="txtUsername"]', timeout=DEFAULT_TIMEOUT_MS)
-        page.fill('input[name="txtUsername"]', username)
-        page.fill('input[name="txtPassword"]', password)
-        safe_click_with_nav(page, "#cmdLogin")
+            } finally {
+                sweep.done = true;
+            }
+        })();
+    }
+""".replace("LOOKUP_BATCH", HISTORY_BATCH_JS.strip())
+
+HISTORY_SWEEP_TAKE_JS = """
+    () => {
+        const sweep = window.__hosixSweep;
+        return { results: sweep.results.splice(0), done: sweep.done };
+    }
+"""
+
+
+class HistorySweep:
+    """
+    Producer side of auto_book(): history lookups running in the background
+    of their own page (HISTORY_SWEEP_JS) while another page of the context
+    books. take() returns [(ip, rows, or None if unreadable)] read since the
+    last call; the IPPs the batched lookups missed are then navigated to,
+    one per call, so that bookings keep interleaving.
+    """
 
-        for ipp_index, current_ipp in enumerate(ipp_list):
-            log(f"[INFO] Traitement IPP {ipp_index + 1}/{len(ipp_list)}: {current_ipp}")
+    def __init__(self, page, ipps):
+        self.page = page
+        self.pending = list(ipps)  # not read yet
+        self.running = False
+        if HISTORY_BATCH_SIZE > 0 and self.pending:
+            try:
+                page.goto(PATIENT_HISTORY_URL, timeout=60000)
+                page.wait_for_selector(HISTORY_IPP_INPUT, timeout=60000)
+                page.evaluate(HISTORY_SWEEP_JS, {"ipps": self.pending, "input": HISTORY_IPP_INPUT,
+                                                 "size": HISTORY_BATCH_SIZE, "timeout": HISTORY_LOOKUP_TIMEOUT_MS})
+                self.running = True
+            except Exception as e:
+                log(f"[WARNING] Batched history lookup unavailable: {e}")
+
+    @property
+    def finished(self):
+        return not self.running and not self.pending
+
+    def take(self):
+        if self.running:
+            try:
+                state = self.page.evaluate(HISTORY_SWEEP_TAKE_JS)
+            except Exception as e:
+                log(f"[WARNING] Batched history lookup lost, navigating per patient instead: {e}")
+                self.running = False
+                return []
+            results = []
+            for r in state["results"]:
+                notify("step", "history_lookup", r["ms"] / 1000, ok=r["found"], mode="batched")
+                if r["found"]:
+                    self.pending.remove(r["ipp"])
+                    results.append((r["ipp"], r["rows"]))
+                elif not r["ok"]:
+                    log(f"[WARNING] Batched history lookup failed for {r['ipp']}: {r.get('error')}")
+            if state["done"]:
+                self.running = False
+                if self.pending:
+                    log(f"[WARNING] {len(self.pending)} history page(s) not read in batch, navigating per patient.")
+            return results
+
+        if not self.pending:
+            return []
+        ip = self.pending.pop(0)
+        try:
+            with timed_step("history_lookup", mode="navigate"):
+                return [(ip, lookup_history_by_navigation(self.page, ip))]
+        except Exception as e:
+            log(f"[WARNING] Error checking IP {ip}, skipping: {e}")
+            return [(ip, None)]
 
-            page.wait_for_selector(BOOKING, timeout=DEFAULT_TIMEOUT_MS)
-            page.keyboard.press("Escape")
-            page.keyboard.press("Enter")
-            page.keyboard.press("Escape")
 
-            safe_fill(page, TXT_IPP, current_ipp)
-            page.locator(TXT_IPP).press("Tab")
-            page.wait_for_load_state("networkidle")
+def missing_bookings(matrix, selected_bookings, target_date, min_gap_days=0):
+    """
+    The selected analyses whose code has no bilan in matrix ({code: [date,
+    ...]}, see history_matrix()) on target_date or the min_gap_days before it.
+    """
+    missing = []
+    for item in selected_bookings:
+        dates = matrix.get(MENU_CONFIG[item]["code"], [])
+        if not any(0 <= (target_date - d).days <= min_gap_days for d in dates):
+            missing.append(item)
+    return missing
+
+
+def sweep_and_book(sweep, patients, target_date, selected_bookings, rules, control, book, run_ipps, idle):
+    """
+    Consumer side of auto_book(). Each history the sweep returns is reduced
+    to the analyses the patient lacks (missing_bookings()), which are booked
+    right away with book(ip, items) while the sweep goes on. With
+    rules["confirm"], patients wait for control.confirmations() instead, up
+    to AUTO_BOOK_CONFIRM_WAIT_S once the sweep is over. patients maps IPPs
+    to names; idle(ms) waits when there is nothing to do.
+    """
+    min_gap_days = int(rules.get("min_gap_days") or 0)
+    window_start = target_date - timedelta(days=min_gap_days)
+    queue, held = deque(), {}
+    swept, hold_until = 0, None
+    while True:
+        results = sweep.take()
+        if results:
+            found = []
+            for ip, rows in results:
+                swept += 1
+                if rows is None:
+                    found.append({"ip": ip, "name": patients.get(ip, ""), "bookings": [], "state": "error"})
+                    continue
+                items = missing_bookings(history_matrix(rows, window_start), selected_bookings, target_date,
+                                         min_gap_days)
+                if not items:
+                    continue
+                log(f"[INFO] IPP {ip} sans bilan : {', '.join(items)}")
+                if rules.get("confirm"):
+                    held[ip] = items
+                else:
+                    queue.append((ip, items))
+                found.append({"ip": ip, "name": patients.get(ip, ""), "bookings": items,
+                              "state": "to_confirm" if rules.get("confirm") else "queued"})
+            control.patients_swept(found, swept, len(patients))
+
+        if held:
+            for ip, approved in control.confirmations().items():
+                items = held.pop(ip, None)
+                if items and approved:
+                    queue.append((ip, items))
+
+        if queue:
+            control.between_ipps(run_ipps)
+            control.checkpoint()
+            book(*queue.popleft())
+            continue
+        if sweep.finished and not held:
+            break
+        if sweep.finished:
+            hold_until = hold_until or time.monotonic() + AUTO_BOOK_CONFIRM_WAIT_S
+            if time.monotonic() > hold_until:
+                log(f"[WARNING] {len(held)} IPP non confirmé(s) après {AUTO_BOOK_CONFIRM_WAIT_S} s, ignoré(s).")
+                break
+        control.checkpoint()
+        if not results:
+            idle(AUTO_BOOK_POLL_MS)
+    control.between_ipps(run_ipps)
+
+
+def open_booking_page(page, username, password):
+    """Open the booking page in a context that is already logged in; log in again if SIH asks."""
+    page.goto(BOOKING_URL, timeout=0)
+    name, _ = wait_first(page, {"booking": Visible(BOOKING), "login": Visible('input[name="txtUsername"]')},
+                         60000, key="booking_page")
+    if name == "login":
+        log("[INFO] Session not shared with the booking page, logging in again.")
+        with timed_step("login"):
+            page.fill('input[name="txtUsername"]', username)
+            page.fill('input[name="txtPassword"]', password)
+            safe_click_with_nav(page, "#cmdLogin", step="login")
+    elif name is None:
+        raise Exception("Booking page did not load")
 
-            page.keyboard.press("Escape")
-            page.keyboard.press("Enter")
-            page.keyboard.press("Escape")
 
-            safe_check(page, CHK_MANTENER)
-            try_click(page, BTN_TOOL_1031, timeout_ms=3000)
+def auto_book(username, password, filter_option, selected_date, selected_hour, selected_bookings, rules=None,
+              browser_tag=None, control=None, series=None):
+    """
+    Sweep the hospitalised patients for missing bilans (as
+    fetch_patients_without_bilans()) and book what each one lacks as soon as
+    their history is read, in one browser and one login: the sweep runs in
+    the background of a history page (HistorySweep) while a booking page
+    books (sweep_and_book()).
+
+    filter_option: "today" or "yesterday", the day whose bilans count.
+    rules: {"confirm": bool, "min_gap_days": int}, see sweep_and_book().
+    Other arguments as run_job(); control also gets patients_swept() and
+    confirmations().
+    """
+    target_date = bilan_target_date(filter_option)
+    dates_08 = list(series) if series else [f"{selected_date} {selected_hour}"]
+    control = control or JobControl()
+
+    with sync_playwright() as p:
+        browser = launch_browser(p, kiosk_printing=True, tag=browser_tag)
+        try:
+            context = new_context(browser)
+            context.set_default_timeout(0)  # unlimited; inherited by popups
+            context.add_init_script(OVERLAY_HIDE_SCRIPT)
+
+            sweep_page = context.new_page()
+            sweep_page.set_default_timeout(60000)
+            sweep_page.on("dialog", accept_dialog)
+            login_patients(sweep_page, username, password)
+            patients = {pt["ip"]: pt.get("name", "") for pt in list_episode_patients(sweep_page) if pt.get("ip")}
+            log(f"[INFO] {len(patients)} patients hospitalisés à vérifier")
+            sweep = HistorySweep(sweep_page, list(patients))
+
+            page = context.new_page()
+            open_booking_page(page, username, password)
+
+            def book(ipp, items):
+                book_ipp(page, context, ipp, dates_08, items, control)
+                log(f"[INFO] IPP {ipp} terminé avec succès!")
+
+            def run_ipps(ipps, ipp_dates_08, bookings, ipp_control):
+                for ipp in ipps:
+                    ipp_control.checkpoint()
+                    book_ipp(page, context, ipp, ipp_dates_08, bookings, ipp_control)
+
+            sweep_and_book(sweep, patients, target_date, selected_bookings, rules or {}, control, book, run_ipps,
+                           page.wait_for_timeout)
+        finally:
+            close_browser(browser)
+            LATENCY.save()
+
+
+# Process-isolated jobs: web.py starts run_job_process() in a child process
+# and drives it over a multiprocessing pipe. Messages are tuples; hooks and
+# measurements go up, ("cancel" | "pause" | "resume", channel) come down.
+# Channel 0 is the job itself, channel 1 urgent work run inside it. The
+# patient list and bilan sweeps run the same way through run_call_process().
+class PipeJobControl(JobControl):
+    """JobControl of a job process: hooks are sent to the parent, commands read at checkpoints."""
+
+    _STATES = {"cancel": "cancel", "pause": "paused", "resume": "running"}
+
+    def __init__(self, conn, channel=0, states=None):
+        self.conn = conn
+        self.channel = channel
+        self.states = states if states is not None else {}  # channel -> "running" / "paused" / "cancel"
+
+    def _apply(self, message):
+        """Record a command; return the message if it is something else (a reply)."""
+        if message[0] not in self._STATES:
+            return message
+        if self.states.get(message[1]) != "cancel":
+            self.states[message[1]] = self._STATES[message[0]]
+        return None
+
+    def _receive(self):
+        """Wait for the parent's reply to a request, applying the commands that come first."""
+        while True:
+            reply = self._apply(self.conn.recv())
+            if reply is not None:
+                return reply
+
+    def checkpoint(self):
+        while self.conn.poll():
+            self._apply(self.conn.recv())
+        if self.states.get(self.channel) == "paused":
+            self.conn.send(("status", self.channel, "paused"))
+            while self.states.get(self.channel) == "paused":
+                self._apply(self.conn.recv())
+            if self.states.get(self.channel) != "cancel":
+                self.conn.send(("status", self.channel, "running"))
+        if self.states.get(self.channel) == "cancel":
+            raise JobCancelled("Travail annulé.")
+
+    def ipp_started(self, ipp):
+        self.conn.send(("ipp_started", self.channel, ipp))
+
+    def booking_started(self, ipp, code):
+        self.conn.send(("booking_started", self.channel, ipp, code))
+
+    def booking_done(self, ipp, code):
+        self.conn.send(("booking_done", self.channel, ipp, code))
+
+    def ipp_done(self, ipp):
+        self.conn.send(("ipp_done", self.channel, ipp))
+
+    def between_ipps(self, run_ipps):
+        while True:
+            self.conn.send(("between_ipps", self.channel))
+            reply = self._receive()
+            if reply[0] != "inject":
+                return
+            _, ipp_list, dates_08, bookings = reply
+            self.states[1] = "running"
+            try:
+                run_ipps(ipp_list, dates_08, bookings, PipeJobControl(self.conn, 1, self.states))
+                self.conn.send(("work_done", "completed", None))
+            except JobCancelled:
+                self.conn.send(("work_done", "cancelled", None))
+            except Exception as e:
+                self.conn.send(("work_done", "failed", str(e)))
 
-            booking_plan = compute_booking_plan(selected_bookings)
-            for code, checkboxes in booking_plan:
-                perform_booking(page, context, code, checkboxes, selected_date_08)
+    def patients_swept(self, found, swept, total):
+        self.conn.send(("patients_swept", self.channel, found, swept, total))
 
-            log(f"[INFO] IPP {current_ipp} terminé avec succès!")
+    def confirmations(self):
+        self.conn.send(("confirmations", self.channel))
+        return self._receive()[1]
+
+
+def run_job_process(conn, settings, args, kwargs, flow="run_job"):
+    """
+    Entry point of a job process: apply settings (module globals such as
+    HEADLESS), then run the flow ("run_job" or "auto_book") with *args,
+    **kwargs and a PipeJobControl. Every observer notification is
+    forwarded; the last message is ("result", "completed" | "cancelled" |
+    "failed", error).
+    """
+    _process_setup(conn, settings)
+    try:
+        globals()[flow](*args, control=PipeJobControl(conn), **kwargs)
+        conn.send(("result", "completed", None))
+    except JobCancelled:
+        conn.send(("result", "cancelled", None))
+    except Exception as e:
+        conn.send(("result", "failed", str(e)))
+    finally:
+        conn.close()
+
+
+def run_call_process(conn, settings, flow, args, kwargs):
+    """
+    Entry point of a process running a flow that returns a value
+    (fetch_all_patients, fetch_bilan_matrix): settings and notifications as
+    run_job_process(); the last message is ("result", "completed", value)
+    or ("result", "failed", error).
+    """
+    _process_setup(conn, settings)
+    try:
+        conn.send(("result", "completed", globals()[flow](*args, **kwargs)))
+    except Exception as e:
+        conn.send(("result", "failed", str(e)))
+    finally:
+        conn.close()
 
-        log(f"[INFO] Tous les {len(ipp_list)} IPP ont été traités!")
-        browser.close()
+
+def _process_setup(conn, settings):
+    globals().update(settings)
+    LATENCY.persist = False
+    OBSERVERS[:] = [lambda kind, name, value, labels: conn.send(("notify", kind, name, value, labels))]
 
 
 def main():
@@ -833,104 +2133,70 @@ def main():
     password = getpass.getpass("Password: ")
 
     with sync_playwright() as p:
-        launch_args = []
-        if USE_KIOSK_PRINTING:
-            launch_args.append("--kiosk-printing")
-        if USE_PRIVATE_MODE:
-            launch_args.append("--incognito")
-
-        browser = p.chromium.launch(
-            headless=HEADLESS,
-            args=launch_args
-        )
-
-        context = browser.new_context(ignore_https_errors=True)
-        context.set_default_timeout(0)  # unlimited; inherited by popups
-
-        # Globally suppress unwanted ExtJS modals/overlays on every page and frame
-        context.add_init_script("""
-            (() => {
-                const CSS = '.x-window-closable, .x-mask, .x-css-shadow { display: none!important }';
-                const STYLE_ID = 'hosix-overlay-hide';
-                const mo = new MutationObserver(function(mutations) {
-                    for (const m of mutations) {
-                        for (const node of m.removedNodes) {
-                            if (node.id === STYLE_ID) { injectStyle(); return; }
-                        }
-                    }
-                });
-                function injectStyle() {
-                    if (!document.getElementById(STYLE_ID)) {
-                        const s = document.createElement('style');
-                        s.id = STYLE_ID;
-                        s.textContent = CSS;
-                        const container = document.head || document.documentElement;
-                        container.appendChild(s);
-                        mo.observe(container, { childList: true });
-                    }
-                }
-                injectStyle();
-                // Re-inject after ASP.NET AJAX partial postbacks (UpdatePanel)
-                document.addEventListener('DOMContentLoaded', function() {
-                    if (window.Sys && Sys.WebForms && Sys.WebForms.PageRequestManager) {
-                        Sys.WebForms.PageRequestManager.getInstance().add_endRequest(injectStyle);
-                    }
-                });
-            })();
-        """)
-
-        page = context.new_page()
-
-        # 1) Login
-        page.goto(LOGIN_URL, timeout=0)  # No timeout
-        page.wait_for_selector('input[name="txtUsername"]', timeout=DEFAULT_TIMEOUT_MS)
-        page.fill('input[name="txtUsername"]', username)
-        page.fill('input[name="txtPassword"]', password)
-        safe_click_with_nav(page, "#cmdLogin")
-
-        # Process each IPP
-        for ipp_index, current_ipp in enumerate(ipp_list):
-            print(f"\n{'='*50}")
-            log(f"[INFO] Traitement IPP {ipp_index + 1}/{len(ipp_list)}: {current_ipp}")
-            print(f"{'='*50}")
-
-            # 2) Wait for Booking page
-            page.wait_for_selector(BOOKING, timeout=DEFAULT_TIMEOUT_MS)
-            page.keyboard.press("Escape")
-            page.keyboard.press("Enter")
-            page.keyboard.press("Escape")
-
-            safe_fill(page, TXT_IPP, current_ipp)
-            page.locator(TXT_IPP).press("Tab")  # Blur input to trigger ASPX change/postback
-            page.wait_for_load_state("networkidle")
-
-            page.keyboard.press("Escape")
-            page.keyboard.press("Enter")
-            page.keyboard.press("Escape")
-
-            safe_check(page, CHK_MANTENER)
+        browser = launch_browser(p, kiosk_printing=True)
+        try:
+            context = new_context(browser)
+            context.set_default_timeout(0)  # unlimited; inherited by popups
+
+            # Globally suppress unwanted ExtJS modals/overlays on every page and frame
+            context.add_init_script(OVERLAY_HIDE_SCRIPT)
+
+            page = context.new_page()
+
+            # 1) Login
+            with timed_step("login"):
+                page.goto(LOGIN_URL, timeout=0)  # No timeout
+                page.wait_for_selector('input[name="txtUsername"]', timeout=DEFAULT_TIMEOUT_MS)
+                page.fill('input[name="txtUsername"]', username)
+                page.fill('input[name="txtPassword"]', password)
+                safe_click_with_nav(page, "#cmdLogin", step="login")
+
+            # Process each IPP
+            for ipp_index, current_ipp in enumerate(ipp_list):
+                print(f"\n{'='*50}")
+                log(f"[INFO] Traitement IPP {ipp_index + 1}/{len(ipp_list)}: {current_ipp}")
+                print(f"{'='*50}")
+
+                # 2) Wait for Booking page
+                page.wait_for_selector(BOOKING, timeout=DEFAULT_TIMEOUT_MS)
+                page.keyboard.press("Escape")
+                page.keyboard.press("Enter")
+                page.keyboard.press("Escape")
+
+                safe_fill(page, TXT_IPP, current_ipp)
+                # Blur input to trigger ASPX change/postback
+                wait_postback(page, "ipp", action=lambda: page.locator(TXT_IPP).press("Tab"))
+
+                page.keyboard.press("Escape")
+                page.keyboard.press("Enter")
+                page.keyboard.press("Escape")
+
+                safe_check(page, CHK_MANTENER)
             
-            # Optional click if the tool button appears after typing IPP
-            try_click(page, BTN_TOOL_1031, timeout_ms=3000)
+                # Optional click if the tool button appears after typing IPP
+                close_tool_window(page)
             
-            # Compute booking plan from selections
-            booking_plan = compute_booking_plan(selected_bookings)
-
-            for code, checkboxes in booking_plan:
-                perform_booking(page, context, code, checkboxes, selected_date_08)
+                # Compute booking plan from selections
+                booking_plan = compute_booking_plan(selected_bookings)
 
-            print(f"[INFO] IPP {current_ipp} terminé avec succès!")
+                book_codes(page, context, current_ipp, [selected_date_08], booking_plan, JobControl())
 
-        print(f"\n{'='*50}")
-        print(f"[INFO] Tous les {len(ipp_list)} IPP ont été traités!")
-        print(f"{'='*50}")
+                print(f"[INFO] IPP {current_ipp} terminé avec succès!")
 
-        browser.close()
+            print(f"\n{'='*50}")
+            print(f"[INFO] Tous les {len(ipp_list)} IPP ont été traités!")
+            print(f"{'='*50}")
+        finally:
+            close_browser(browser)
+            LATENCY.save()
         log("[INFO] Navigateur fermé.")
 
         return True  # Signal success
 
 if __name__ == "__main__":
+    # beaupy is only needed for the interactive menus; web.py never loads it
+    from beaupy import select
+
     while True:
         result = main()
         print()
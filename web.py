@@ -1,14 +1,46 @@
-from flask import Flask, render_template_string, request, jsonify, cli as flask_cli
+import time
+
+_STARTUP_T0 = time.perf_counter()
+
+from flask import Flask, render_template, request, jsonify, cli as flask_cli
+from werkzeug.serving import make_server
 import threading
+import argparse
+import sys
 import json
+import gzip
+import hashlib
+import heapq
+import hmac
 import os
 import re
 import socket
 import logging
+import math
+import sqlite3
+import ast
+import importlib.util
+import multiprocessing
+import unicodedata
+import urllib.request
+from collections import deque
+from contextlib import contextmanager
 from datetime import date, timedelta, datetime
 
-import script as _script_mod
-from script import MENU_CONFIG, parse_ddmmyyyy_strict, run_job, fetch_patients_without_bilans, fetch_all_patients
+try:
+    import brotli
+except ImportError:  # optional: gzip is used when brotli is not installed
+    brotli = None
+
+try:
+    import psutil
+except ImportError:  # optional: memory budget falls back to /proc/meminfo
+    psutil = None
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:  # optional: only the shared job store (--store) needs it
+    Fernet = None
 
 app = Flask(__name__)
 LOGGING_ENABLED = False
@@ -27,12 +59,142 @@ def configure_console_logging():
         werkzeug_logger = logging.getLogger("werkzeug")
         werkzeug_logger.disabled = True
 
+
+# ──────────────────────────────────────────────
+# Automation engine (imported lazily)
+# ──────────────────────────────────────────────
+# script.py pulls in Playwright, which is by far the slowest import of the
+# app. It is loaded on first use (or by the warm-up thread once the server
+# is listening) so the UI answers as soon as possible.
+_engine_mod = None
+_engine_lock = threading.Lock()
+
+
+def _engine():
+    """Return the script module, importing it on first call."""
+    global _engine_mod
+    if _engine_mod is None:
+        with _engine_lock:
+            if _engine_mod is None:
+                t0 = time.perf_counter()
+                import script
+                script.VERBOSE = LOGGING_ENABLED
+                script.OBSERVERS.append(_observe_step)
+                _startup["engine_import_s"] = round(time.perf_counter() - t0, 3)
+                _engine_mod = script
+    return _engine_mod
+
+
+_page_defaults = None  # script.py settings read from its source (see _page_settings)
+
+
+def _page_settings():
+    """
+    (menu items, HEADLESS, LAUNCH_PROFILE) for the index page. Until the
+    engine is loaded they are read from script.py's source, so the first
+    GET / does not wait on the Playwright import; the engine only changes
+    them once it is loaded (toggles call _engine()).
+    """
+    global _page_defaults
+    if _engine_mod is not None:
+        return list(_engine_mod.MENU_CONFIG), _engine_mod.HEADLESS, _engine_mod.LAUNCH_PROFILE
+    if _page_defaults is None:
+        try:
+            with open(importlib.util.find_spec("script").origin, encoding="utf-8") as fh:
+                tree = ast.parse(fh.read())
+            found = {}
+            for node in tree.body:
+                if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+                    name = node.targets[0].id
+                    if name == "MENU_CONFIG":
+                        found[name] = [ast.literal_eval(key) for key in node.value.keys]
+                    elif name in ("HEADLESS", "LAUNCH_PROFILE"):
+                        found[name] = ast.literal_eval(node.value)
+            _page_defaults = (found["MENU_CONFIG"], found["HEADLESS"], found["LAUNCH_PROFILE"])
+        except Exception as exc:
+            log_if_enabled(f"[WARNING] Could not read script.py settings, loading the engine: {exc}")
+            engine = _engine()
+            return list(engine.MENU_CONFIG), engine.HEADLESS, engine.LAUNCH_PROFILE
+    return _page_defaults
+
+
+# ──────────────────────────────────────────────
+# Startup timing & background update check
+# ──────────────────────────────────────────────
+_startup = {}
+
+_UPDATE_BASE_URL = "https://raw.githubusercontent.com/kamatil-dev/hosix/main/"
+_UPDATE_FILES = ["script.py", "web.py", "jobproc.py", "run.bat" if os.name == "nt" else "run.sh"]
+
+
+def _mark_startup(phase):
+    _startup[phase] = round(time.perf_counter() - _STARTUP_T0, 3)
+
+
+def _launcher_elapsed():
+    """Seconds spent in run.sh before Python started (HOSIX_LAUNCH_T0 = epoch)."""
+    try:
+        return round(time.time() - (time.perf_counter() - _STARTUP_T0) - float(os.environ["HOSIX_LAUNCH_T0"]), 3)
+    except (KeyError, ValueError):
+        return None
+
+
+def _check_updates():
+    """
+    Download the latest copies of the app files and stage them as <name>.new.
+    Nothing running is replaced: the launcher swaps staged files in on next start.
+    """
+    t0 = time.perf_counter()
+    staged = []
+    for name in _UPDATE_FILES:
+        try:
+            req = urllib.request.Request(
+                _UPDATE_BASE_URL + name,
+                headers={"Cache-Control": "no-cache, no-store", "Pragma": "no-cache"},
+            )
+            with urllib.request.urlopen(req, timeout=30) as resp:
+                data = resp.read()
+            current = None
+            if os.path.exists(name):
+                with open(name, "rb") as fh:
+                    current = fh.read()
+            if data and data != current:
+                with open(name + ".new.tmp", "wb") as fh:
+                    fh.write(data)
+                os.replace(name + ".new.tmp", name + ".new")
+                staged.append(name)
+        except Exception as exc:
+            log_if_enabled(f"[WARNING] Update check failed for {name}: {exc}")
+    _startup["update_check_s"] = round(time.perf_counter() - t0, 3)
+    _startup["updates_staged"] = staged
+    if staged:
+        log_if_enabled(f"[INFO] Mise à jour téléchargée ({', '.join(staged)}), appliquée au prochain démarrage.")
+
+
+def _after_listen():
+    """Warm up the engine, seed the patient index and check for updates once requests are being served."""
+    try:
+        _engine()
+    except Exception as exc:
+        log_if_enabled(f"[WARNING] Could not load automation engine: {exc}")
+    _mark_startup("engine_ready_s")
+    with _jobs_lock:
+        history = list(_jobs)
+    for job in history:
+        _index_job(job, booked=job.get("status") == "completed")
+    log_if_enabled(
+        "[INFO] Démarrage : "
+        + ", ".join(f"{k}={v}" for k, v in _startup.items() if isinstance(v, (int, float)))
+    )
+    _check_updates()
+
 # ──────────────────────────────────────────────
-# Job history (last 10 jobs, persisted to disk)
+# Job history (active jobs and the last 10 finished, persisted to disk)
 # ──────────────────────────────────────────────
 _jobs = []
 _jobs_lock = threading.Lock()
 _JOB_HISTORY_FILE = "jobs.json"
+JOB_HISTORY_SIZE = 10  # finished jobs kept; queued, running and paused ones always are
 
 
 def _load_jobs():
@@ -44,12 +206,23 @@ def _load_jobs():
         except Exception as exc:
             log_if_enabled(f"[WARNING] Could not load job history: {exc}")
             _jobs = []
+    for job in _jobs:
+        if job.get("status") not in _FINISHED:
+            # Local jobs die with the server; store jobs are reaped from the store
+            job["status"], job["error"] = "failed", "Serveur arrêté, travail interrompu."
+
+
+def _trim_jobs(jobs):
+    """Every active job and the last JOB_HISTORY_SIZE finished ones, in order."""
+    finished = [job["id"] for job in jobs if job["status"] in _FINISHED]
+    dropped = set(finished[:-JOB_HISTORY_SIZE])
+    return [job for job in jobs if job["id"] not in dropped]
 
 
 def _save_jobs():
     try:
         with open(_JOB_HISTORY_FILE, "w", encoding="utf-8") as fh:
-            json.dump(_jobs[-10:], fh, indent=2, ensure_ascii=False)
+            json.dump(_trim_jobs(_jobs), fh, indent=2, ensure_ascii=False)
     except Exception as exc:
         log_if_enabled(f"[WARNING] Could not save job history: {exc}")
 
@@ -57,41 +230,2344 @@ def _save_jobs():
 def _add_job(job):
     with _jobs_lock:
         _jobs.append(job)
-        if len(_jobs) > 10:
-            _jobs.pop(0)
+        _jobs[:] = _trim_jobs(_jobs)
         _save_jobs()
 
 
-def _update_job(job_id, status, error=None):
+def _update_job(job_id, status=None, error=None, **fields):
+    mirrored = None
     with _jobs_lock:
         for job in _jobs:
             if job["id"] == job_id:
-                job["status"] = status
+                if status is not None:
+                    job["status"] = status
                 if error is not None:
                     job["error"] = error
+                job.update(fields)
+                mirrored = dict(job)
                 break
         _save_jobs()
+    if JOB_STORE_PATH and mirrored is not None:
+        try:
+            _store_save(mirrored)
+        except sqlite3.Error as exc:
+            log_if_enabled(f"[WARNING] Could not update job store: {exc}")
+
+
+def _recent_jobs():
+    """Active jobs and the last finished ones, newest first: from the shared store in worker mode."""
+    if JOB_STORE_PATH:
+        try:
+            return _store_recent(JOB_HISTORY_SIZE)
+        except sqlite3.Error as exc:
+            log_if_enabled(f"[WARNING] Could not read job store: {exc}")
+    with _jobs_lock:
+        return list(reversed(_trim_jobs(_jobs)))
+
+
+# ──────────────────────────────────────────────
+# Shared job store (worker mode)
+# ──────────────────────────────────────────────
+# With HOSIX_JOB_STORE (or --store) naming a SQLite file, on this PC or on a
+# share every ward PC mounts, /run only queues jobs there. The web server and
+# every process started with --worker claim them while they have a free
+# browser slot. A claim is a lease kept alive by heartbeats, which also carry
+# cancel/pause/resume requests to the worker. A job whose lease runs out is
+# failed, not run again: its bookings may be half done ("booked" says which).
+#
+# The SIH password of a queued job is never written in clear: it is sealed
+# with Fernet (cryptography: AES-CBC + HMAC-SHA256) under one key shared by
+# every PC of the store: HOSIX_STORE_KEY, else the key file named by
+# HOSIX_STORE_KEY_FILE, by default store.key next to the store (restrict the
+# share to the ward PCs). The web server creates the file on first use; a
+# worker refuses to start without a key, so it can never seal or claim under
+# one of its own. The sealed password is erased (secure_delete) when the job
+# is claimed or ends, and jobs nobody claims within JOB_QUEUE_EXPIRE_S fail.
+JOB_STORE_PATH = os.environ.get("HOSIX_JOB_STORE") or None
+JOB_STORE_KEEP = 200   # finished jobs kept in the store
+JOB_LEASE_S = 120      # generous: lease times are compared across PCs' clocks
+JOB_HEARTBEAT_S = 5
+JOB_POLL_S = 2
+JOB_QUEUE_EXPIRE_S = 2 * 3600
+STORE_KEY_FILE = os.environ.get("HOSIX_STORE_KEY_FILE") or None  # None: store.key next to the store
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+_FINISHED = ("completed", "failed", "cancelled")
+_FINISHED_MARKS = ",".join("?" * len(_FINISHED))  # placeholders for "status IN (...)"
+_store_local = threading.local()
+_store_key_cache = None
+_store_key_lock = threading.Lock()
+
+
+def _store_key_path():
+    return STORE_KEY_FILE or os.path.join(os.path.dirname(os.path.abspath(JOB_STORE_PATH)), "store.key")
+
+
+def _store_key(create=False):
+    """The store's shared key: HOSIX_STORE_KEY, else the key file (written, owner-only, if create and missing).
+
+    FileNotFoundError when there is no key and create is false."""
+    global _store_key_cache
+    with _store_key_lock:
+        if _store_key_cache is None:
+            if os.environ.get("HOSIX_STORE_KEY"):
+                key = os.environ["HOSIX_STORE_KEY"].strip().encode("ascii")
+            else:
+                path = _store_key_path()
+                if create:
+                    try:
+                        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                        with os.fdopen(fd, "wb") as fh:
+                            fh.write(Fernet.generate_key())
+                    except FileExistsError:
+                        pass
+                with open(path, "rb") as fh:
+                    key = fh.read().strip()
+            Fernet(key)  # ValueError now rather than at the first job for a malformed key
+            _store_key_cache = key
+        return _store_key_cache
+
+
+def _store_key_id():
+    """Identifies the store key without revealing it; a job can only be claimed with the key that sealed it."""
+    return hmac.new(_store_key(), b"hosix-store-key-id", hashlib.sha256).hexdigest()[:16]
+
+
+def _seal(password):
+    return Fernet(_store_key()).encrypt(password.encode("utf-8")).decode("ascii")
+
+
+def _unseal(secret):
+    """The password _seal() sealed; ValueError if it was sealed with another key or altered."""
+    try:
+        return Fernet(_store_key()).decrypt(secret.encode("ascii")).decode("utf-8")
+    except InvalidToken:
+        raise ValueError("sealed with another key or altered") from None
+
+
+def _store():
+    """This thread's connection to the job store."""
+    db = getattr(_store_local, "db", None)
+    if db is None:
+        db = sqlite3.connect(JOB_STORE_PATH, timeout=30, isolation_level=None)
+        # Rollback journal: WAL needs shared memory, which network shares do not offer
+        db.execute("PRAGMA journal_mode=DELETE")
+        db.execute("PRAGMA secure_delete=ON")  # erased secrets are overwritten, not just freed
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id          TEXT PRIMARY KEY,
+                created     TEXT NOT NULL,
+                priority    INTEGER NOT NULL,
+                status      TEXT NOT NULL,
+                worker      TEXT,
+                lease_until REAL,
+                finished    REAL,
+                request     TEXT,
+                secret      TEXT,
+                key_id      TEXT,
+                data        TEXT NOT NULL
+            )
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority, created)")
+        if "key_id" not in [row[1] for row in db.execute("PRAGMA table_info(jobs)")]:
+            _store_upgrade(db)
+        _store_local.db = db
+    return db
+
+
+def _store_upgrade(db):
+    """Stores written before secrets were sealed: erase the clear passwords, fail the jobs still waiting."""
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        if "key_id" not in [row[1] for row in db.execute("PRAGMA table_info(jobs)")]:
+            db.execute("ALTER TABLE jobs ADD COLUMN key_id TEXT")
+            for job_id, data in db.execute("SELECT id, data FROM jobs WHERE status = 'queued'").fetchall():
+                job = json.loads(data)
+                job.update(status="failed", error="File partagée mise à jour, relancez le travail.")
+                db.execute("UPDATE jobs SET status = 'failed', finished = ?, data = ? WHERE id = ?",
+                           (time.time(), json.dumps(job, ensure_ascii=False), job_id))
+            db.execute("UPDATE jobs SET secret = NULL")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+
+@contextmanager
+def _store_transaction():
+    """Write transaction taken up front, so two workers never claim the same job."""
+    db = _store()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+
+def _store_add(job, password):
+    with _store_transaction() as db:
+        db.execute(
+            "INSERT INTO jobs (id, created, priority, status, secret, key_id, data) VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+            (job["id"], job["timestamp"], 1 if job.get("priority") == "urgent" else 0, _seal(password),
+             _store_key_id(), json.dumps(job, ensure_ascii=False)),
+        )
+        db.execute(f"""
+            DELETE FROM jobs WHERE status IN ({_FINISHED_MARKS}) AND id NOT IN (
+                SELECT id FROM jobs WHERE status IN ({_FINISHED_MARKS}) ORDER BY finished DESC LIMIT ?)
+        """, (*_FINISHED, *_FINISHED, JOB_STORE_KEEP))
+
+
+def _store_save(job):
+    """Mirror a job this process runs (see _update_job), unless it was already finished (e.g. reaped)."""
+    finished = time.time() if job["status"] in _FINISHED else None
+    _store().execute(
+        "UPDATE jobs SET status = ?, finished = ?, secret = NULL, data = ? "
+        f"WHERE id = ? AND worker = ? AND status NOT IN ({_FINISHED_MARKS})",
+        (job["status"], finished, json.dumps(job, ensure_ascii=False), job["id"], WORKER_ID, *_FINISHED),
+    )
+
+
+def _store_claim():
+    """
+    Lease the next queued job (urgent first) sealed with this PC's key to
+    this process: (job, password), or None.
+    """
+    with _store_transaction() as db:
+        row = db.execute(
+            "SELECT secret, data FROM jobs WHERE status = 'queued' AND key_id = ? "
+            "ORDER BY priority DESC, created, id LIMIT 1",
+            (_store_key_id(),),
+        ).fetchone()
+        if row is None:
+            return None
+        job = json.loads(row[1])
+        try:
+            password = _unseal(row[0])
+        except ValueError:
+            job.update(status="failed", error="Mot de passe illisible dans la file partagée.")
+            db.execute("UPDATE jobs SET status = 'failed', finished = ?, secret = NULL, data = ? WHERE id = ?",
+                       (time.time(), json.dumps(job, ensure_ascii=False), job["id"]))
+            return None
+        job.update(status="running", worker=WORKER_ID)
+        db.execute(
+            "UPDATE jobs SET status = 'running', worker = ?, lease_until = ?, secret = NULL, data = ? WHERE id = ?",
+            (WORKER_ID, time.time() + JOB_LEASE_S, json.dumps(job, ensure_ascii=False), job["id"]),
+        )
+    return job, password
+
+
+def _store_heartbeat(job_id):
+    """
+    Extend this process's lease on a job. Returns (held, request): held is
+    False once the lease was lost (job reaped or gone), request the pending
+    user request, if any.
+    """
+    with _store_transaction() as db:
+        held = db.execute(f"UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? "
+                          f"AND status NOT IN ({_FINISHED_MARKS})",
+                          (time.time() + JOB_LEASE_S, job_id, WORKER_ID, *_FINISHED)).rowcount > 0
+        if not held:
+            return False, None
+        row = db.execute("SELECT request FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row[0]:
+            db.execute("UPDATE jobs SET request = NULL WHERE id = ?", (job_id,))
+    return True, row[0]
+
+
+def _store_request(job_id, action):
+    """
+    Record a cancel/pause/resume request for a store job. A queued job is
+    cancelled on the spot; others get it with their next heartbeat.
+    Returns (ok, error message).
+    """
+    with _store_transaction() as db:
+        row = db.execute("SELECT status, data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or row[0] in _FINISHED:
+            return False, "Travail introuvable ou déjà terminé."
+        status, job = row[0], json.loads(row[1])
+        if action == "pause" and status != "running":
+            return False, "Seul un travail en cours peut être mis en pause."
+        if action == "cancel" and status == "queued":
+            job.update(status="cancelled", cancel_requested=True)
+            db.execute("UPDATE jobs SET status = 'cancelled', finished = ?, secret = NULL, data = ? WHERE id = ?",
+                       (time.time(), json.dumps(job, ensure_ascii=False), job_id))
+            return True, None
+        if action == "resume" and status == "queued":
+            return True, None
+        flag, value = {"cancel": ("cancel_requested", True), "pause": ("pause_requested", True),
+                       "resume": ("pause_requested", False)}[action]
+        job[flag] = value
+        db.execute("UPDATE jobs SET request = ?, data = ? WHERE id = ?",
+                   (action, json.dumps(job, ensure_ascii=False), job_id))
+    return True, None
+
+
+def _store_reap():
+    """
+    Fail the jobs whose worker stopped renewing its lease (crashed, powered
+    off, cut off) and the jobs no worker claimed within JOB_QUEUE_EXPIRE_S.
+    """
+    expired = (datetime.now() - timedelta(seconds=JOB_QUEUE_EXPIRE_S)).strftime("%Y-%m-%d %H:%M:%S")
+    with _store_transaction() as db:
+        rows = db.execute(
+            "SELECT id, worker, data FROM jobs WHERE status IN ('running', 'paused') AND lease_until < ?",
+            (time.time(),),
+        ).fetchall()
+        stale = db.execute("SELECT id, NULL, data FROM jobs WHERE status = 'queued' AND created < ?",
+                           (expired,)).fetchall()
+        for job_id, worker, data in rows + stale:
+            job = json.loads(data)
+            error = (f"Poste {worker} injoignable, travail interrompu." if worker
+                     else "Aucun poste n'a pris le travail en charge, relancez-le.")
+            job.update(status="failed", error=error)
+            db.execute("UPDATE jobs SET status = 'failed', finished = ?, secret = NULL, data = ? WHERE id = ?",
+                       (time.time(), json.dumps(job, ensure_ascii=False), job_id))
+    return len(rows) + len(stale)
+
+
+def _store_finished_since(since):
+    """(finished, job) for the jobs any worker finished after since (a time.time() value)."""
+    rows = _store().execute("SELECT finished, data FROM jobs WHERE finished > ? ORDER BY finished",
+                            (since,)).fetchall()
+    return [(finished, json.loads(data)) for finished, data in rows]
+
+
+def _store_recent(limit):
+    """Every active job and the last `limit` finished ones, newest first."""
+    rows = _store().execute(
+        f"SELECT data FROM jobs WHERE status NOT IN ({_FINISHED_MARKS}) UNION ALL "
+        f"SELECT data FROM (SELECT data, created, id FROM jobs WHERE status IN ({_FINISHED_MARKS}) ORDER BY created DESC, id DESC LIMIT ?)",
+        (*_FINISHED, *_FINISHED, limit)).fetchall()
+    jobs = [json.loads(r[0]) for r in rows]
+    return sorted(jobs, key=lambda job: job["id"], reverse=True)
+
+
+def _store_active():
+    rows = _store().execute("SELECT data FROM jobs WHERE status IN ('queued', 'running', 'paused')").fetchall()
+    return [json.loads(r[0]) for r in rows]
+
+
+def _store_count(status):
+    return _store().execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+
+
+# ──────────────────────────────────────────────
+# Bilan matrix cache (one history sweep per user)
+# ──────────────────────────────────────────────
+# A sweep reads every history page once into script.fetch_bilan_matrix()'s
+# {code: dates} matrix, so any combination of codes and days is answered
+# from it. A user's own /run jobs change the history and drop the entry.
+MATRIX_CACHE_TTL_S = 10 * 60
+_matrix_cache = {}  # username -> {"key", "at", "day", "swept_at", "matrix"}
+_matrix_lock = threading.Lock()
+
+
+def _credentials_key(username, password):
+    # A cached sweep is only handed back to someone who could have run it
+    return hashlib.sha256(f"{username}\0{password}".encode("utf-8")).digest()
+
+
+def _cached_matrix(username, password):
+    with _matrix_lock:
+        entry = _matrix_cache.get(username)
+        if entry is None or entry["key"] != _credentials_key(username, password):
+            return None
+        if time.monotonic() - entry["at"] > MATRIX_CACHE_TTL_S or entry["day"] != date.today():
+            del _matrix_cache[username]
+            return None
+        return entry
+
+
+def _store_matrix(username, password, matrix):
+    entry = {
+        "key": _credentials_key(username, password),
+        "at": time.monotonic(),
+        "day": date.today(),
+        "swept_at": datetime.now().strftime("%H:%M"),
+        "matrix": matrix,
+    }
+    with _matrix_lock:
+        _matrix_cache[username] = entry
+    return entry
+
+
+def _invalidate_matrix(username):
+    with _matrix_lock:
+        _matrix_cache.pop(username, None)
+
+
+# ──────────────────────────────────────────────
+# Patient index (SQLite, fed by every scrape and job)
+# ──────────────────────────────────────────────
+# Backs IPP autocomplete without logging into SIH: /list-patients and
+# /fetch-patients upsert what they scraped, finished jobs upsert their IPPs
+# and booked codes. Dates are stored ISO so MAX() compares them correctly.
+_PATIENT_DB_FILE = "patients.db"
+PATIENT_SEARCH_LIMIT = 10
+_patient_db = None
+_patient_db_lock = threading.Lock()
+
+
+def _name_key(name):
+    """Lower-case, accent-free form of a name for searching."""
+    decomposed = unicodedata.normalize("NFKD", name or "")
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).lower()
+
+
+def _patients_db():
+    global _patient_db
+    if _patient_db is None:
+        db = sqlite3.connect(_PATIENT_DB_FILE, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS patients (
+                ip TEXT PRIMARY KEY,
+                name TEXT NOT NULL DEFAULT '',
+                name_key TEXT NOT NULL DEFAULT '',
+                last_seen TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS bilans (
+                ip TEXT NOT NULL,
+                code TEXT NOT NULL,
+                last_date TEXT NOT NULL,
+                PRIMARY KEY (ip, code)
+            );
+        """)
+        _patient_db = db
+    return _patient_db
+
+
+def _index_patients(patients, seen=None):
+    """
+    Upsert scraped patients: dicts with "ip", optional "name" and optional
+    "dates" ({code: [date, ...]} as in script.fetch_bilan_matrix()).
+    """
+    seen = seen or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    rows, bilans = [], []
+    for p in patients:
+        ip = p.get("ip")
+        if not ip:
+            continue
+        name = p.get("name") or ""
+        rows.append((ip, name, _name_key(name), seen))
+        for code, dates in (p.get("dates") or {}).items():
+            if dates:
+                bilans.append((ip, code, max(dates).isoformat()))
+    try:
+        with _patient_db_lock:
+            db = _patients_db()
+            with db:
+                db.executemany("""
+                    INSERT INTO patients (ip, name, name_key, last_seen) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(ip) DO UPDATE SET
+                        name = CASE WHEN excluded.name != '' THEN excluded.name ELSE name END,
+                        name_key = CASE WHEN excluded.name != '' THEN excluded.name_key ELSE name_key END,
+                        last_seen = MAX(last_seen, excluded.last_seen)
+                """, rows)
+                db.executemany("""
+                    INSERT INTO bilans (ip, code, last_date) VALUES (?, ?, ?)
+                    ON CONFLICT(ip, code) DO UPDATE SET last_date = MAX(last_date, excluded.last_date)
+                """, bilans)
+    except sqlite3.Error as exc:
+        log_if_enabled(f"[WARNING] Could not update patient index: {exc}")
+
+
+def _index_job(job, booked=True):
+    """
+    Record a job's IPPs and the codes booked for them on the job's dates:
+    the job's "booked" list when it has one, else every code when booked.
+    """
+    try:
+        booking_dates = [datetime.strptime(d, "%d/%m/%Y").date() for d in job.get("series") or [job["date"]]]
+    except (KeyError, ValueError):
+        booking_dates = None
+    codes_by_ip = {}
+    if booking_dates and "booked" in job:
+        for entry in job["booked"]:
+            codes_by_ip.setdefault(entry["ipp"], set()).add(entry["code"])
+    elif booking_dates and booked and _engine_mod is not None:
+        menu_config = _engine_mod.MENU_CONFIG
+        codes = {menu_config[b]["code"] for b in job.get("bookings", []) if b in menu_config}
+        codes_by_ip = {ip: codes for ip in job.get("ipp_list", [])}
+    _index_patients(
+        [{"ip": ip, "dates": {code: booking_dates for code in codes_by_ip.get(ip, ())}}
+         for ip in job.get("ipp_list", [])],
+        seen=job.get("timestamp"),
+    )
+
+
+def _search_patients(query, limit=PATIENT_SEARCH_LIMIT):
+    """Digits match IPP prefixes, anything else names (accents ignored); most recently seen first."""
+    query = query.strip()
+    if not query:
+        return []
+    with _patient_db_lock:
+        db = _patients_db()
+        if query.isdigit():
+            # Range scan on the primary key instead of LIKE, which would not use it
+            found = db.execute(
+                "SELECT ip, name, last_seen FROM patients WHERE ip >= ? AND ip < ? ORDER BY last_seen DESC LIMIT ?",
+                (query, query + "\uffff", limit),
+            ).fetchall()
+        else:
+            pattern = "%" + _name_key(query).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            found = db.execute(
+                "SELECT ip, name, last_seen FROM patients WHERE name_key LIKE ? ESCAPE '\\' "
+                "ORDER BY last_seen DESC LIMIT ?",
+                (pattern, limit),
+            ).fetchall()
+        bilans = {}
+        if found:
+            marks = ",".join("?" * len(found))
+            for ip, code, last_date in db.execute(
+                f"SELECT ip, code, last_date FROM bilans WHERE ip IN ({marks})", [row[0] for row in found]
+            ):
+                bilans.setdefault(ip, {})[code] = date.fromisoformat(last_date).strftime("%d/%m/%Y")
+    return [
+        {"ip": ip, "name": name, "last_seen": last_seen, "bilans": bilans.get(ip, {})}
+        for ip, name, last_seen in found
+    ]
+
+
+# ──────────────────────────────────────────────
+# IPP pre-validation (before a /run job books)
+# ──────────────────────────────────────────────
+# run_job() only meets an unknown or discharged IPP once it types it into the
+# booking page, whose waits have no timeout. IPPs are checked against the
+# episodes table, which one scrape resolves for the whole list at once.
+# With a recent scrape (/list-patients, /fetch-patients and earlier checks
+# refresh it) /run rejects the missing ones straight away; the user may
+# resubmit with force=1 to book them anyway (other ward, outpatient).
+# Otherwise /run starts a scrape in the background and queues the job, which
+# picks the result up (or scrapes itself) before its first booking and
+# leaves the missing IPPs unbooked ("unknown_ipps"). /run never waits on SIH.
+EPISODES_FRESH_S = 15 * 60
+PREVALIDATE_WAIT_S = 120  # how long a job waits for a scrape /run already started
+_episodes = {}  # username -> (monotonic, frozenset of hospitalised IPPs)
+_episode_scrapes = {}  # username -> {"browsing": Event, "done": Event} of the scrape in flight
+_episodes_lock = threading.Lock()
+
+
+def _remember_episodes(username, patients):
+    ips = frozenset(p["ip"] for p in patients if p.get("ip"))
+    with _episodes_lock:
+        _episodes[username] = (time.monotonic(), ips)
+    return ips
+
+
+def _fresh_episodes(username):
+    with _episodes_lock:
+        entry = _episodes.get(username)
+    if entry is not None and time.monotonic() - entry[0] <= EPISODES_FRESH_S:
+        return entry[1]
+    return None
+
+
+def _scrape_episodes(username, password, tag):
+    """One SIH scrape of the episodes table on the caller's slot; returns the hospitalised IPPs."""
+    t0 = time.perf_counter()
+    _watchdog.track(tag)
+    try:
+        patients = _browser_call("fetch_all_patients", username, password, browser_tag=_owned_tag(tag))
+    finally:
+        _watchdog.release(tag)
+    _index_patients(patients)
+    known = _remember_episodes(username, patients)
+    _step_seconds.observe(time.perf_counter() - t0, step="prevalidate", source="sih")
+    return known
+
+
+def _refresh_episodes(username, password):
+    """Scrape the episodes table in the background on a "validate" slot, unless a scrape is in flight."""
+    with _episodes_lock:
+        if username in _episode_scrapes:
+            return
+        scrape = _episode_scrapes[username] = {"browsing": threading.Event(), "done": threading.Event()}
+
+    def _bg():
+        ticket = None
+        try:
+            ticket = _acquire_slot("validate", timeout=FETCH_ADMISSION_WAIT_S)
+            if _fresh_episodes(username) is None:
+                scrape["browsing"].set()
+                _scrape_episodes(username, password, f"validate-{datetime.now().strftime('%Y%m%d%H%M%S%f')}")
+        except Exception as exc:
+            log_if_enabled(f"[WARNING] Vérification des IPP impossible pour {username} : {exc}")
+        finally:
+            if ticket is not None:
+                _governor.release(ticket)
+            with _episodes_lock:
+                _episode_scrapes.pop(username, None)
+            scrape["done"].set()
+
+    threading.Thread(target=_bg, daemon=True).start()
+
+
+def _check_cached(job):
+    """Resolve a job's IPPs from a recent scrape; False when there is none."""
+    known = _fresh_episodes(job["username"])
+    if known is None:
+        return False
+    fields = {"validation": "sih", "unknown_ipps": [ip for ip in job["ipp_list"] if ip not in known]}
+    job.update(fields)  # also when the job runs from the shared store
+    _update_job(job["id"], **fields)
+    return True
+
+
+def _validate_job(job, password):
+    """
+    Resolve a job's IPPs before it books: from the scrape /run started when
+    it already has a browser, else with one on the job's own slot. Raises
+    when none of them is hospitalised; a failed scrape leaves the job unchecked.
+    """
+    with _episodes_lock:
+        scrape = _episode_scrapes.get(job["username"])
+    if scrape is not None and scrape["browsing"].is_set():
+        scrape["done"].wait(PREVALIDATE_WAIT_S)
+    if not _check_cached(job):
+        try:
+            _scrape_episodes(job["username"], password, f"validate-{job['id']}")
+        except Exception as exc:
+            _update_job(job["id"], validation=f"non vérifiée ({exc})")
+            return
+        _check_cached(job)
+    if job.get("unknown_ipps") and not _bookable_ipps(job):
+        raise RuntimeError("Aucun IPP parmi les patients hospitalisés, rien n'a été réservé.")
+
+
+def _bookable_ipps(job):
+    """The IPPs a job books: its list without those pre-validation did not find."""
+    unknown = set(job.get("unknown_ipps") or ())
+    return [ip for ip in job["ipp_list"] if ip not in unknown]
+
+
+# ──────────────────────────────────────────────
+# Resource governor (admission control for Chromium)
+# ──────────────────────────────────────────────
+MAX_BROWSERS = 2               # Chromium instances allowed at once
+MIN_FREE_MEMORY_MB = 700       # RAM that must stay free for the OS and other apps
+BROWSER_MEMORY_MB = 400        # expected footprint of one Chromium
+MAX_QUEUED_JOBS = 20           # /run jobs allowed to wait for a slot
+FETCH_ADMISSION_WAIT_S = 15    # interactive endpoints give up after this long
+
+
+class GovernorBusy(Exception):
+    """No capacity available; retry_after is a best estimate in seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Occupé, réessayez dans {retry_after} s.")
+        self.retry_after = retry_after
+
+
+def _memory_mb():
+    """Return (available, total) system memory in MB, or (None, None) if unknown."""
+    if psutil is not None:
+        vm = psutil.virtual_memory()
+        return vm.available // 2**20, vm.total // 2**20
+    try:
+        info = {}
+        with open("/proc/meminfo", "r", encoding="ascii") as fh:
+            for line in fh:
+                key, value = line.split(":", 1)
+                info[key] = int(value.split()[0])
+        return info["MemAvailable"] // 1024, info["MemTotal"] // 1024
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _process_tree_rss_mb():
+    """RSS of web.py and everything it spawned (drivers, Chromium), in MB."""
+    if psutil is None:
+        return None
+    try:
+        me = psutil.Process()
+        total = me.memory_info().rss
+        for child in me.children(recursive=True):
+            try:
+                total += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return total // 2**20
+    except psutil.Error:
+        return None
+
+
+class ResourceGovernor:
+    """
+    Hands out browser slots in FIFO order, urgent requests ahead of normal
+    ones, only while the process budget (MAX_BROWSERS, lowered by the SIH
+    load control) and the memory budget (MIN_FREE_MEMORY_MB left after one
+    more BROWSER_MEMORY_MB) both allow it.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._active = {}      # ticket -> (kind, started monotonic)
+        self._waiting = []     # tickets in admission order
+        self._urgent = set()   # waiting tickets of the urgent lane
+        self._next_ticket = 0
+        self._hold_s = {}      # kind -> smoothed time a slot is held
+        self._browser_mb = None  # smoothed measured peak of one browser tree
+
+    def browser_memory_mb(self):
+        """Expected footprint of one more browser: measured when known, else the default."""
+        return self._browser_mb or BROWSER_MEMORY_MB
+
+    def observe_browser_peak(self, peak_mb):
+        with self._cond:
+            prev = self._browser_mb
+            self._browser_mb = peak_mb if prev is None else int(0.7 * prev + 0.3 * peak_mb)
+
+    def capacity(self):
+        """Browsers allowed at once right now."""
+        return min(MAX_BROWSERS, _sih_load.limit())
+
+    def in_use(self):
+        with self._cond:
+            return len(self._active)
+
+    def wake(self):
+        """Re-check waiting requests (the capacity went up)."""
+        with self._cond:
+            self._cond.notify_all()
+
+    def _has_capacity(self):
+        if len(self._active) >= self.capacity():
+            return False
+        available, _ = _memory_mb()
+        if available is not None and self._active and available - self.browser_memory_mb() < MIN_FREE_MEMORY_MB:
+            # Never block the very first browser on memory alone
+            return False
+        return True
+
+    def retry_after(self):
+        """Seconds until a slot is likely to free up."""
+        with self._cond:
+            now = time.monotonic()
+            remaining = [
+                self._hold_s.get(kind, 60) - (now - started)
+                for kind, started in self._active.values()
+            ]
+            wait = min(remaining) if remaining else 0
+            per_slot = max(self._hold_s.values(), default=60) / max(self.capacity(), 1)
+            return int(max(5, wait + per_slot * len(self._waiting)))
+
+    def queued(self):
+        with self._cond:
+            return len(self._waiting)
+
+    def acquire(self, kind, timeout=None, urgent=False, abort=None):
+        """
+        Wait for a slot and return its ticket. Raise GovernorBusy if none is
+        granted within timeout seconds (None = wait as long as needed).
+        Urgent requests queue behind other urgent ones only. Return None if
+        the abort event is set while waiting.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            if urgent:
+                position = next((i for i, t in enumerate(self._waiting) if t not in self._urgent), len(self._waiting))
+                self._waiting.insert(position, ticket)
+                self._urgent.add(ticket)
+            else:
+                self._waiting.append(ticket)
+            try:
+                while not (self._waiting[0] == ticket and self._has_capacity()):
+                    if abort is not None and abort.is_set():
+                        return None
+                    left = None if deadline is None else deadline - time.monotonic()
+                    if left is not None and left <= 0:
+                        raise GovernorBusy(self._retry_after_locked())
+                    # Memory is not signalled, so re-check it periodically
+                    self._cond.wait(1.0 if left is None else min(left, 1.0))
+            finally:
+                self._waiting.remove(ticket)
+                self._urgent.discard(ticket)
+                self._cond.notify_all()
+            self._active[ticket] = (kind, time.monotonic())
+            return ticket
+
+    def _retry_after_locked(self):
+        self._cond.release()
+        try:
+            return self.retry_after()
+        finally:
+            self._cond.acquire()
+
+    def release(self, ticket):
+        with self._cond:
+            kind, started = self._active.pop(ticket)
+            held = time.monotonic() - started
+            prev = self._hold_s.get(kind)
+            self._hold_s[kind] = held if prev is None else 0.7 * prev + 0.3 * held
+            self._cond.notify_all()
+
+    def snapshot(self):
+        available, total = _memory_mb()
+        with self._cond:
+            return {
+                "browsers": len(self._active),
+                "max_browsers": MAX_BROWSERS,
+                "capacity": self.capacity(),
+                "queued": len(self._waiting),
+                "queued_urgent": len(self._urgent),
+                "memory_available_mb": available,
+                "memory_total_mb": total,
+                "min_free_memory_mb": MIN_FREE_MEMORY_MB,
+                "browser_memory_mb": self.browser_memory_mb(),
+                "hosix_rss_mb": _process_tree_rss_mb(),
+            }
+
+
+_governor = ResourceGovernor()
+
+
+def _busy_response(retry_after):
+    resp = jsonify({"error": f"Occupé, réessayez dans {retry_after} s.", "retry_after": retry_after})
+    resp.status_code = 503
+    resp.headers["Retry-After"] = str(retry_after)
+    return resp
+
+
+# ──────────────────────────────────────────────
+# SIH load control (AIMD)
+# ──────────────────────────────────────────────
+# Every browser works against the same hospital SIH, which clinicians use
+# too. Postback server times (PRM beginRequest to endRequest), timeouts
+# and failed steps, from all jobs, sweeps and lookups, are judged per
+# window: a healthy window with the limit in use raises the number of
+# browsers by one, a degraded one
+# (slow p90 against the healthy baseline, or too many errors) cuts it by
+# SIH_BACKOFF. The governor never runs more browsers than this limit.
+SIH_MIN_CONCURRENCY = 1        # floor
+SIH_MAX_CONCURRENCY = 4        # ceiling, never above MAX_BROWSERS
+SIH_WINDOW_S = 30
+SIH_WINDOW_MIN_SAMPLES = 10    # fewer postbacks: the window is not judged
+SIH_LATENCY_FACTOR = 2.0       # degraded: p90 over factor * healthy baseline p50...
+SIH_LATENCY_FLOOR_S = 1.0      # ...and over this
+SIH_ERROR_RATE = 0.05          # degraded: timeouts + failed steps over this share
+SIH_BACKOFF = 0.5
+
+
+class SihLoadControl:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._limit = self._ceiling()
+        self._baseline_s = None  # EWMA of the p50 of healthy windows
+        self._window_start = time.monotonic()
+        self._latencies = []
+        self._errors = 0
+        self._peak_in_use = 0
+        self._last = None
+
+    @staticmethod
+    def _ceiling():
+        return max(SIH_MIN_CONCURRENCY, min(SIH_MAX_CONCURRENCY, MAX_BROWSERS))
+
+    def limit(self):
+        return self._limit
+
+    def observe_latency(self, seconds):
+        self._add(seconds, 0)
+
+    def observe_error(self):
+        self._add(None, 1)
+
+    def _add(self, seconds, errors):
+        with self._lock:
+            if seconds is not None:
+                self._latencies.append(seconds)
+            self._errors += errors
+            self._peak_in_use = max(self._peak_in_use, _governor.in_use())
+            if time.monotonic() - self._window_start < SIH_WINDOW_S:
+                return
+            changed = self._judge()
+        if changed:
+            _governor.wake()
+
+    def _judge(self):
+        """Close the window: adjust the limit; return True if it went up."""
+        latencies, errors, in_use = sorted(self._latencies), self._errors, self._peak_in_use
+        self._latencies, self._errors, self._peak_in_use = [], 0, 0
+        self._window_start = time.monotonic()
+        samples = len(latencies) + errors
+        if samples < SIH_WINDOW_MIN_SAMPLES:
+            return False
+        p50 = latencies[len(latencies) // 2] if latencies else None
+        p90 = latencies[math.ceil(0.9 * len(latencies)) - 1] if latencies else None
+        error_rate = errors / samples
+        slow = p90 is not None and self._baseline_s is not None and \
+            p90 > max(SIH_LATENCY_FACTOR * self._baseline_s, SIH_LATENCY_FLOOR_S)
+        previous = self._limit
+        if slow or error_rate > SIH_ERROR_RATE:
+            self._limit = max(SIH_MIN_CONCURRENCY, int(self._limit * SIH_BACKOFF))
+            decision = "backoff"
+        else:
+            if p50 is not None:
+                self._baseline_s = p50 if self._baseline_s is None else 0.9 * self._baseline_s + 0.1 * p50
+            # Only raise a limit the window actually reached: idle windows prove nothing
+            if in_use >= self._limit:
+                self._limit = min(self._ceiling(), self._limit + 1)
+            decision = "increase" if self._limit > previous else "hold"
+        self._last = {"samples": samples, "p50_s": p50, "p90_s": p90, "error_rate": round(error_rate, 3),
+                      "in_use": in_use, "decision": decision}
+        if self._limit != previous:
+            _sih_limit_changes.inc(direction="down" if self._limit < previous else "up")
+            log_if_enabled(f"[INFO] Limite SIH : {previous} -> {self._limit} navigateur(s) "
+                           f"(p90 {p90 if p90 is None else round(p90, 2)} s, erreurs {error_rate:.0%})")
+        return self._limit > previous
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "limit": self._limit,
+                "floor": SIH_MIN_CONCURRENCY,
+                "ceiling": self._ceiling(),
+                "baseline_p50_s": None if self._baseline_s is None else round(self._baseline_s, 3),
+                "last_window": self._last,
+            }
+
+
+_sih_load = SihLoadControl()
+
+
+# ──────────────────────────────────────────────
+# Per-job browser memory/CPU accounting
+# ──────────────────────────────────────────────
+SAMPLE_INTERVAL_S = 1.0
+
+
+def _tagged_browser_tree(tag):
+    """
+    Processes of the Chromium launched with --hosix-tag=<tag> (see
+    script.launch_browser), including its renderers/GPU/utility children.
+    Only web.py's own descendants are scanned.
+    """
+    marker = f"--hosix-tag={_owned_tag(tag)}"
+    tree = {}
+    try:
+        descendants = psutil.Process().children(recursive=True)
+    except psutil.Error:
+        return []
+    for proc in descendants:
+        try:
+            if marker in proc.cmdline():
+                tree[proc.pid] = proc
+                for child in proc.children(recursive=True):
+                    tree[child.pid] = child
+        except psutil.Error:
+            continue
+    return list(tree.values())
+
+
+class JobResourceSampler:
+    """
+    Samples the browser process tree of one job in a background thread and
+    reports peak RSS, total CPU time and peak process count on stop().
+    """
+
+    def __init__(self, tag, profile):
+        self.tag = tag
+        self.profile = profile
+        self._stop = threading.Event()
+        self._thread = None
+        self._peak_rss = 0
+        self._peak_procs = 0
+        self._cpu = {}      # pid -> last seen user+system CPU seconds
+        self._samples = 0
+        self._started = None
+
+    def start(self):
+        self._started = time.monotonic()
+        if psutil is not None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def _sample(self):
+        rss = 0
+        procs = _tagged_browser_tree(self.tag)
+        for proc in procs:
+            try:
+                rss += proc.memory_info().rss
+                times = proc.cpu_times()
+                self._cpu[proc.pid] = times.user + times.system
+            except psutil.Error:
+                continue
+        if procs:
+            self._samples += 1
+        self._peak_rss = max(self._peak_rss, rss)
+        self._peak_procs = max(self._peak_procs, len(procs))
+
+    def _run(self):
+        while not self._stop.wait(SAMPLE_INTERVAL_S):
+            self._sample()
+
+    def stop(self):
+        """Stop sampling and return the measurements for the job record."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        result = {
+            "profile": self.profile,
+            "duration_s": round(time.monotonic() - self._started, 1),
+        }
+        if psutil is not None and self._samples:
+            result.update({
+                "peak_rss_mb": self._peak_rss // 2**20,
+                "cpu_s": round(sum(self._cpu.values()), 1),
+                "peak_processes": self._peak_procs,
+            })
+            _governor.observe_browser_peak(self._peak_rss // 2**20)
+        return result
+
+
+def _effective_profile():
+    engine = _engine()
+    return engine.LAUNCH_PROFILE if engine.HEADLESS else "standard"
+
+
+# ──────────────────────────────────────────────
+# Browser watchdog (orphan reaper & leak trends)
+# ──────────────────────────────────────────────
+WATCHDOG_INTERVAL_S = 60       # periodic sweep for leaked Chromium/driver processes
+ORPHAN_GRACE_S = 120           # untracked processes younger than this are left alone
+ORPHAN_SCAN_INTERVAL_S = 15 * 60  # whole-machine scan for browsers of dead web/worker processes
+JOB_MAX_DURATION_S = 3 * 3600  # browsers of longer jobs are killed (job fails)
+_CHROME_NAMES = ("chrome", "chromium", "headless_shell")
+
+
+def _is_chrome(proc):
+    try:
+        name = (proc.name() or "").lower()
+    except psutil.Error:
+        return False
+    return any(n in name for n in _CHROME_NAMES)
+
+
+def _owned_tag(name):
+    """
+    The --hosix-tag to launch a browser with for name (a job id, "fetch-...").
+    It starts with this process's pid, so that the watchdogs of other web or
+    worker processes on the same PC leave the browser alone.
+    """
+    return f"{os.getpid()}.{name}"
+
+
+def _tag_owner(tag):
+    """(owner pid, name) of a browser tag; (None, tag) for tags without an owner."""
+    pid, sep, name = tag.partition(".")
+    if sep and pid.isdigit():
+        return int(pid), name
+    return None, tag
+
+
+def _owner_alive(pid, browser_started):
+    """
+    Whether the web/worker process that launched a browser started at
+    browser_started still runs: a process now holding its pid but started
+    after the browser only reuses the pid.
+    """
+    try:
+        return psutil.Process(pid).create_time() <= browser_started
+    except psutil.NoSuchProcess:
+        return False
+    except psutil.Error:
+        return True  # cannot tell: leave its browsers alone
+
+
+def _browser_tag(proc):
+    """Return the --hosix-tag of a browser main process, "" if untagged, None if not one."""
+    try:
+        cmdline = proc.cmdline()
+    except psutil.Error:
+        return None
+    if any(arg.startswith("--type=") for arg in cmdline):
+        return None  # renderer/GPU/utility child, handled with its browser
+    for arg in cmdline:
+        if arg.startswith("--hosix-tag="):
+            return arg.split("=", 1)[1]
+    return ""
+
+
+def _kill_tree(root):
+    """Kill a process and its descendants; return how many were killed."""
+    try:
+        procs = root.children(recursive=True) + [root]
+    except psutil.Error:
+        return 0
+    for proc in procs:
+        try:
+            proc.kill()
+        except psutil.Error:
+            pass
+    gone, _ = psutil.wait_procs(procs, timeout=5)
+    return len(gone)
+
+
+class BrowserWatchdog:
+    """
+    Tracks the browser of every job by its --hosix-tag (see _owned_tag).
+    Leftover processes are killed when the job ends, when it has run
+    JOB_MAX_DURATION_S (pauses excluded), and by a periodic sweep that
+    also catches untagged Chromium below web.py and tagged Chromium
+    re-parented after its driver died. Sweeps look at our own process
+    tree and the browsers seen in it before; only every
+    ORPHAN_SCAN_INTERVAL_S do they scan the whole machine. Browsers of
+    other live web/worker processes are never touched: a foreign tag is
+    only reaped once its owner is gone (see _owner_alive). Each sweep
+    records process counts and RSS so leaks show up as a trend.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._live = {}                  # tag -> deadline (monotonic)
+        self._paused = {}                # tag -> start of its pause (monotonic)
+        self._timed_out = set()
+        self._leaked_total = 0
+        self._trend = deque(maxlen=24 * 60)  # one point per sweep, ~24 h
+        self._seen = {}                  # pid -> (process, tag) of browsers once below us
+        self._last_scan = None           # monotonic time of the last whole-machine scan
+
+    def track(self, tag):
+        with self._lock:
+            self._live[tag] = time.monotonic() + JOB_MAX_DURATION_S
+
+    def suspend(self, tag):
+        """A paused job does not expire; its deadline moves back on resume()."""
+        with self._lock:
+            if tag in self._live:
+                self._paused.setdefault(tag, time.monotonic())
+
+    def resume(self, tag):
+        with self._lock:
+            paused_at = self._paused.pop(tag, None)
+            if paused_at is not None and tag in self._live:
+                self._live[tag] += time.monotonic() - paused_at
+
+    def release(self, tag):
+        """Forget a finished job and kill whatever its browser left behind."""
+        with self._lock:
+            self._live.pop(tag, None)
+            self._paused.pop(tag, None)
+        if psutil is None:
+            return
+        killed = self._kill_tagged({tag})
+        if killed:
+            with self._lock:
+                self._leaked_total += killed
+            log_if_enabled(f"[WARNING] Watchdog: {killed} processus orphelin(s) tué(s) pour {tag}")
+
+    def timed_out(self, tag):
+        with self._lock:
+            return tag in self._timed_out
+
+    def _browser_roots(self, scan=False):
+        """
+        (process, tag) for every Chromium main process that may be ours: our
+        descendants, those seen among them before (re-parented once their
+        driver died, they keep their tag) and, with scan, every tagged one
+        on the machine, which finds those of web/worker processes that died.
+        """
+        roots = {}
+        try:
+            for proc in psutil.Process().children(recursive=True):
+                if _is_chrome(proc):
+                    tag = _browser_tag(proc)
+                    if tag is not None:
+                        roots[proc.pid] = (proc, tag)
+        except psutil.Error:
+            pass
+        with self._lock:
+            for pid, (proc, tag) in list(self._seen.items()):
+                if pid in roots:
+                    continue
+                if tag and proc.is_running():  # is_running() also rules out a reused pid
+                    roots[pid] = (proc, tag)
+                else:
+                    del self._seen[pid]
+            self._seen.update(roots)
+        if scan:
+            for proc in psutil.process_iter(["name"]):
+                if proc.pid not in roots and _is_chrome(proc):
+                    tag = _browser_tag(proc)
+                    if tag:
+                        roots[proc.pid] = (proc, tag)
+        return list(roots.values())
+
+    def _idle_drivers(self):
+        """Playwright driver processes of ours that have no browser left."""
+        drivers = []
+        try:
+            for proc in psutil.Process().children():
+                try:
+                    if "run-driver" in " ".join(proc.cmdline()) and not proc.children():
+                        drivers.append(proc)
+                except psutil.Error:
+                    continue
+        except psutil.Error:
+            pass
+        return drivers
+
+    def _kill_tagged(self, names):
+        tags = {_owned_tag(name) for name in names}
+        killed = 0
+        for proc, tag in self._browser_roots():
+            if tag in tags:
+                killed += _kill_tree(proc)
+        return killed
+
+    def sweep(self):
+        """Kill expired and orphaned browsers, then record a trend point."""
+        now = time.monotonic()
+        with self._lock:
+            expired = {tag for tag, deadline in self._live.items() if deadline < now and tag not in self._paused}
+            self._timed_out |= expired
+            live = set(self._live) - expired
+        scan = self._last_scan is None or now - self._last_scan >= ORPHAN_SCAN_INTERVAL_S
+        if scan:
+            self._last_scan = now
+        killed = 0
+        chrome_count = 0
+        for proc, tag in self._browser_roots(scan):
+            owner, name = _tag_owner(tag)
+            try:
+                started = proc.create_time()
+                if owner in (None, os.getpid()):  # the trend counts ours, whether or not this sweep scans
+                    chrome_count += 1 + len(proc.children(recursive=True))
+            except psutil.Error:
+                continue
+            age = time.time() - started
+            if owner == os.getpid():
+                orphan = name not in live
+            elif owner is not None:
+                orphan = not _owner_alive(owner, started)  # its web/worker process died
+            else:
+                orphan = tag == ""  # untagged below web.py; unknown tags belong to someone else
+            if (owner == os.getpid() and name in expired) or (orphan and age > ORPHAN_GRACE_S):
+                killed += _kill_tree(proc)
+        if not live:
+            # With no job running, any remaining driver is a leftover
+            for proc in self._idle_drivers():
+                try:
+                    if time.time() - proc.create_time() > ORPHAN_GRACE_S:
+                        killed += _kill_tree(proc)
+                except psutil.Error:
+                    continue
+        available, _ = _memory_mb()
+        with self._lock:
+            self._leaked_total += killed
+            self._trend.append({
+                "t": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "chrome_processes": chrome_count,
+                "killed": killed,
+                "hosix_rss_mb": _process_tree_rss_mb(),
+                "memory_available_mb": available,
+            })
+        if killed:
+            log_if_enabled(f"[WARNING] Watchdog: {killed} processus Chromium orphelin(s) tué(s)")
+
+    def run_forever(self):
+        if psutil is None:
+            return
+        while True:
+            time.sleep(WATCHDOG_INTERVAL_S)
+            try:
+                self.sweep()
+            except Exception as exc:
+                log_if_enabled(f"[WARNING] Watchdog sweep failed: {exc}")
+
+    def trend(self):
+        with self._lock:
+            return list(self._trend)
+
+    def snapshot(self):
+        """Totals plus RSS/process drift over the last hour of sweeps."""
+        with self._lock:
+            points = list(self._trend)[-60:]
+            summary = {
+                "live_jobs": len(self._live),
+                "leaked_killed_total": self._leaked_total,
+                "sweeps": len(self._trend),
+            }
+        if points:
+            summary["chrome_processes"] = points[-1]["chrome_processes"]
+            rss = [p["hosix_rss_mb"] for p in points if p["hosix_rss_mb"] is not None]
+            if len(rss) >= 2:
+                summary["rss_change_1h_mb"] = rss[-1] - rss[0]
+        return summary
+
+
+_watchdog = BrowserWatchdog()
+
+
+# ──────────────────────────────────────────────
+# Metrics (Prometheus text format, scraped from /metrics)
+# ──────────────────────────────────────────────
+# Step durations come from script.timed_step through script.OBSERVERS; job
+# outcomes and admission waits are counted here. Everything lives in memory
+# and restarts from zero with the server, as Prometheus counters expect.
+LATENCY_BUCKETS_S = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_str(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in labels.items()) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+        self._values = {}  # sorted label items -> value
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_str(dict(key))} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS_S):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}  # sorted label items -> [count per bucket..., sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                labels = dict(key)
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_label_str({**labels, 'le': bound})} {count}")
+                lines.append(f"{self.name}_bucket{_label_str({**labels, 'le': '+Inf'})} {series[-1]}")
+                lines.append(f"{self.name}_sum{_label_str(labels)} {round(series[-2], 6)}")
+                lines.append(f"{self.name}_count{_label_str(labels)} {series[-1]}")
+        return lines
+
+
+def _gauge(name, help_text, value):
+    if value is None:
+        return []
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+
+
+_step_seconds = Histogram(
+    "hosix_step_duration_seconds",
+    "Duration of successful SIH steps (login, booking per code, history_lookup).",
+)
+_step_failures = Counter("hosix_step_failures_total", "SIH steps that raised an error.")
+_jobs_total = Counter("hosix_jobs_total", "Finished browser jobs by kind and status.")
+_admission_seconds = Histogram(
+    "hosix_admission_wait_seconds",
+    "Time spent waiting for a browser slot.",
+    buckets=(0.1, 1, 5, 15, 30, 60, 300, 900),
+)
+_busy_total = Counter("hosix_busy_rejections_total", "Requests rejected with 503 because no slot was free.")
+_wait_seconds = Histogram(
+    "hosix_wait_duration_seconds",
+    "Element waits by key (selector) and whether the element showed up.",
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60),
+)
+_race_seconds = Histogram(
+    "hosix_race_duration_seconds",
+    "Multi-outcome waits (script.wait_first) by race and the outcome that resolved first.",
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60),
+)
+_postback_seconds = Histogram(
+    "hosix_postback_duration_seconds",
+    "Postback waits (script.wait_postback) by step and how they finished.",
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60),
+)
+_postback_saving_seconds = Histogram(
+    "hosix_postback_saving_seconds",
+    "Extra time networkidle took after the postback had finished (only with POSTBACK_MEASURE_SAVINGS).",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10),
+)
+
+_asset_cache_total = Counter(
+    "hosix_asset_cache_requests_total",
+    "Static SIH assets by how the disk cache answered (hit, revalidated, miss, bypass).",
+)
+_asset_cache_bytes_saved = Counter(
+    "hosix_asset_cache_bytes_saved_total",
+    "Bytes of static SIH assets served from the disk cache instead of the network.",
+)
+_sih_limit_changes = Counter("hosix_sih_limit_changes_total", "Changes of the SIH concurrency limit by direction.")
+_eta_ratio = Histogram(
+    "hosix_eta_ratio",
+    "Actual / predicted run time of completed /run jobs (drift of the duration model).",
+    buckets=(0.5, 0.75, 0.9, 1.1, 1.25, 1.5, 2, 3),
+)
+
+
+def _observe_step(kind, name, value, labels):
+    """script.OBSERVERS hook: failed steps are counted, not mixed into latencies."""
+    if kind == "wait":
+        _wait_seconds.observe(value, wait=name, found=str(bool(labels.get("found"))).lower())
+        return
+    if kind == "race":
+        _race_seconds.observe(value, race=name, outcome=labels.get("outcome", ""))
+        return
+    if kind == "postback":
+        _postback_seconds.observe(value, step=name, outcome=labels.get("outcome", ""))
+        if labels.get("outcome") == "timeout":
+            _sih_load.observe_error()
+        elif labels.get("server_s") is not None:
+            _sih_load.observe_latency(labels["server_s"])  # the SIH's time only, not our element waits
+        return
+    if kind == "postback_saving":
+        _postback_saving_seconds.observe(value, step=name)
+        return
+    if kind == "asset_cache":
+        _asset_cache_total.inc(outcome=name)
+        _asset_cache_bytes_saved.inc(value)
+        return
+    if kind != "step":
+        return
+    labels = dict(labels)
+    if labels.pop("ok", True):
+        _step_seconds.observe(value, step=name, **labels)
+    else:
+        _step_failures.inc(step=name, **labels)
+        _sih_load.observe_error()
+
+
+def _acquire_slot(kind, timeout=None, urgent=False, abort=None, since=None):
+    """
+    _governor.acquire that also records the admission wait. since: when a
+    caller that keeps retrying (the urgent lane) started waiting; its
+    timeouts are then not rejections, and only the admission is recorded.
+    """
+    t0 = time.perf_counter() if since is None else since
+    try:
+        ticket = _governor.acquire(kind, timeout=timeout, urgent=urgent, abort=abort)
+    except GovernorBusy:
+        if since is None:
+            _busy_total.inc(kind=kind)
+            _admission_seconds.observe(time.perf_counter() - t0, kind=kind)
+        raise
+    if since is None or ticket is not None:
+        _admission_seconds.observe(time.perf_counter() - t0, kind=kind)
+    return ticket
+
+
+def _render_metrics():
+    resources = _governor.snapshot()
+    watchdog = _watchdog.snapshot()
+    lines = []
+    for metric in (_step_seconds, _step_failures, _jobs_total, _admission_seconds, _busy_total, _wait_seconds,
+                   _race_seconds, _postback_seconds, _postback_saving_seconds, _eta_ratio,
+                   _asset_cache_total, _asset_cache_bytes_saved, _sih_limit_changes):
+        lines += metric.render()
+    if _engine_mod is not None:
+        # Adaptive timeouts: learned p99 and the timeout currently applied to optional waits
+        latency = _engine_mod.LATENCY
+        learned = [(key, st) for key, st in sorted(latency.snapshot().items()) if st["p99_ms"] is not None]
+        lines += ["# HELP hosix_wait_p99_seconds Rolling p99 of successful waits.",
+                  "# TYPE hosix_wait_p99_seconds gauge"]
+        lines += [f"hosix_wait_p99_seconds{_label_str({'wait': key})} {st['p99_ms'] / 1000}" for key, st in learned]
+        lines += ["# HELP hosix_wait_timeout_seconds Timeout an optional wait on this key would use now.",
+                  "# TYPE hosix_wait_timeout_seconds gauge"]
+        lines += [
+            f"hosix_wait_timeout_seconds{_label_str({'wait': key})} {latency.timeout_ms(key, _engine_mod.SOFT_TIMEOUT_MS) / 1000}"
+            for key, _ in learned
+        ]
+    lines += _gauge("hosix_queue_depth", "Jobs waiting for a browser slot.", resources["queued"])
+    lines += _gauge("hosix_active_browsers", "Browser slots in use.", resources["browsers"])
+    lines += _gauge("hosix_max_browsers", "Browser slots available.", resources["max_browsers"])
+    lines += _gauge("hosix_browser_capacity", "Browser slots usable now (MAX_BROWSERS and the SIH limit).",
+                    resources["capacity"])
+    lines += _gauge("hosix_sih_concurrency_limit", "Browsers the SIH load control allows.", _sih_load.limit())
+    lines += _gauge("hosix_memory_available_mb", "Free system memory.", resources["memory_available_mb"])
+    lines += _gauge("hosix_rss_mb", "RSS of web.py and its browsers.", resources["hosix_rss_mb"])
+    lines += _gauge("hosix_browser_memory_mb", "Expected footprint of one browser.", resources["browser_memory_mb"])
+    lines += _gauge("hosix_chrome_processes", "Chromium processes seen by the last sweep.", watchdog.get("chrome_processes"))
+    lines += [
+        "# HELP hosix_leaked_processes_killed_total Leftover browser processes killed by the watchdog.",
+        "# TYPE hosix_leaked_processes_killed_total counter",
+        f"hosix_leaked_processes_killed_total {watchdog['leaked_killed_total']}",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+# ──────────────────────────────────────────────
+# Duration model (predicted duration and ETA of /run jobs)
+# ──────────────────────────────────────────────
+# Learned from the jobs this process runs, through the _JobControl hooks:
+# login (browser start to first IPP), booking per code (one date, plus each
+# extra date of a series) and the rest of an IPP (search, close). Segments a
+# pause or urgent work cut into are not learned. The ETA of a queued job
+# replays the queue over the browser slots; it is rounded so /jobs can
+# still revalidate to a 304 between polls.
+ETA_MODEL_FILE = "eta.json"
+ETA_ALPHA = 0.2        # weight of the newest observation (EWMA)
+ETA_ROUND_S = 10
+_ETA_DEFAULTS = {"login": 20.0, "ipp": 15.0, "booking": 40.0, "extra_date": 8.0}
+
+
+class DurationModel:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._costs = {}   # "login" / "ipp" / "extra_date" / "code:<code>" -> [EWMA seconds, samples]
+        self._drift = None  # EWMA of actual / predicted run time
+        self._dirty = False
+        try:
+            with open(path, "r", encoding="utf-8") as fh:
+                data = json.load(fh)
+            self._costs = {k: list(v) for k, v in data["costs"].items()}
+            self._drift = data.get("drift")
+        except (OSError, ValueError, KeyError, AttributeError, TypeError):
+            pass
+
+    def _learn(self, key, seconds):
+        if seconds <= 0:
+            return
+        with self._lock:
+            entry = self._costs.get(key)
+            if entry is None:
+                self._costs[key] = [seconds, 1]  # the first sample replaces the default
+            else:
+                entry[0] += ETA_ALPHA * (seconds - entry[0])
+                entry[1] += 1
+            self._dirty = True
+
+    def _cost(self, key, default):
+        with self._lock:
+            entry = self._costs.get(key)
+        return entry[0] if entry else default
+
+    def learn_login(self, seconds):
+        self._learn("login", seconds)
+
+    def learn_ipp_overhead(self, seconds):
+        self._learn("ipp", seconds)
+
+    def learn_booking(self, code, n_dates, seconds):
+        """One code booked at n_dates date-times: the extra dates are learned once the code's base cost is known."""
+        if n_dates > 1 and self._cost(f"code:{code}", None) is not None:
+            self._learn("extra_date", (seconds - self._cost(f"code:{code}", 0)) / (n_dates - 1))
+        else:
+            self._learn(f"code:{code}", seconds - self._cost("extra_date", _ETA_DEFAULTS["extra_date"]) * (n_dates - 1))
+
+    def booking_s(self, code, n_dates):
+        return (self._cost(f"code:{code}", _ETA_DEFAULTS["booking"])
+                + self._cost("extra_date", _ETA_DEFAULTS["extra_date"]) * (n_dates - 1))
+
+    def ipp_s(self, codes, n_dates):
+        return self._cost("ipp", _ETA_DEFAULTS["ipp"]) + sum(self.booking_s(code, n_dates) for code in codes)
+
+    def predict(self, job):
+        """
+        {"login_s", "ipp_s", "total_s"} for a whole job (login included), or
+        None while the engine, whose booking plan this needs, is still being
+        imported: pages show no ETA rather than wait for it.
+        """
+        engine = _engine_mod
+        if engine is None:
+            return None
+        items = [b for b in job["bookings"] if b in engine.MENU_CONFIG]
+        codes = [code for code, _ in engine.compute_booking_plan(items)]
+        login = self._cost("login", _ETA_DEFAULTS["login"])
+        per_ipp = self.ipp_s(codes, len(_job_dates_08(job)))
+        return {"login_s": login, "ipp_s": per_ipp, "total_s": login + per_ipp * len(job["ipp_list"])}
+
+    def observe_job(self, predicted_s, actual_s):
+        """Track how far real run times drift from the model's predictions."""
+        if predicted_s <= 0:
+            return
+        ratio = actual_s / predicted_s
+        _eta_ratio.observe(ratio)
+        with self._lock:
+            self._drift = ratio if self._drift is None else self._drift + ETA_ALPHA * (ratio - self._drift)
+            self._dirty = True
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "costs_s": {k: round(v[0], 1) for k, v in sorted(self._costs.items())},
+                "samples": {k: v[1] for k, v in sorted(self._costs.items())},
+                "defaults_s": dict(_ETA_DEFAULTS),
+                "drift": None if self._drift is None else round(self._drift, 2),
+            }
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps({"costs": self._costs, "drift": self._drift})
+            self._dirty = False
+        tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as fh:
+                fh.write(data)
+            os.replace(tmp, self.path)
+        except OSError as exc:
+            log_if_enabled(f"[WARNING] Could not save duration model: {exc}")
+
+
+_durations = DurationModel(ETA_MODEL_FILE)
+
+
+def _round_eta(seconds):
+    return int(max(0, round(seconds / ETA_ROUND_S)) * ETA_ROUND_S)
+
+
+def _remaining_s(job, now):
+    """Predicted seconds left for a job, from its progress fields (works for store jobs too)."""
+    plan = _durations.predict(job)
+    if job.get("injected_into") and job["status"] != "queued":
+        plan["total_s"] -= plan["login_s"]  # runs on the batch's logged-in page
+    if job["status"] == "queued" or not (job.get("started_at") or job.get("ipps_started")):
+        return plan["total_s"]
+    left = len(job["ipp_list"]) - job.get("ipps_done", 0)
+    if not job.get("ipps_started"):
+        return max(0.0, plan["login_s"] - (now - job["started_at"])) + left * plan["ipp_s"]
+    if job.get("ipps_started", 0) > job.get("ipps_done", 0):
+        current = max(0.0, plan["ipp_s"] - (now - job["ipp_started_at"]))
+        return current + (left - 1) * plan["ipp_s"]
+    return left * plan["ipp_s"]
+
+
+def _job_etas(active, now):
+    """
+    {job id: seconds until done} for queued, running and paused jobs. Queued
+    jobs are replayed in claim order (urgent first) over the browser slots,
+    each slot freeing up when its current job is predicted to finish.
+    Empty until the engine is loaded (see DurationModel.predict).
+    """
+    etas = {}
+    if _engine_mod is None:
+        return etas
+    slots = []
+    for job in active:
+        if job["status"] in ("running", "paused"):
+            etas[job["id"]] = _remaining_s(job, now)
+            if not job.get("injected_into"):
+                slots.append(etas[job["id"]])
+    slots += [0.0] * max(0, _governor.capacity() - len(slots))
+    heapq.heapify(slots)
+    queued = sorted((j for j in active if j["status"] == "queued"),
+                    key=lambda j: (j.get("priority") != "urgent", j["timestamp"], j["id"]))
+    for job in queued:
+        start = heapq.heappop(slots)
+        etas[job["id"]] = start + _remaining_s(job, now)
+        heapq.heappush(slots, etas[job["id"]])
+    return {job_id: _round_eta(eta) for job_id, eta in etas.items()}
+
+
+def _with_etas(jobs):
+    """Copies of jobs with eta_s (seconds until done) on the unfinished ones."""
+    if all(j["status"] in _FINISHED for j in jobs):
+        return jobs
+    etas = _job_etas(_active_jobs(), time.time())
+    return [dict(j, eta_s=etas[j["id"]]) if j["id"] in etas else j for j in jobs]
+
+
+def _active_jobs():
+    """Queued, running and paused jobs: every worker's in worker mode, else this process's."""
+    if JOB_STORE_PATH:
+        try:
+            return _store_active()
+        except sqlite3.Error as exc:
+            log_if_enabled(f"[WARNING] Could not read job store: {exc}")
+    with _controls_lock:
+        return [dict(c.job) for c in _controls.values() if c.job["status"] not in _FINISHED]
+
+
+# ──────────────────────────────────────────────
+# Job control (urgent lane, cancel, pause)
+# ──────────────────────────────────────────────
+# Cancel and pause are cooperative: run_job() honours them at its
+# checkpoints (before each IPP and each booking code), so a booking in
+# progress is finished and recorded, then the browser is closed and its slot
+# released. A paused job keeps its browser and logged-in page.
+#
+# Urgent jobs jump the governor queue. If no browser frees up within
+# URGENT_INJECT_AFTER_S, an urgent job from the same user (same credentials)
+# is handed to one of their running batches, which books it on its own
+# logged-in page at the next IPP boundary and then resumes. Work a batch
+# never reached goes back to the queue when the batch ends.
+URGENT_INJECT_AFTER_S = 5
+# "process": each /run job runs script.run_job in its own process (own Playwright
+# driver, killed after JOB_MAX_DURATION_S of unpaused time), and so does each
+# patient list and bilan sweep; "thread": inside this process as before
+JOB_BACKEND = "process"
+JOB_PROCESS_SETUP = None  # picklable callable run first in each job process (loadtest: its fake SIH)
+MAX_SERIES_DAYS = 14  # consecutive days a single /run may book (date series)
+
+
+def _job_dates_08(job):
+    """Appointment date-times of a job: one per day of its series, else its single date."""
+    return [f"{d} {job['time']}" for d in job.get("series") or [job["date"]]]
+
+
+def _job_call(job, password):
+    """(script function name, args, kwargs) that run a job: run_job, or auto_book for /auto-book jobs."""
+    kwargs = {"browser_tag": _owned_tag(job["id"]), "series": _job_dates_08(job)}
+    if job.get("kind") == "auto":
+        args = (job["username"], password, job["filter"], job["date"], job["time"], job["bookings"])
+        return "auto_book", args, dict(kwargs, rules=job.get("rules"))
+    return "run_job", (_bookable_ipps(job), job["date"], job["time"], job["bookings"], job["username"], password), kwargs
+
+
+def _job_finished(job, status, error=None):
+    fields = {}
+    if job.get("started_at"):
+        fields["actual_s"] = round(time.time() - job["started_at"], 1)
+        if status == "completed" and job.get("predicted_s"):
+            _durations.observe_job(job["predicted_s"], fields["actual_s"])
+    if job.get("found"):
+        # Auto-book: whatever was still waiting will not be booked by this job
+        fields["found"] = [dict(f, state="not_booked") if f["state"] in ("queued", "to_confirm", "booking") else f
+                           for f in job["found"]]
+    _update_job(job["id"], status, error, **fields)
+    _durations.save()
+    _jobs_total.inc(kind=job.get("kind", "run"), status=status)
+    _index_job(job, booked=status == "completed")
+    _invalidate_matrix(job["username"])
+
+
+class _UrgentWork:
+    """An urgent job waiting to be run inside another job's browser."""
+
+    def __init__(self, job, dates_08, control):
+        self.job = job
+        self.dates_08 = dates_08
+        self.control = control
+        self.outcome = None  # "completed", "failed", "cancelled" or "returned"
+        self.done = threading.Event()
+
+    def finish(self, outcome, error=None):
+        self.outcome = outcome
+        if outcome != "returned":
+            _job_finished(self.job, outcome, error)
+        self.done.set()
+
+
+class _JobControl:
+    """script.JobControl for a /run or /auto-book job (duck-typed: script is imported lazily)."""
+
+    def __init__(self, job, submitted):
+        self.job = job
+        self.submitted = submitted  # monotonic time of the /run request
+        self._lock = threading.Lock()
+        self._injected = []
+        self._open = True
+        self._booked = []
+        self.cancel_event = threading.Event()
+        self._resume = threading.Event()
+        self._resume.set()
+        # Duration model: monotonic start of the job, of the current IPP and of its current booking
+        self._started = None
+        self._login_clean = True
+        self._ipps_started = 0
+        self._ipps_done = 0
+        self._ipp_t0 = None
+        self._booking_t0 = None
+        self._booked_s = 0.0  # time the current IPP spent in bookings
+        self._paused_at = None
+        self._paused_s = 0.0  # time spent paused, not counted against JOB_MAX_DURATION_S
+        # Auto-book: patients found by the sweep and confirmations not yet collected
+        self._found = []
+        self._decisions = {}
+        if job.get("kind") == "auto":
+            self._login_clean = False  # the first IPP waits for the sweep, not just the login
+
+    def cancel(self):
+        self.cancel_event.set()
+        self._resume.set()
+
+    def pause(self):
+        self._resume.clear()
+
+    def resume(self):
+        self._resume.set()
+
+    def started(self):
+        """The job got its browser slot and is about to launch it."""
+        self._started = time.monotonic()
+        _update_job(self.job["id"], "running", started_at=time.time(), ipps_started=0, ipps_done=0)
+
+    def interrupted(self):
+        """A pause: the segment in progress says nothing about SIH speed."""
+        self._login_clean = False
+        self._ipp_t0 = None
+        self._booking_t0 = None
+        if self._paused_at is None:
+            self._paused_at = time.monotonic()
+            _watchdog.suspend(self.job["id"])
+
+    def unpaused(self):
+        """The job runs again: the pause does not count against JOB_MAX_DURATION_S."""
+        if self._paused_at is None:
+            return
+        self._paused_s += time.monotonic() - self._paused_at
+        self._paused_at = None
+        _watchdog.resume(self.job["id"])
+
+    def paused_s(self):
+        """Time spent paused so far, the current pause included."""
+        current = time.monotonic() - self._paused_at if self._paused_at is not None else 0.0
+        return self._paused_s + current
+
+    def checkpoint(self):
+        if not self._resume.is_set():
+            self.interrupted()
+            _update_job(self.job["id"], "paused")
+            self._resume.wait()
+            self.unpaused()
+            if not self.cancel_event.is_set():
+                _update_job(self.job["id"], "running", pause_requested=False)
+        if self.cancel_event.is_set():
+            raise _engine().JobCancelled("Travail annulé.")
+
+    def ipp_started(self, ipp):
+        now = time.monotonic()
+        if self._ipps_started == 0 and self._started is not None and self._login_clean:
+            _durations.learn_login(now - self._started)
+        self._ipps_started += 1
+        self._ipp_t0 = now
+        self._booked_s = 0.0
+        _update_job(self.job["id"], ipps_started=self._ipps_started, ipp_started_at=time.time(),
+                    **self._found_state(ipp, "booking"))
+
+    def booking_started(self, ipp, code):
+        self._booking_t0 = time.monotonic()
+
+    def booking_done(self, ipp, code):
+        now = time.monotonic()
+        if self._booking_t0 is not None:
+            _durations.learn_booking(code, len(_job_dates_08(self.job)), now - self._booking_t0)
+            self._booked_s += now - self._booking_t0
+        self._booking_t0 = None
+        self._booked.append({"ipp": ipp, "code": code})
+        fields = {"booked": list(self._booked)}
+        if len(self._booked) == 1:
+            fields["first_booking_s"] = round(now - self.submitted, 1)
+        _update_job(self.job["id"], **fields)
+
+    def ipp_done(self, ipp):
+        if self._ipp_t0 is not None:
+            _durations.learn_ipp_overhead(time.monotonic() - self._ipp_t0 - self._booked_s)
+        self._ipp_t0 = None
+        self._ipps_done += 1
+        _update_job(self.job["id"], ipps_done=self._ipps_done, **self._found_state(ipp, "booked"))
+
+    def _found_state(self, ipp, state):
+        """Job fields moving a swept patient to state ({} for other jobs and patients)."""
+        with self._lock:
+            entry = next((f for f in self._found if f["ip"] == ipp and f["state"] != "error"), None)
+            if entry is None:
+                return {}
+            entry["state"] = state
+            return {"found": [dict(f) for f in self._found]}
+
+    def patients_swept(self, found, swept, total):
+        _index_patients(found)
+        with self._lock:
+            self._found.extend(dict(f) for f in found)
+            queued = [f["ip"] for f in found if f["state"] == "queued"]
+            _update_job(self.job["id"], found=[dict(f) for f in self._found], sweep={"swept": swept, "total": total},
+                        ipp_list=self.job["ipp_list"] + queued)
+
+    def confirm(self, ipps, approved):
+        """Book (or skip) patients held for confirmation; return the IPPs that were waiting."""
+        with self._lock:
+            decided = [f for f in self._found if f["ip"] in ipps and f["state"] == "to_confirm"]
+            for entry in decided:
+                entry["state"] = "queued" if approved else "rejected"
+                self._decisions[entry["ip"]] = approved
+            fields = {"found": [dict(f) for f in self._found]}
+            if approved:
+                fields["ipp_list"] = self.job["ipp_list"] + [f["ip"] for f in decided]
+            if decided:
+                _update_job(self.job["id"], **fields)
+        return [f["ip"] for f in decided]
+
+    def confirmations(self):
+        with self._lock:
+            decisions, self._decisions = self._decisions, {}
+        return decisions
+
+    def inject(self, work):
+        with self._lock:
+            if not self._open:
+                return False
+            self._injected.append(work)
+            return True
+
+    def withdraw(self, work):
+        """Take back injected work that has not started; False if it already has."""
+        with self._lock:
+            if work in self._injected:
+                self._injected.remove(work)
+                return True
+            return False
+
+    def requested_state(self):
+        """What the user last asked for: "cancel", "pause" or "resume" (= keep running)."""
+        if self.cancel_event.is_set():
+            return "cancel"
+        return "resume" if self._resume.is_set() else "pause"
+
+    def next_injected(self):
+        """Take the next urgent work handed to this batch and mark it running, or None."""
+        with self._lock:
+            if not self._injected:
+                return None
+            work = self._injected.pop(0)
+        if work.job.get("validation") == "en attente":
+            _check_cached(work.job)  # no browser of its own to scrape with
+        if self._ipps_started == 0:
+            self._login_clean = False  # the first IPP will start after this work, not right after login
+        log_if_enabled(f"[INFO] Travail urgent {work.job['id']} intercalé dans {self.job['id']}")
+        _update_job(work.job["id"], "running", injected_into=self.job["id"])
+        return work
+
+    def between_ipps(self, run_ipps):
+        while True:
+            work = self.next_injected()
+            if work is None:
+                return
+            job = work.job
+            try:
+                run_ipps(_bookable_ipps(job), work.dates_08, job["bookings"], work.control)
+                work.finish("completed")
+            except _engine().JobCancelled:
+                work.finish("cancelled")
+            except Exception as exc:
+                work.finish("failed", str(exc))
+
+    def close(self):
+        """Stop accepting urgent work and return what was never started."""
+        with self._lock:
+            self._open = False
+            pending, self._injected = self._injected, []
+        for work in pending:
+            work.finish("returned")
+
+
+_controls = {}  # job id -> _JobControl of every queued, running or paused job
+_batches = {}   # job id -> (credentials key, _JobControl) of running normal jobs
+_controls_lock = threading.Lock()
+
+
+def _admit_urgent(job, credentials_key, dates_08, control):
+    """
+    Get an urgent job running: return a governor ticket for its own browser,
+    or None once it has run inside another batch (or was cancelled waiting).
+    """
+    t0 = time.perf_counter()
+    try:
+        return _acquire_slot("run", timeout=URGENT_INJECT_AFTER_S, urgent=True, abort=control.cancel_event, since=t0)
+    except GovernorBusy:
+        pass
+    with _controls_lock:
+        batches = [c for key, c in _batches.values() if key == credentials_key]
+    work = _UrgentWork(job, dates_08, control)
+    batch = next((b for b in batches if b.inject(work)), None)
+    if batch is None:
+        return _acquire_slot("run", urgent=True, abort=control.cancel_event, since=t0)
+
+    _update_job(job["id"], injected_into=batch.job["id"])
+    while not work.done.is_set():
+        if control.cancel_event.is_set() and batch.withdraw(work):
+            return None
+        # A free browser may still come first; take it if the batch has not started the work
+        try:
+            ticket = _acquire_slot("run", timeout=1, urgent=True, abort=control.cancel_event, since=t0)
+        except GovernorBusy:
+            continue
+        if ticket is None:
+            continue
+        if batch.withdraw(work) or work.outcome == "returned":
+            _update_job(job["id"], injected_into=None)
+            return ticket
+        _governor.release(ticket)
+        work.done.wait()
+    if work.outcome == "returned":
+        _update_job(job["id"], injected_into=None)
+        return _acquire_slot("run", urgent=True, abort=control.cancel_event, since=t0)
+    return None
+
+
+def _execute_job(job, control, credentials_key, password, urgent, ticket=None):
+    """Admit a /run job (unless a slot ticket is already held), run it and record its outcome."""
+    job_id = job["id"]
+    if ticket is None and urgent:
+        ticket = _admit_urgent(job, credentials_key, _job_dates_08(job), control)
+    elif ticket is None:
+        ticket = _acquire_slot("run", abort=control.cancel_event)
+    if ticket is None:
+        if control.cancel_event.is_set() and job["status"] not in ("completed", "failed", "cancelled"):
+            _job_finished(job, "cancelled")
+        return  # cancelled while waiting, or booked inside a running batch
+    if control.cancel_event.is_set():
+        _governor.release(ticket)
+        _job_finished(job, "cancelled")
+        return
+
+    if not urgent:
+        with _controls_lock:
+            _batches[job_id] = (credentials_key, control)
+    _watchdog.track(job_id)
+    sampler = JobResourceSampler(job_id, _effective_profile()).start()
+    try:
+        if job.get("validation") == "en attente":
+            _validate_job(job, password)
+        control.started()
+        if JOB_BACKEND == "process":
+            _run_job_process(job, control, password)
+        else:
+            flow, args, kwargs = _job_call(job, password)
+            getattr(_engine(), flow)(*args, control=control, **kwargs)
+        _update_job(job_id, resources=sampler.stop())
+        _job_finished(job, "completed")
+    except Exception as exc:
+        _update_job(job_id, resources=sampler.stop())
+        if isinstance(exc, _engine().JobCancelled):
+            _job_finished(job, "cancelled")
+        elif _watchdog.timed_out(job_id):
+            _job_finished(job, "failed", "Durée maximale dépassée, navigateur arrêté.")
+        else:
+            _job_finished(job, "failed", str(exc))
+    finally:
+        with _controls_lock:
+            _batches.pop(job_id, None)
+        control.close()
+        _watchdog.release(job_id)
+        _governor.release(ticket)
+
+
+def _enqueue(job, password, urgent=False):
+    """Queue a new job: in the shared store for any worker, else on a thread of this process."""
+    if JOB_STORE_PATH:
+        # Any worker sharing the store (this server included) will claim it
+        _store_add(job, password)
+        return
+    _add_job(job)
+    # Runs once a browser slot is free
+    submitted = time.monotonic()
+    credentials_key = _credentials_key(job["username"], password)
+
+    def _bg():
+        control = _JobControl(job, submitted)
+        with _controls_lock:
+            _controls[job["id"]] = control
+        try:
+            _execute_job(job, control, credentials_key, password, urgent)
+        finally:
+            with _controls_lock:
+                _controls.pop(job["id"], None)
+
+    threading.Thread(target=_bg, daemon=True).start()
+
+
+def _start_process(entry, args, name):
+    """
+    Start jobproc.<entry>(pipe, settings, *args, JOB_PROCESS_SETUP) in a
+    spawn-context child process: one process per job or sweep, not a pool,
+    so each gets a fresh Playwright driver. Returns (process, our pipe end).
+    """
+    engine = _engine()
+    import jobproc  # after the engine: it imports script
+    mp = multiprocessing.get_context("spawn")
+    conn, child_conn = mp.Pipe()
+    settings = {"HEADLESS": engine.HEADLESS, "LAUNCH_PROFILE": engine.LAUNCH_PROFILE, "VERBOSE": engine.VERBOSE}
+    proc = mp.Process(target=getattr(jobproc, entry), args=(child_conn, settings, *args, JOB_PROCESS_SETUP),
+                      name=name, daemon=True)
+    proc.start()
+    child_conn.close()
+    return proc, conn
+
+
+def _stop_process(proc):
+    """Kill a child process that is still running, with the Playwright driver and Chromium below it."""
+    if proc.is_alive():
+        # Killed through multiprocessing so it can still reap the child; the
+        # Playwright driver and Chromium below it are killed right after
+        descendants = []
+        if psutil is not None:
+            try:
+                descendants = psutil.Process(proc.pid).children(recursive=True)
+            except psutil.Error:
+                pass
+        proc.kill()
+        for descendant in descendants:
+            try:
+                descendant.kill()
+            except psutil.Error:
+                pass
+    proc.join(5)
+
+
+def _relay_notify(engine, message):
+    """Replay a child's ("notify", ...) message on this process's observers and latency tracker."""
+    _, obs_kind, name, value, labels = message
+    if obs_kind == "wait" and labels.get("found"):
+        engine.LATENCY.record(name, value * 1000)
+    engine.notify(obs_kind, name, value, **labels)
+
+
+def _run_job_process(job, control, password):
+    """
+    Run a job in a child process (jobproc.run) and relay its
+    pipe messages to control; raise like run_job would. The child's whole
+    process tree is killed once it has run JOB_MAX_DURATION_S, time spent
+    paused excluded, or on any exit.
+    """
+    engine = _engine()
+    flow, args, kwargs = _job_call(job, password)
+    proc, conn = _start_process("run", (args, kwargs, flow), f"hosix-job-{job['id']}")
+
+    t0 = time.monotonic()
+    controls = {0: control}  # channel -> _JobControl (1: urgent work running inside the job)
+    sent = {0: "resume"}
+    work = None
+    result = None
+    try:
+        while result is None:
+            for channel, channel_control in controls.items():
+                state = channel_control.requested_state()
+                if sent.get(channel) != state:
+                    conn.send((state, channel))
+                    sent[channel] = state
+            if time.monotonic() - t0 - control.paused_s() > JOB_MAX_DURATION_S:
+                raise RuntimeError("Durée maximale dépassée, processus du travail arrêté.")
+            if not conn.poll(0.5):
+                if not proc.is_alive():
+                    raise RuntimeError(f"Processus du travail arrêté (code {proc.exitcode}).")
+                continue
+            try:
+                message = conn.recv()
+            except EOFError:
+                proc.join(5)
+                raise RuntimeError(f"Processus du travail arrêté (code {proc.exitcode}).")
+            kind = message[0]
+            if kind == "notify":
+                _relay_notify(engine, message)
+            elif kind == "status":
+                _, channel, status = message
+                fields = {"pause_requested": False} if status == "running" else {}
+                if status == "paused":
+                    controls[channel].interrupted()
+                elif status == "running":
+                    controls[channel].unpaused()
+                _update_job(controls[channel].job["id"], status, **fields)
+            elif kind == "ipp_started":
+                controls[message[1]].ipp_started(*message[2:])
+            elif kind == "booking_started":
+                controls[message[1]].booking_started(*message[2:])
+            elif kind == "booking_done":
+                controls[message[1]].booking_done(*message[2:])
+            elif kind == "ipp_done":
+                controls[message[1]].ipp_done(*message[2:])
+            elif kind == "patients_swept":
+                controls[message[1]].patients_swept(*message[2:])
+            elif kind == "confirmations":
+                conn.send(("confirmations", controls[message[1]].confirmations()))
+            elif kind == "between_ipps":
+                work = control.next_injected()
+                if work is None:
+                    conn.send(("none",))
+                else:
+                    controls[1], sent[1] = work.control, "resume"
+                    conn.send(("inject", _bookable_ipps(work.job), work.dates_08, work.job["bookings"]))
+            elif kind == "work_done":
+                work.finish(message[1], message[2])
+                work = None
+                del controls[1]
+            elif kind == "result":
+                result = message[1:]
+    finally:
+        conn.close()
+        _stop_process(proc)
+        engine.LATENCY.save()
+        if work is not None:
+            work.finish("failed", "Processus du travail arrêté.")
+
+    outcome, error = result
+    if outcome == "cancelled":
+        raise engine.JobCancelled("Travail annulé.")
+    if outcome == "failed":
+        raise RuntimeError(error)
+
+
+def _browser_call(flow, *args, **kwargs):
+    """
+    script.<flow>(*args, **kwargs) for the flows that return a value
+    (patient lists, bilan sweeps): in a child process (jobproc.call) with
+    the process backend, else in this process. The caller keeps the slot
+    and the watchdog tag, which bounds the child's browser.
+    """
+    engine = _engine()
+    if JOB_BACKEND != "process":
+        return getattr(engine, flow)(*args, **kwargs)
+    proc, conn = _start_process("call", (flow, args, kwargs), f"hosix-{flow}")
+    try:
+        while True:
+            if not conn.poll(0.5):
+                if not proc.is_alive():
+                    raise RuntimeError(f"Processus arrêté (code {proc.exitcode}).")
+                continue
+            try:
+                message = conn.recv()
+            except EOFError:
+                proc.join(5)
+                raise RuntimeError(f"Processus arrêté (code {proc.exitcode}).")
+            if message[0] == "notify":
+                _relay_notify(engine, message)
+            elif message[0] == "result":
+                if message[1] == "failed":
+                    raise RuntimeError(message[2])
+                return message[2]
+    finally:
+        conn.close()
+        _stop_process(proc)
+        engine.LATENCY.save()
+
+
+# Worker mode: claim jobs from the shared store (see _store_claim) while this
+# process has a free browser slot, and run them like local ones.
+def _heartbeat(job_id, control, done):
+    """
+    Keep a claimed job's lease and apply the requests the web UI left in the
+    store. A lost lease stops the job at its next checkpoint: the store
+    already failed it and the user may have submitted it again.
+    """
+    while not done.wait(JOB_HEARTBEAT_S):
+        try:
+            held, action = _store_heartbeat(job_id)
+        except sqlite3.Error as exc:
+            log_if_enabled(f"[WARNING] Heartbeat for job {job_id} failed: {exc}")
+            continue
+        if not held:
+            log_if_enabled(f"[WARNING] Bail du travail {job_id} perdu, arrêt.")
+            _update_job(job_id, error="Bail perdu (poste jugé injoignable), travail arrêté.")
+            control.cancel()
+            return
+        if action == "cancel":
+            control.cancel()
+            _update_job(job_id, cancel_requested=True)
+        elif action == "pause":
+            control.pause()
+            _update_job(job_id, pause_requested=True)
+        elif action == "resume":
+            control.resume()
+            _update_job(job_id, pause_requested=False)
+
+
+def _run_claimed(job, password, ticket):
+    job_id = job["id"]
+    _add_job(job)
+    # first_booking_s counts from the /run request, made on whichever PC
+    try:
+        waited = max(0.0, time.time() - datetime.strptime(job["timestamp"], "%Y-%m-%d %H:%M:%S").timestamp())
+    except (KeyError, ValueError):
+        waited = 0.0
+    control = _JobControl(job, time.monotonic() - waited)
+    with _controls_lock:
+        _controls[job_id] = control
+    done = threading.Event()
+    threading.Thread(target=_heartbeat, args=(job_id, control, done), daemon=True).start()
+    try:
+        _execute_job(job, control, _credentials_key(job["username"], password), password, urgent=False,
+                     ticket=ticket)
+    finally:
+        done.set()
+        with _controls_lock:
+            _controls.pop(job_id, None)
+
+
+def _worker_loop(stop):
+    """
+    Claim store jobs while a browser slot is free, until stop is set. Also
+    fails jobs with an expired lease, and refreshes this process's patient
+    index and bilan cache with jobs other workers finished.
+    """
+    log_if_enabled(f"[INFO] Travailleur {WORKER_ID} : file partagée {JOB_STORE_PATH}")
+    seen_until = time.time()
+    while not stop.is_set():
+        try:
+            if _store_reap():
+                log_if_enabled("[WARNING] Travail(aux) interrompu(s) ou jamais pris en charge marqué(s) en échec.")
+            for finished, job in _store_finished_since(seen_until):
+                seen_until = max(seen_until, finished)
+                if job.get("worker") != WORKER_ID:
+                    _index_job(job, booked=job.get("status") == "completed")
+                    _invalidate_matrix(job["username"])
+        except sqlite3.Error as exc:
+            log_if_enabled(f"[WARNING] Job store unavailable: {exc}")
+            stop.wait(JOB_POLL_S)
+            continue
+        try:
+            ticket = _governor.acquire("run", timeout=JOB_POLL_S)
+        except GovernorBusy:
+            continue
+        claim = None
+        try:
+            claim = _store_claim()
+        except sqlite3.Error as exc:
+            log_if_enabled(f"[WARNING] Job store unavailable: {exc}")
+        if claim is None:
+            _governor.release(ticket)
+            stop.wait(JOB_POLL_S)
+            continue
+        threading.Thread(target=_run_claimed, args=(*claim, ticket), daemon=True).start()
 
 
 # ──────────────────────────────────────────────
 # HTML template
 # ──────────────────────────────────────────────
-_HTML = """<!DOCTYPE html>
-<html lang="fr">
-<head>
-<meta charset="UTF-8">
-<meta name="viewport" content="width=device-width, initial-scale=1.0">
-<title>HOSIX — Impression automatique</title>
-<style>
-  * { box-sizing: border-box; margin: 0; padding: 0; }
+# Stylesheet and script are served as separate, long-lived cacheable assets
+# (see /assets/...); only the page skeleton below is rendered per request.
+_CSS = """  * { box-sizing: border-box; margin: 0; padding: 0; }
   body { font-family: 'Segoe UI', Arial, sans-serif; background: #f0f2f5; color: #333; }
   header { background: #1a73e8; color: #fff; padding: 14px 24px; display: flex; align-items: center; gap: 12px; box-shadow: 0 2px 4px rgba(0,0,0,.2); }
   header h1 { font-size: 1.3rem; font-weight: 600; }
+  .usage { margin-left: auto; font-size: .82rem; opacity: .9; white-space: nowrap; }
+  .usage.busy { color: #ffe08a; }
   .container { max-width: 960px; margin: 24px auto; padding: 0 16px; }
   .card { background: #fff; border-radius: 8px; box-shadow: 0 1px 4px rgba(0,0,0,.1); padding: 24px; margin-bottom: 24px; }
   .card h2 { font-size: 1.05rem; font-weight: 600; color: #1a73e8; border-bottom: 2px solid #e8f0fe; padding-bottom: 8px; margin-bottom: 16px; }
   label { display: block; font-weight: 500; margin-bottom: 4px; margin-top: 14px; }
-  input[type=text], input[type=password], textarea { width: 100%; padding: 8px 10px; border: 1px solid #ddd; border-radius: 4px; font-size: .95rem; }
+  input[type=text], input[type=password], input[type=number], textarea { width: 100%; padding: 8px 10px; border: 1px solid #ddd; border-radius: 4px; font-size: .95rem; }
   textarea { resize: vertical; min-height: 60px; }
   .row { display: flex; gap: 16px; flex-wrap: wrap; }
   .row > div { flex: 1; min-width: 220px; }
@@ -115,9 +2591,24 @@ _HTML = """<!DOCTYPE html>
   .badge { display: inline-flex; align-items: center; gap: 5px; padding: 3px 10px;
       border-radius: 12px; font-size: .78rem; font-weight: 600; }
   .badge-running  { background: #fff3cd; color: #856404; }
+  .badge-queued   { background: #e2e3e5; color: #41464b; }
   .badge-completed{ background: #d1e7dd; color: #0f5132; }
   .badge-failed   { background: #f8d7da; color: #842029; }
+  .badge-urgent   { background: #842029; color: #fff; margin-right: 4px; }
+  .badge-paused   { background: #cfe2ff; color: #084298; }
+  .badge-cancelled{ background: #e2e3e5; color: #41464b; text-decoration: line-through; }
+  .job-actions { margin-top: 4px; white-space: nowrap; }
+  .job-actions button { background: none; border: 1px solid #ccc; border-radius: 4px; cursor: pointer;
+      font-size: .75rem; padding: 1px 7px; margin-right: 4px; color: #333; }
+  .job-actions button:hover { background: #e8f0fe; border-color: #1a73e8; }
+  .series-opt { margin-top: 8px; font-size: .9rem; color: #555; }
+  .series-opt input[type=number] { width: 64px; padding: 4px 6px; margin: 0 4px; }
+  .urgent-opt { display: inline-flex; align-items: center; gap: 6px; margin-left: 14px; font-weight: 600; color: #842029; }
   .err-text { color: #842029; font-size: .78rem; margin-top: 3px; }
+  .res-text { color: #666; font-size: .75rem; margin-top: 3px; white-space: nowrap; }
+  .confirm-list { margin-top: 4px; font-size: .75rem; }
+  .confirm-row { white-space: nowrap; margin-top: 2px; }
+  .confirm-list button { font-size: .7rem; padding: 1px 6px; margin-left: 4px; cursor: pointer; }
   .spinner { width: 11px; height: 11px; border: 2px solid #856404; border-top-color: transparent;
       border-radius: 50%; animation: spin .7s linear infinite; display: inline-block; }
   @keyframes spin { to { transform: rotate(360deg); } }
@@ -141,6 +2632,14 @@ _HTML = """<!DOCTYPE html>
   .fetch-menu button { display: block; width: 100%; text-align: left; padding: 8px 14px; border: none;
       background: none; cursor: pointer; font-size: .88rem; color: #333; }
   .fetch-menu button:hover { background: #e8f0fe; }
+  .ipp-wrap { position: relative; }
+  .ipp-suggest { display: none; position: absolute; left: 0; right: 0; top: 100%; background: #fff;
+      border: 1px solid #ddd; border-radius: 6px; box-shadow: 0 4px 12px rgba(0,0,0,.15); z-index: 60;
+      max-height: 260px; overflow-y: auto; padding: 4px 0; }
+  .ipp-suggest.open { display: block; }
+  .ipp-suggest div { padding: 6px 12px; cursor: pointer; font-size: .88rem; }
+  .ipp-suggest div.active, .ipp-suggest div:hover { background: #e8f0fe; }
+  .ipp-suggest small { color: #888; margin-left: 6px; }
   .run-wrap { position: relative; display: inline-block; }
   .headless-popover { display: none; position: absolute; bottom: calc(100% + 8px); left: 0;
       background: #fff; border: 1px solid #ddd; border-radius: 6px;
@@ -150,6 +2649,7 @@ _HTML = """<!DOCTYPE html>
   .headless-popover .headless-btn { background: #e8f0fe; color: #1a73e8; border: 1px solid #1a73e8;
       border-radius: 4px; padding: 6px 14px; cursor: pointer; font-size: .88rem; font-weight: 500; }
   .headless-popover .headless-btn:hover { background: #d2e3fc; }
+  .headless-popover .headless-btn + p { margin-top: 10px; }
   /* Patient modal */
   .modal-overlay { display: none; position: fixed; inset: 0; background: rgba(0,0,0,.45); z-index: 200;
       align-items: center; justify-content: center; }
@@ -169,197 +2669,150 @@ _HTML = """<!DOCTYPE html>
   .modal-body td { padding: 8px 10px; border-bottom: 1px solid #f0f0f0; vertical-align: middle; }
   .modal-body tr:last-child td { border-bottom: none; }
   .modal-body tr.has-bilan td { color: #aaa; }
+  .code-chip { display: inline-block; font-size: .74rem; padding: 1px 7px; margin: 1px 4px 1px 0;
+      border-radius: 10px; background: #f1f3f4; color: #5f6368; white-space: nowrap; }
+  .code-chip.done { background: #d1e7dd; color: #0f5132; }
   .modal-footer { padding: 12px 20px; border-top: 1px solid #eee; display: flex;
       align-items: center; justify-content: space-between; gap: 10px; }
   .modal-footer small { color: #666; font-size: .82rem; }
   .modal-sel-all { background: none; border: none; color: #1a73e8; font-size: .82rem;
       cursor: pointer; text-decoration: underline; padding: 0; }
-</style>
-</head>
-<body>
-<header>
-  <svg width="26" height="26" viewBox="0 0 24 24" fill="white">
-    <path d="M19 3H5c-1.1 0-2 .9-2 2v14c0 1.1.9 2 2 2h14c1.1 0 2-.9 2-2V5c0-1.1-.9-2-2-2zm-7 3c1.93 0 3.5 1.57 3.5 3.5S13.93 13 12 13s-3.5-1.57-3.5-3.5S10.07 6 12 6zm7 13H5v-.23c0-.62.28-1.2.76-1.58C7.47 15.82 9.64 15 12 15s4.53.82 6.24 2.19c.48.38.76.97.76 1.58V19z"/>
-  </svg>
-  <h1>HOSIX — Système d'impression automatique</h1>
-</header>
+"""
 
-<div class="container">
+_JS = """// ── Custom date/time visibility ──
+document.querySelectorAll('input[name="date_choice"]').forEach(r =>
+  r.addEventListener('change', () => {
+    document.getElementById('customDateWrap').classList.toggle('hidden', r.value !== 'custom' || !r.checked);
+  })
+);
+document.querySelectorAll('input[name="time_choice"]').forEach(r =>
+  r.addEventListener('change', () => {
+    document.getElementById('customTimeWrap').classList.toggle('hidden', r.value !== 'custom' || !r.checked);
+  })
+);
 
-  <!-- ── New Job Form ── -->
-  <div class="card">
-    <h2>Nouveau travail</h2>
-    <form id="jobForm">
+// ── Toggle all bookings ──
+let allOn = true;
+document.getElementById('toggleAll').addEventListener('click', () => {
+  allOn = !allOn;
+  document.querySelectorAll('input[name="bookings"]').forEach(cb => cb.checked = allOn);
+  document.getElementById('toggleAll').textContent = allOn ? 'Tout désélectionner' : 'Tout sélectionner';
+});
 
-      <div class="row">
-        <div>
-          <label for="ipp_list">Liste des IPP <small style="font-weight:normal;">(séparés par virgules)</small>
-            <span class="fetch-wrap">
-              <button type="button" class="fetch-btn" id="listToggle" title="Lister les patients" aria-label="Lister les patients"><svg class="list-icon" width="16" height="16" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2" stroke-linecap="round" stroke-linejoin="round"><line x1="8" y1="6" x2="21" y2="6"/><line x1="8" y1="12" x2="21" y2="12"/><line x1="8" y1="18" x2="21" y2="18"/><line x1="3" y1="6" x2="3.01" y2="6"/><line x1="3" y1="12" x2="3.01" y2="12"/><line x1="3" y1="18" x2="3.01" y2="18"/></svg><span class="fetch-spinner"></span></button>
-              <div class="fetch-menu" id="listMenu">
-                <button type="button" onclick="listAllPatients('all')">Lister tous les patients</button>
-                <button type="button" onclick="fetchPatients('today')">Patients sans bilans aujourd'hui</button>
-                <button type="button" onclick="fetchPatients('yesterday')">Patients sans bilans hier</button>
-              </div>
-            </span>
-          </label>
-          <textarea id="ipp_list" name="ipp_list" placeholder="ex : 123456, 789012, 345678" required></textarea>
-        </div>
-        <div>
-          <label>Identifiants SIH</label>
-          <input type="text"     name="username" placeholder="Nom d'utilisateur" value="{{ default_username }}">
-          <input type="password" name="password" placeholder="Mot de passe" style="margin-top:8px">
-        </div>
-      </div>
+// ── Toast helper ──
+function showToast(msg, ms) {
+  const t = document.getElementById('toast');
+  t.textContent = msg;
+  t.style.display = 'block';
+  setTimeout(() => t.style.display = 'none', ms || 3000);
+}
 
-      <div class="row">
-        <div>
-          <label>Date de rendez-vous</label>
-          <div class="choice-group" id="dateGroup">
-            <label><input type="radio" name="date_choice" value="today"    checked> Aujourd'hui ({{ today }})</label>
-            <label><input type="radio" name="date_choice" value="tomorrow">         Demain ({{ tomorrow }})</label>
-            <label><input type="radio" name="date_choice" value="custom">           Personnalisé</label>
-          </div>
-          <div id="customDateWrap" class="hidden" style="margin-top:8px;">
-            <input type="text" name="custom_date" placeholder="jj/mm/aaaa">
-          </div>
-        </div>
+// ── Render status badge ──
+function renderPriority(job) {
+  return job.priority === 'urgent' ? '<span class="badge badge-urgent">&#9889; Urgent</span>' : '';
+}
 
-        <div>
-          <label>Heure de rendez-vous</label>
-          <div class="choice-group" id="timeGroup">
-            <label><input type="radio" name="time_choice" value="now"    checked> Maintenant</label>
-            <label><input type="radio" name="time_choice" value="06:00">          06:00</label>
-            <label><input type="radio" name="time_choice" value="08:00">          08:00</label>
-            <label><input type="radio" name="time_choice" value="09:00">          09:00</label>
-            <label><input type="radio" name="time_choice" value="custom">         Personnalisé</label>
-          </div>
-          <div id="customTimeWrap" class="hidden" style="margin-top:8px;">
-            <input type="text" name="custom_time" placeholder="HH:MM">
-          </div>
-        </div>
-      </div>
+function renderSeries(job) {
+  if (!job.series) return '';
+  return '<div class="res-text">× ' + job.series.length + ' jours, jusqu\\'au ' + job.series[job.series.length - 1] + '</div>';
+}
 
-      <label>
-        Analyses
-        <button type="button" class="link-btn" id="toggleAll">Tout désélectionner</button>
-      </label>
-      <div class="choice-group" id="bookingGroup">
-        {% for item in menu_items %}
-        <label><input type="checkbox" name="bookings" value="{{ item }}" checked> {{ item }}</label>
-        {% endfor %}
-      </div>
+function renderWorker(job) {
+  return job.worker ? '<div class="res-text">Poste ' + job.worker + '</div>' : '';
+}
 
-      <div style="margin-top:20px;" class="run-wrap" id="runWrap">
-        <button type="submit" class="btn" id="submitBtn">▶ Lancer le travail</button>
-        <div class="headless-popover" id="headlessPopover">
-          <p>Mode navigateur</p>
-          <button type="button" class="headless-btn" id="headlessToggleBtn"></button>
-        </div>
-      </div>
-    </form>
-  </div>
+function renderFirstBooking(job) {
+  return job.first_booking_s != null ? '<div class="res-text">1er RDV après ' + job.first_booking_s + ' s</div>' : '';
+}
 
-  <!-- ── Job History ── -->
-  <div class="card">
-    <h2>
-      Derniers travaux <small style="font-weight:normal; color:#666;">(10 derniers)</small>
-      <button type="button" class="link-btn" style="float:right" onclick="loadJobs()">↻ Actualiser</button>
-    </h2>
-    <table>
-      <thead>
-        <tr><th>Horodatage</th><th>IPP(s)</th><th>Date RDV</th><th>Analyses</th><th>Utilisateur</th><th>Statut</th></tr>
-      </thead>
-      <tbody id="jobsBody">
-        {% if not jobs %}
-        <tr><td colspan="6" style="text-align:center;color:#999;padding:20px;">Aucun travail enregistré</td></tr>
-        {% endif %}
-        {% for job in jobs %}
-        <tr>
-          <td style="white-space:nowrap;">{{ job.timestamp }}</td>
-          <td class="ipp-cell" title="{{ job.ipp_list | join(', ') }}">{{ job.ipp_list | join(', ') }}</td>
-          <td style="white-space:nowrap;">{{ job.date }} {{ job.time[:5] }}</td>
-          <td>{{ job.bookings | join(', ') }}</td>
-          <td>{{ job.username }}</td>
-          <td>
-            {% if job.status == 'running' %}
-              <span class="badge badge-running"><span class="spinner"></span>En cours</span>
-            {% elif job.status == 'completed' %}
-              <span class="badge badge-completed">✓ Terminé</span>
-            {% else %}
-              <span class="badge badge-failed">✗ Erreur</span>
-              {% if job.error %}<div class="err-text">{{ job.error[:120] }}</div>{% endif %}
-            {% endif %}
-          </td>
-        </tr>
-        {% endfor %}
-      </tbody>
-    </table>
-  </div>
+function fmtDuration(s) {
+  return s < 60 ? s + ' s' : Math.round(s / 60) + ' min';
+}
 
-</div><!-- /container -->
+function renderEta(job) {
+  if (job.eta_s != null) return '<div class="res-text">Fin estimée dans ~' + fmtDuration(job.eta_s) + '</div>';
+  if (job.status === 'completed' && job.actual_s != null && job.predicted_s)
+    return '<div class="res-text">Durée ' + fmtDuration(Math.round(job.actual_s)) + ' (prévue ' + fmtDuration(job.predicted_s) + ')</div>';
+  return '';
+}
 
-<!-- ── Patient selection modal ── -->
-<div class="modal-overlay" id="patientModal" role="dialog" aria-modal="true" aria-labelledby="patientModalTitle">
-  <div class="modal-box">
-    <div class="modal-header">
-      <h3 id="patientModalTitle">Sélectionner les patients</h3>
-      <button type="button" class="modal-close" id="patientModalClose" aria-label="Fermer">&times;</button>
-    </div>
-    <div class="modal-body">
-      <table id="patientTable">
-        <thead>
-          <tr>
-            <th style="width:36px;"><input type="checkbox" id="modalSelectAll" title="Tout sélectionner/désélectionner"></th>
-            <th>IPP</th>
-            <th>Nom complet</th>
-          </tr>
-        </thead>
-        <tbody id="patientTableBody"></tbody>
-      </table>
-    </div>
-    <div class="modal-footer">
-      <small id="patientModalCount"></small>
-      <button type="button" class="btn" id="patientModalConfirm">✓ Confirmer la sélection</button>
-    </div>
-  </div>
-</div>
+function renderResources(job) {
+  const r = job.resources;
+  if (!r || r.peak_rss_mb == null) return '';
+  return '<div class="res-text">' + (r.profile === 'lean' ? 'léger' : 'standard') +
+    ' · pic ' + r.peak_rss_mb + ' Mo · CPU ' + r.cpu_s + ' s</div>';
+}
 
-<div id="toast"></div>
+function renderBooked(job) {
+  if (!job.booked || (job.status !== 'cancelled' && job.status !== 'failed')) return '';
+  const list = job.booked.map(b => b.ipp + ' ' + b.code).join(', ');
+  return '<div class="res-text" title="' + escHtml(list) + '">' + job.booked.length + ' réservation(s) effectuée(s)</div>';
+}
 
-<script>
-// ── Custom date/time visibility ──
-document.querySelectorAll('input[name="date_choice"]').forEach(r =>
-  r.addEventListener('change', () => {
-    document.getElementById('customDateWrap').classList.toggle('hidden', r.value !== 'custom' || !r.checked);
-  })
-);
-document.querySelectorAll('input[name="time_choice"]').forEach(r =>
-  r.addEventListener('change', () => {
-    document.getElementById('customTimeWrap').classList.toggle('hidden', r.value !== 'custom' || !r.checked);
-  })
-);
+function renderAutoLabel(job) {
+  if (job.kind !== 'auto') return '';
+  return '<div class="res-text">Auto · sans bilans ' + (job.filter === 'yesterday' ? 'hier' : "aujourd'hui") + '</div>';
+}
 
-// ── Toggle all bookings ──
-let allOn = true;
-document.getElementById('toggleAll').addEventListener('click', () => {
-  allOn = !allOn;
-  document.querySelectorAll('input[name="bookings"]').forEach(cb => cb.checked = allOn);
-  document.getElementById('toggleAll').textContent = allOn ? 'Tout désélectionner' : 'Tout sélectionner';
-});
+function renderSweep(job) {
+  if (job.kind !== 'auto') return '';
+  const found = job.found || [];
+  const count = state => found.filter(f => f.state === state).length;
+  let h = '';
+  if (job.sweep)
+    h += '<div class="res-text">Balayage ' + job.sweep.swept + '/' + job.sweep.total + ' · ' +
+      found.filter(f => f.state !== 'error').length + ' sans bilan · ' + count('booked') + ' réservé(s)</div>';
+  const errors = found.filter(f => f.state === 'error').map(f => f.ip);
+  if (errors.length)
+    h += '<div class="res-text" title="' + escHtml(errors.join(', ')) + '">' + errors.length + ' historique(s) illisible(s)</div>';
+  const rejected = count('rejected'), notBooked = count('not_booked');
+  if (rejected) h += '<div class="res-text">' + rejected + ' ignoré(s)</div>';
+  if (notBooked) h += '<div class="res-text">' + notBooked + ' non réservé(s)</div>';
+  const held = found.filter(f => f.state === 'to_confirm');
+  if (!held.length || job.status === 'completed' || job.status === 'failed' || job.status === 'cancelled') return h;
+  h += '<div class="confirm-list">';
+  held.forEach(f => {
+    h += '<div class="confirm-row" title="' + escHtml(f.bookings.join(', ')) + '">' + escHtml(f.ip + ' ' + f.name) +
+      ' <button type="button" data-action="confirm" data-decision="book" data-id="' + job.id + '" data-ipp="' + escHtml(f.ip) + '">Réserver</button>' +
+      '<button type="button" data-action="confirm" data-decision="skip" data-id="' + job.id + '" data-ipp="' + escHtml(f.ip) + '">Ignorer</button></div>';
+  });
+  if (held.length > 1)
+    h += '<button type="button" data-action="confirm" data-decision="book" data-id="' + job.id + '" data-ipp="' +
+      escHtml(held.map(f => f.ip).join(',')) + '">Tout réserver (' + held.length + ')</button>';
+  return h + '</div>';
+}
 
-// ── Toast helper ──
-function showToast(msg, ms) {
-  const t = document.getElementById('toast');
-  t.textContent = msg;
-  t.style.display = 'block';
-  setTimeout(() => t.style.display = 'none', ms || 3000);
+function renderUnknown(job) {
+  if (!job.unknown_ipps || !job.unknown_ipps.length) return '';
+  const list = job.unknown_ipps.join(', ');
+  return '<div class="res-text" title="' + escHtml(list) + '">&#9888; Non réservé(s), hors patients hospitalisés : ' + escHtml(list) + '</div>';
+}
+
+function renderActions(job) {
+  if (job.status !== 'queued' && job.status !== 'running' && job.status !== 'paused') return '';
+  if (job.cancel_requested) return '';
+  let h = '<div class="job-actions">';
+  if (job.status === 'running' && !job.pause_requested)
+    h += '<button type="button" data-action="pause" data-id="' + job.id + '">&#10074;&#10074; Pause</button>';
+  if (job.status === 'paused' || job.pause_requested)
+    h += '<button type="button" data-action="resume" data-id="' + job.id + '">&#9654; Reprendre</button>';
+  h += '<button type="button" data-action="cancel" data-id="' + job.id + '">&#10005; Annuler</button>';
+  return h + '</div>';
 }
 
-// ── Render status badge ──
 function renderBadge(job) {
+  if (job.cancel_requested && job.status !== 'cancelled')
+    return '<span class="badge badge-queued"><span class="spinner"></span>Annulation…</span>';
+  if (job.status === 'queued')
+    return '<span class="badge badge-queued">&#8987; En attente</span>';
+  if (job.status === 'running' && job.pause_requested)
+    return '<span class="badge badge-running"><span class="spinner"></span>Pause demandée</span>';
   if (job.status === 'running')
     return '<span class="badge badge-running"><span class="spinner"></span>En cours</span>';
+  if (job.status === 'paused')
+    return '<span class="badge badge-paused">&#10074;&#10074; En pause</span>';
+  if (job.status === 'cancelled')
+    return '<span class="badge badge-cancelled">Annulé</span>';
   if (job.status === 'completed')
     return '<span class="badge badge-completed">&#10003; Terminé</span>';
   let h = '<span class="badge badge-failed">&#10007; Erreur</span>';
@@ -368,10 +2821,18 @@ function renderBadge(job) {
 }
 
 // ── Load & render job list ──
+let jobsEtag = null;
 function loadJobs() {
   fetch('/jobs')
-    .then(r => r.json())
+    .then(r => {
+      // 304 revalidations come back as the cached 200 with the same ETag
+      const etag = r.headers.get('ETag');
+      if (etag && etag === jobsEtag) return null;
+      jobsEtag = etag;
+      return r.json();
+    })
     .then(jobs => {
+      if (!jobs) return;
       const tbody = document.getElementById('jobsBody');
       if (!jobs.length) {
         tbody.innerHTML = '<tr><td colspan="6" style="text-align:center;color:#999;padding:20px;">Aucun travail enregistré</td></tr>';
@@ -380,33 +2841,80 @@ function loadJobs() {
       tbody.innerHTML = jobs.map(j => `
         <tr>
           <td style="white-space:nowrap;">${j.timestamp}</td>
-          <td class="ipp-cell" title="${j.ipp_list.join(', ')}">${j.ipp_list.join(', ')}</td>
-          <td style="white-space:nowrap;">${j.date} ${j.time.substring(0,5)}</td>
+          <td class="ipp-cell" title="${j.ipp_list.join(', ')}">${renderAutoLabel(j)}${j.ipp_list.join(', ')}</td>
+          <td style="white-space:nowrap;">${j.date} ${j.time.substring(0,5)}${renderSeries(j)}</td>
           <td>${j.bookings.join(', ')}</td>
           <td>${j.username || ''}</td>
-          <td>${renderBadge(j)}</td>
+          <td>${renderPriority(j)}${renderBadge(j)}${renderWorker(j)}${renderEta(j)}${renderUnknown(j)}${renderSweep(j)}${renderFirstBooking(j)}${renderBooked(j)}${renderResources(j)}${renderActions(j)}</td>
         </tr>`).join('');
     })
     .catch(() => {});
 }
 
+// ── Pause / resume / cancel buttons ──
+document.getElementById('jobsBody').addEventListener('click', function(e) {
+  const btn = e.target.closest('button[data-action]');
+  if (!btn) return;
+  const action = btn.dataset.action;
+  if (action === 'cancel' && !confirm("Annuler ce travail ? La réservation en cours sera terminée, puis le navigateur fermé.")) return;
+  let body;
+  if (action === 'confirm') {
+    body = new FormData();
+    btn.dataset.ipp.split(',').forEach(ip => body.append('ipp', ip));
+    body.append('decision', btn.dataset.decision);
+  }
+  btn.disabled = true;
+  fetch('/jobs/' + encodeURIComponent(btn.dataset.id) + '/' + action, { method: 'POST', body: body })
+    .then(r => r.json())
+    .then(res => {
+      if (res.error) showToast('Erreur : ' + res.error, 5000);
+      jobsEtag = null;
+      loadJobs();
+    })
+    .catch(() => showToast('Erreur réseau', 5000));
+});
+
+// ── Resource usage (browsers, queue, memory) ──
+function loadUsage() {
+  fetch('/status')
+    .then(r => r.json())
+    .then(st => {
+      const u = st.resources;
+      if (!u) return;
+      const el = document.getElementById('usage');
+      let txt = 'Navigateurs ' + u.browsers + '/' + u.capacity;
+      if (u.capacity < u.max_browsers) txt += ' (SIH chargé, ' + u.max_browsers + ' au mieux)';
+      if (u.queued) txt += ' · En attente ' + u.queued;
+      if (u.memory_available_mb != null)
+        txt += ' · RAM libre ' + (u.memory_available_mb / 1024).toFixed(1) + '/' + (u.memory_total_mb / 1024).toFixed(1) + ' Go';
+      el.textContent = txt;
+      el.classList.toggle('busy', u.browsers >= u.capacity || u.queued > 0);
+    })
+    .catch(() => {});
+}
+
 // ── Auto-refresh every 5 s ──
-(function poll() { loadJobs(); setTimeout(poll, 5000); })();
+(function poll() { loadJobs(); loadUsage(); setTimeout(poll, 5000); })();
 
 // ── Form submission ──
-document.getElementById('jobForm').addEventListener('submit', function(e) {
-  e.preventDefault();
+function submitJob(form, force) {
   const btn = document.getElementById('submitBtn');
   btn.disabled = true;
   btn.textContent = 'Démarrage…';
 
-  fetch('/run', { method: 'POST', body: new FormData(this) })
+  const fd = new FormData(form);
+  if (force) fd.append('force', '1');
+  fetch('/run', { method: 'POST', body: fd })
     .then(r => r.json())
     .then(res => {
-      if (res.error) {
+      if (res.invalid_ipps) {
+        // Not hospitalised may still be bookable (other ward, outpatient): let the user decide
+        if (confirm(res.error + "\\n\\nLancer quand même ?")) submitJob(form, true);
+      } else if (res.error) {
         showToast('Erreur : ' + res.error, 6000);
       } else {
-        showToast('Travail démarré !');
+        const eta = res.eta_s != null ? ' Durée estimée ~' + fmtDuration(res.predicted_s) + ', fin dans ~' + fmtDuration(res.eta_s) + '.' : '';
+        showToast((res.status === 'queued' ? "Travail en attente d'un navigateur libre." : 'Travail démarré !') + eta, 6000);
         loadJobs();
       }
     })
@@ -415,6 +2923,11 @@ document.getElementById('jobForm').addEventListener('submit', function(e) {
       btn.disabled = false;
       btn.textContent = '▶ Lancer le travail';
     });
+}
+
+document.getElementById('jobForm').addEventListener('submit', function(e) {
+  e.preventDefault();
+  submitJob(this, false);
 });
 
 // ── Fetch patients without bilans ──
@@ -432,7 +2945,7 @@ document.addEventListener('click', function(e) {
   }
 });
 
-function fetchPatients(filter) {
+function fetchPatients(filter, refresh) {
   listMenu.classList.remove('open');
   const username = document.querySelector('input[name="username"]').value.trim();
   const password = document.querySelector('input[name="password"]').value;
@@ -449,6 +2962,7 @@ function fetchPatients(filter) {
   fd.append('username', username);
   fd.append('password', password);
   fd.append('filter', filter);
+  if (refresh) fd.append('refresh', '1');
   // Pass selected bookings so the server knows which bilan codes to check
   document.querySelectorAll('input[name="bookings"]:checked').forEach(cb => fd.append('bookings', cb.value));
 
@@ -459,6 +2973,7 @@ function fetchPatients(filter) {
         showToast('Erreur : ' + res.error, 6000);
       } else if (res.patients && res.patients.length) {
         showPatientModal(res.patients);
+        if (res.cached) showToast("Historique SIH lu à " + res.swept_at + " (Actualiser l'historique pour relire).", 4000);
       } else {
         showToast('Aucun patient trouvé.', 4000);
       }
@@ -467,6 +2982,35 @@ function fetchPatients(filter) {
     .finally(() => { btn.disabled = false; btn.classList.remove('loading'); });
 }
 
+// ── Sweep and book patients without bilans in one job ──
+function autoBook(filter, confirmEach) {
+  listMenu.classList.remove('open');
+  const fd = new FormData(document.getElementById('jobForm'));
+  if (!fd.get('username').trim() || !fd.get('password')) {
+    showToast('Veuillez saisir vos identifiants SIH.', 4000);
+    return;
+  }
+  const day = filter === 'yesterday' ? 'hier' : "aujourd'hui";
+  if (!confirmEach && !confirm('Réserver les analyses cochées pour tous les patients sans bilans ' + day + ' ?')) return;
+  fd.delete('ipp_list');
+  fd.delete('priority');
+  fd.append('filter', filter);
+  if (confirmEach) fd.append('confirm', '1');
+  fetch('/auto-book', { method: 'POST', body: fd })
+    .then(r => r.json())
+    .then(res => {
+      if (res.error) {
+        showToast('Erreur : ' + res.error, 6000);
+        return;
+      }
+      showToast(confirmEach ? 'Balayage lancé : confirmez chaque patient trouvé dans la liste des travaux.'
+                            : 'Balayage lancé : les patients sans bilans sont réservés au fur et à mesure.', 6000);
+      jobsEtag = null;
+      loadJobs();
+    })
+    .catch(() => showToast('Erreur réseau', 5000));
+}
+
 // ── List all patients ──
 
 function listAllPatients(filter) {
@@ -510,6 +3054,16 @@ function listAllPatients(filter) {
   const tbody = document.getElementById('patientTableBody');
   const countEl = document.getElementById('patientModalCount');
   const selectAllCb = document.getElementById('modalSelectAll');
+  const bilansHead = document.getElementById('patientBilansHead');
+
+  // One chip per checked code: green when done on the requested day, last date in the tooltip
+  function codeChips(codes) {
+    return Object.keys(codes || {}).map(function(code) {
+      const st = codes[code];
+      const title = st.last ? 'Dernier : ' + st.last : 'Aucun sur la période';
+      return '<span class="code-chip' + (st.has_bilan ? ' done' : '') + '" title="' + escHtml(title) + '">' + escHtml(code) + '</span>';
+    }).join('');
+  }
 
   function updateCount() {
     const total = tbody.querySelectorAll('input[type="checkbox"]').length;
@@ -521,6 +3075,7 @@ function listAllPatients(filter) {
 
   window.showPatientModal = function(patients, showAll) {
     tbody.innerHTML = '';
+    bilansHead.style.display = showAll ? 'none' : '';
     patients.forEach(function(p, idx) {
       const hasBilan = p.has_bilan;
       const checked = showAll ? false : !hasBilan;
@@ -530,7 +3085,8 @@ function listAllPatients(filter) {
       tr.innerHTML =
         '<td><input type="checkbox" id="pmcb' + idx + '" aria-label="Sélectionner le patient ' + escHtml(p.ip) + '"' + (checked ? ' checked' : '') + '></td>' +
         '<td>' + escHtml(p.ip) + '</td>' +
-        '<td>' + escHtml(p.name || '—') + '</td>';
+        '<td>' + escHtml(p.name || '—') + '</td>' +
+        (showAll ? '' : '<td>' + codeChips(p.codes) + '</td>');
       tr.querySelector('input[type="checkbox"]').addEventListener('change', updateCount);
       tbody.appendChild(tr);
     });
@@ -568,19 +3124,107 @@ function escHtml(s) {
   return String(s).replace(/&/g,'&amp;').replace(/</g,'&lt;').replace(/>/g,'&gt;').replace(/"/g,'&quot;');
 }
 
+// ── IPP autocomplete from the local patient index ──
+(function() {
+  const ta = document.getElementById('ipp_list');
+  const box = document.getElementById('ippSuggest');
+  let items = [];
+  let active = -1;
+  let timer = null;
+  let seq = 0;
+
+  // Bounds of the comma-separated entry under the caret
+  function currentToken() {
+    const v = ta.value, pos = ta.selectionStart;
+    const start = v.lastIndexOf(',', pos - 1) + 1;
+    let end = v.indexOf(',', pos);
+    if (end < 0) end = v.length;
+    return { start: start, end: end, text: v.slice(start, end).trim() };
+  }
+
+  function close() { box.classList.remove('open'); items = []; active = -1; }
+
+  function render() {
+    box.innerHTML = items.map(function(p, i) {
+      const codes = Object.keys(p.bilans).map(c => c + ' ' + p.bilans[c]).join(', ');
+      return '<div role="option" data-i="' + i + '"' + (i === active ? ' class="active"' : '') + '>' +
+        escHtml(p.ip) + ' — ' + escHtml(p.name || '?') + (codes ? '<small>' + escHtml(codes) + '</small>' : '') + '</div>';
+    }).join('');
+    box.classList.toggle('open', items.length > 0);
+  }
+
+  function pick(i) {
+    const p = items[i];
+    if (!p) return;
+    const tok = currentToken();
+    const v = ta.value;
+    const tail = v.slice(tok.end);
+    const insert = (tok.start > 0 ? ' ' : '') + p.ip + (tail ? '' : ', ');
+    ta.value = v.slice(0, tok.start) + insert + tail;
+    const caret = tok.start + insert.length;
+    ta.setSelectionRange(caret, caret);
+    close();
+    ta.focus();
+  }
+
+  ta.addEventListener('input', function() {
+    clearTimeout(timer);
+    const q = currentToken().text;
+    if (q.length < (/^\d+$/.test(q) ? 3 : 2)) { close(); return; }
+    timer = setTimeout(function() {
+      const mine = ++seq;
+      fetch('/patients/search?q=' + encodeURIComponent(q))
+        .then(r => r.json())
+        .then(res => {
+          if (mine !== seq) return;  // a newer keystroke already asked
+          items = res.patients || [];
+          active = items.length ? 0 : -1;
+          render();
+        })
+        .catch(close);
+    }, 120);
+  });
+
+  ta.addEventListener('keydown', function(e) {
+    if (!items.length) return;
+    if (e.key === 'ArrowDown' || e.key === 'ArrowUp') {
+      e.preventDefault();
+      active = (active + (e.key === 'ArrowDown' ? 1 : items.length - 1)) % items.length;
+      render();
+    } else if (e.key === 'Enter' || e.key === 'Tab') {
+      e.preventDefault();
+      pick(active);
+    } else if (e.key === 'Escape') {
+      e.stopPropagation();
+      close();
+    }
+  });
+
+  box.addEventListener('mousedown', function(e) {
+    const el = e.target.closest('[data-i]');
+    if (el) { e.preventDefault(); pick(+el.dataset.i); }
+  });
+  ta.addEventListener('blur', close);
+})();
+
 // ── Headless popover on long hover ──
 (function() {
   const runWrap = document.getElementById('runWrap');
   const popover = document.getElementById('headlessPopover');
   const toggleBtn = document.getElementById('headlessToggleBtn');
+  const profileBtn = document.getElementById('profileToggleBtn');
   let hoverTimer = null;
   let closeTimer = null;
-  let headless = {{ headless|tojson }};
+  let headless = runWrap.dataset.headless === 'true';
+  let profile = runWrap.dataset.profile;
 
   function updateBtn() {
     const label = headless ? '👁 Afficher le navigateur' : '🙈 Masquer le navigateur';
     toggleBtn.textContent = label;
     toggleBtn.setAttribute('aria-label', headless ? 'Afficher le navigateur (désactiver le mode headless)' : 'Masquer le navigateur (activer le mode headless)');
+    profileBtn.textContent = profile === 'lean' ? '🪶 Profil léger (actif)' : '🪶 Activer le profil léger';
+    profileBtn.disabled = !headless;
+    profileBtn.title = headless ? '' : "Le profil léger ne s'applique qu'en mode headless";
   }
   updateBtn();
 
@@ -612,48 +3256,337 @@ function escHtml(s) {
       })
       .catch(() => showToast('Erreur lors du changement de mode.', 4000));
   });
+
+  profileBtn.addEventListener('click', function() {
+    fetch('/toggle-profile', { method: 'POST' })
+      .then(r => r.json())
+      .then(res => {
+        profile = res.profile;
+        updateBtn();
+        showToast(res.profile === 'lean' ? 'Profil léger activé — moins de mémoire par navigateur.' : 'Profil standard activé.');
+        popover.classList.remove('open');
+      })
+      .catch(() => showToast('Erreur lors du changement de profil.', 4000));
+  });
 })();
-</script>
+"""
+
+_HTML = """<!DOCTYPE html>
+<html lang="fr">
+<head>
+<meta charset="UTF-8">
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<title>HOSIX — Impression automatique</title>
+<link rel="stylesheet" href="/assets/app.css?v={{ css_version }}">
+</head>
+<body>
+<header>
+  <svg width="26" height="26" viewBox="0 0 24 24" fill="white">
+    <path d="M19 3H5c-1.1 0-2 .9-2 2v14c0 1.1.9 2 2 2h14c1.1 0 2-.9 2-2V5c0-1.1-.9-2-2-2zm-7 3c1.93 0 3.5 1.57 3.5 3.5S13.93 13 12 13s-3.5-1.57-3.5-3.5S10.07 6 12 6zm7 13H5v-.23c0-.62.28-1.2.76-1.58C7.47 15.82 9.64 15 12 15s4.53.82 6.24 2.19c.48.38.76.97.76 1.58V19z"/>
+  </svg>
+  <h1>HOSIX — Système d'impression automatique</h1>
+  <span class="usage" id="usage"></span>
+</header>
+
+<div class="container">
+
+  <!-- ── New Job Form ── -->
+  <div class="card">
+    <h2>Nouveau travail</h2>
+    <form id="jobForm">
+
+      <div class="row">
+        <div>
+          <label for="ipp_list">Liste des IPP <small style="font-weight:normal;">(séparés par virgules)</small>
+            <span class="fetch-wrap">
+              <button type="button" class="fetch-btn" id="listToggle" title="Lister les patients" aria-label="Lister les patients"><svg class="list-icon" width="16" height="16" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2" stroke-linecap="round" stroke-linejoin="round"><line x1="8" y1="6" x2="21" y2="6"/><line x1="8" y1="12" x2="21" y2="12"/><line x1="8" y1="18" x2="21" y2="18"/><line x1="3" y1="6" x2="3.01" y2="6"/><line x1="3" y1="12" x2="3.01" y2="12"/><line x1="3" y1="18" x2="3.01" y2="18"/></svg><span class="fetch-spinner"></span></button>
+              <div class="fetch-menu" id="listMenu">
+                <button type="button" onclick="listAllPatients('all')">Lister tous les patients</button>
+                <button type="button" onclick="fetchPatients('today')">Patients sans bilans aujourd'hui</button>
+                <button type="button" onclick="fetchPatients('yesterday')">Patients sans bilans hier</button>
+                <button type="button" onclick="fetchPatients('today', true)">Actualiser l'historique</button>
+                <button type="button" onclick="autoBook('today', false)">Réserver automatiquement les patients sans bilans</button>
+                <button type="button" onclick="autoBook('today', true)">Réserver automatiquement, avec confirmation</button>
+              </div>
+            </span>
+          </label>
+          <div class="ipp-wrap">
+            <textarea id="ipp_list" name="ipp_list" placeholder="ex : 123456, 789012, 345678" required autocomplete="off"></textarea>
+            <div class="ipp-suggest" id="ippSuggest" role="listbox"></div>
+          </div>
+        </div>
+        <div>
+          <label>Identifiants SIH</label>
+          <input type="text"     name="username" placeholder="Nom d'utilisateur" value="{{ default_username }}">
+          <input type="password" name="password" placeholder="Mot de passe" style="margin-top:8px">
+        </div>
+      </div>
+
+      <div class="row">
+        <div>
+          <label>Date de rendez-vous</label>
+          <div class="choice-group" id="dateGroup">
+            <label><input type="radio" name="date_choice" value="today"    checked> Aujourd'hui ({{ today }})</label>
+            <label><input type="radio" name="date_choice" value="tomorrow">         Demain ({{ tomorrow }})</label>
+            <label><input type="radio" name="date_choice" value="custom">           Personnalisé</label>
+          </div>
+          <div id="customDateWrap" class="hidden" style="margin-top:8px;">
+            <input type="text" name="custom_date" placeholder="jj/mm/aaaa">
+          </div>
+          <div class="series-opt">
+            Répéter sur
+            <input type="number" name="repeat_days" value="1" min="1" max="{{ max_series_days }}">
+            jour(s) consécutif(s)
+          </div>
+        </div>
+
+        <div>
+          <label>Heure de rendez-vous</label>
+          <div class="choice-group" id="timeGroup">
+            <label><input type="radio" name="time_choice" value="now"    checked> Maintenant</label>
+            <label><input type="radio" name="time_choice" value="06:00">          06:00</label>
+            <label><input type="radio" name="time_choice" value="08:00">          08:00</label>
+            <label><input type="radio" name="time_choice" value="09:00">          09:00</label>
+            <label><input type="radio" name="time_choice" value="custom">         Personnalisé</label>
+          </div>
+          <div id="customTimeWrap" class="hidden" style="margin-top:8px;">
+            <input type="text" name="custom_time" placeholder="HH:MM">
+          </div>
+        </div>
+      </div>
+
+      <label>
+        Analyses
+        <button type="button" class="link-btn" id="toggleAll">Tout désélectionner</button>
+      </label>
+      <div class="choice-group" id="bookingGroup">
+        {% for item in menu_items %}
+        <label><input type="checkbox" name="bookings" value="{{ item }}" checked> {{ item }}</label>
+        {% endfor %}
+      </div>
+
+      <div style="margin-top:20px;" class="run-wrap" id="runWrap" data-headless="{{ headless|tojson }}" data-profile="{{ profile }}">
+        <button type="submit" class="btn" id="submitBtn">▶ Lancer le travail</button>
+        <div class="headless-popover" id="headlessPopover">
+          <p>Mode navigateur</p>
+          <button type="button" class="headless-btn" id="headlessToggleBtn"></button>
+          <p>Profil de lancement</p>
+          <button type="button" class="headless-btn" id="profileToggleBtn"></button>
+        </div>
+      </div>
+      <label class="urgent-opt" title="Passe avant les travaux en attente, ou s'intercale dans votre travail en cours entre deux IPP">
+        <input type="checkbox" name="priority" value="urgent"> Urgent
+      </label>
+    </form>
+  </div>
+
+  <!-- ── Job History ── -->
+  <div class="card">
+    <h2>
+      Derniers travaux <small style="font-weight:normal; color:#666;">(10 derniers)</small>
+      <button type="button" class="link-btn" style="float:right" onclick="loadJobs()">↻ Actualiser</button>
+    </h2>
+    <table>
+      <thead>
+        <tr><th>Horodatage</th><th>IPP(s)</th><th>Date RDV</th><th>Analyses</th><th>Utilisateur</th><th>Statut</th></tr>
+      </thead>
+      <tbody id="jobsBody">
+        {% if not jobs %}
+        <tr><td colspan="6" style="text-align:center;color:#999;padding:20px;">Aucun travail enregistré</td></tr>
+        {% endif %}
+        {% for job in jobs %}
+        <tr>
+          <td style="white-space:nowrap;">{{ job.timestamp }}</td>
+          <td class="ipp-cell" title="{{ job.ipp_list | join(', ') }}">{% if job.kind == 'auto' %}<div class="res-text">Auto · sans bilans {{ 'hier' if job.filter == 'yesterday' else "aujourd'hui" }}</div>{% endif %}{{ job.ipp_list | join(', ') }}</td>
+          <td style="white-space:nowrap;">{{ job.date }} {{ job.time[:5] }}{% if job.series %}<div class="res-text">× {{ job.series | length }} jours, jusqu'au {{ job.series[-1] }}</div>{% endif %}</td>
+          <td>{{ job.bookings | join(', ') }}</td>
+          <td>{{ job.username }}</td>
+          <td>
+            {% if job.priority == 'urgent' %}<span class="badge badge-urgent">⚡ Urgent</span>{% endif %}
+            {% if job.status == 'queued' %}
+              <span class="badge badge-queued">⌛ En attente</span>
+            {% elif job.status == 'running' %}
+              <span class="badge badge-running"><span class="spinner"></span>En cours</span>
+            {% elif job.status == 'paused' %}
+              <span class="badge badge-paused">❚❚ En pause</span>
+            {% elif job.status == 'cancelled' %}
+              <span class="badge badge-cancelled">Annulé</span>
+            {% elif job.status == 'completed' %}
+              <span class="badge badge-completed">✓ Terminé</span>
+            {% else %}
+              <span class="badge badge-failed">✗ Erreur</span>
+              {% if job.error %}<div class="err-text">{{ job.error[:120] }}</div>{% endif %}
+            {% endif %}
+            {% if job.worker %}<div class="res-text">Poste {{ job.worker }}</div>{% endif %}
+            {% if job.eta_s is defined %}
+              <div class="res-text">Fin estimée dans ~{{ job.eta_s ~ ' s' if job.eta_s < 60 else (job.eta_s / 60) | round | int ~ ' min' }}</div>
+            {% elif job.status == 'completed' and job.actual_s and job.predicted_s %}
+              <div class="res-text">Durée {{ job.actual_s | round | int ~ ' s' if job.actual_s < 60 else (job.actual_s / 60) | round | int ~ ' min' }} (prévue {{ job.predicted_s ~ ' s' if job.predicted_s < 60 else (job.predicted_s / 60) | round | int ~ ' min' }})</div>
+            {% endif %}
+            {% if job.sweep %}
+              <div class="res-text">Balayage {{ job.sweep.swept }}/{{ job.sweep.total }} · {{ job.found | rejectattr('state', 'equalto', 'error') | list | length }} sans bilan · {{ job.found | selectattr('state', 'equalto', 'booked') | list | length }} réservé(s)</div>
+            {% endif %}
+            {% if job.unknown_ipps %}
+              <div class="res-text" title="{{ job.unknown_ipps | join(', ') }}">⚠ Non réservé(s), hors patients hospitalisés : {{ job.unknown_ipps | join(', ') }}</div>
+            {% endif %}
+            {% if job.first_booking_s is defined and job.first_booking_s is not none %}
+              <div class="res-text">1er RDV après {{ job.first_booking_s }} s</div>
+            {% endif %}
+            {% if job.resources and job.resources.peak_rss_mb is not none %}
+              <div class="res-text">{{ 'léger' if job.resources.profile == 'lean' else 'standard' }} · pic {{ job.resources.peak_rss_mb }} Mo · CPU {{ job.resources.cpu_s }} s</div>
+            {% endif %}
+          </td>
+        </tr>
+        {% endfor %}
+      </tbody>
+    </table>
+  </div>
+
+</div><!-- /container -->
+
+<!-- ── Patient selection modal ── -->
+<div class="modal-overlay" id="patientModal" role="dialog" aria-modal="true" aria-labelledby="patientModalTitle">
+  <div class="modal-box">
+    <div class="modal-header">
+      <h3 id="patientModalTitle">Sélectionner les patients</h3>
+      <button type="button" class="modal-close" id="patientModalClose" aria-label="Fermer">&times;</button>
+    </div>
+    <div class="modal-body">
+      <table id="patientTable">
+        <thead>
+          <tr>
+            <th style="width:36px;"><input type="checkbox" id="modalSelectAll" title="Tout sélectionner/désélectionner"></th>
+            <th>IPP</th>
+            <th>Nom complet</th>
+            <th id="patientBilansHead">Bilans</th>
+          </tr>
+        </thead>
+        <tbody id="patientTableBody"></tbody>
+      </table>
+    </div>
+    <div class="modal-footer">
+      <small id="patientModalCount"></small>
+      <button type="button" class="btn" id="patientModalConfirm">✓ Confirmer la sélection</button>
+    </div>
+  </div>
+</div>
+
+<div id="toast"></div>
+
+<script src="/assets/app.js?v={{ js_version }}"></script>
 </body>
 </html>
 """
 
 
+# Compiled once at startup instead of on every page load
+_INDEX_TEMPLATE = app.jinja_env.from_string(_HTML)
+
+_ASSETS = {
+    "app.css": (_CSS.encode("utf-8"), "text/css"),
+    "app.js": (_JS.encode("utf-8"), "application/javascript"),
+}
+_ASSET_VERSIONS = {name: hashlib.sha1(body).hexdigest()[:12] for name, (body, _) in _ASSETS.items()}
+
+
+# ──────────────────────────────────────────────
+# Conditional GET & compression
+# ──────────────────────────────────────────────
+_COMPRESS_MIN_BYTES = 512
+_compressed_cache = {}  # (etag, encoding) -> bytes, for immutable assets only
+
+
+def _pick_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+
+def _compress(body, encoding, static):
+    if encoding == "br":
+        return brotli.compress(body, quality=11 if static else 5)
+    return gzip.compress(body, compresslevel=9 if static else 6)
+
+
+def _cached_response(body, mimetype, cache_control, static=False):
+    """
+    Build a response carrying a (weak) ETag of the body. A matching
+    If-None-Match gets an empty 304; otherwise the body is compressed with
+    brotli or gzip when the client accepts it. Compressed copies of static
+    assets are kept so they are only compressed once.
+    """
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    etag = hashlib.sha1(body).hexdigest()[:20]
+
+    if request.if_none_match.contains_weak(etag):
+        resp = app.response_class(status=304)
+    else:
+        encoding = _pick_encoding() if len(body) >= _COMPRESS_MIN_BYTES else None
+        if encoding:
+            key = (etag, encoding)
+            data = _compressed_cache.get(key) if static else None
+            if data is None:
+                data = _compress(body, encoding, static)
+                if static:
+                    _compressed_cache[key] = data
+            resp = app.response_class(data, mimetype=mimetype)
+            resp.headers["Content-Encoding"] = encoding
+        else:
+            resp = app.response_class(body, mimetype=mimetype)
+
+    resp.set_etag(etag, weak=True)
+    resp.headers["Cache-Control"] = cache_control
+    resp.headers["Vary"] = "Accept-Encoding"
+    return resp
+
+
 # ──────────────────────────────────────────────
 # Routes
 # ──────────────────────────────────────────────
 @app.route("/")
 def index():
-    with _jobs_lock:
-        recent = list(reversed(_jobs[-10:]))
+    recent = _with_etas(_recent_jobs())
     today = date.today()
-    return render_template_string(
-        _HTML,
+    menu_items, headless, profile = _page_settings()
+    html = render_template(
+        _INDEX_TEMPLATE,
         jobs=recent,
-        menu_items=list(MENU_CONFIG.keys()),
+        menu_items=menu_items,
         today=today.strftime("%d/%m/%Y"),
         tomorrow=(today + timedelta(days=1)).strftime("%d/%m/%Y"),
+        max_series_days=MAX_SERIES_DAYS,
         default_username="",
-        headless=_script_mod.HEADLESS,
+        headless=headless,
+        profile=profile,
+        css_version=_ASSET_VERSIONS["app.css"],
+        js_version=_ASSET_VERSIONS["app.js"],
     )
+    return _cached_response(html, "text/html", "no-cache")
 
 
-@app.route("/run", methods=["POST"])
-def run_endpoint():
-    # ── Collect form values ──
-    ipp_raw        = request.form.get("ipp_list", "").strip()
-    date_choice    = request.form.get("date_choice", "today")
-    custom_date    = request.form.get("custom_date", "").strip()
-    time_choice    = request.form.get("time_choice", "now")
-    custom_time    = request.form.get("custom_time", "").strip()
-    username       = request.form.get("username", "").strip()
-    password       = request.form.get("password", "")
-    sel_bookings   = request.form.getlist("bookings")
+@app.route("/assets/<name>")
+def asset_endpoint(name):
+    if name not in _ASSETS:
+        return "Not found", 404
+    body, mimetype = _ASSETS[name]
+    # URLs carry the content hash (?v=...), so the browser may keep them forever
+    return _cached_response(body, mimetype, "public, max-age=31536000, immutable", static=True)
 
-    if not username:
-        return jsonify({"error": "Nom d'utilisateur requis."}), 400
-    if not password:
-        return jsonify({"error": "Mot de passe requis."}), 400
+
+def _resolve_schedule(form):
+    """
+    (date "dd/mm/yyyy", time "HH:MM:SS", series of dates) from the job
+    form's date, time and repeat fields; ValueError with the message to show.
+    """
+    date_choice    = form.get("date_choice", "today")
+    custom_date    = form.get("custom_date", "").strip()
+    time_choice    = form.get("time_choice", "now")
+    custom_time    = form.get("custom_time", "").strip()
+    repeat_days    = form.get("repeat_days", "1").strip() or "1"
 
     # ── Resolve date ──
     today = date.today()
@@ -663,10 +3596,16 @@ def run_endpoint():
         selected_date = (today + timedelta(days=1)).strftime("%d/%m/%Y")
     else:
         try:
-            parse_ddmmyyyy_strict(custom_date)
+            _engine().parse_ddmmyyyy_strict(custom_date)
             selected_date = custom_date
         except Exception:
-            return jsonify({"error": "Format de date invalide. Utilisez jj/mm/aaaa."}), 400
+            raise ValueError("Format de date invalide. Utilisez jj/mm/aaaa.")
+
+    # ── Resolve series (same analyses on consecutive days) ──
+    if not repeat_days.isdigit() or not 1 <= int(repeat_days) <= MAX_SERIES_DAYS:
+        raise ValueError(f"Nombre de jours invalide (1 à {MAX_SERIES_DAYS}).")
+    first_day = datetime.strptime(selected_date, "%d/%m/%Y").date()
+    series = [(first_day + timedelta(days=i)).strftime("%d/%m/%Y") for i in range(int(repeat_days))]
 
     # ── Resolve time ──
     if time_choice == "now":
@@ -676,9 +3615,29 @@ def run_endpoint():
             parsed = datetime.strptime(custom_time, "%H:%M")
             selected_time = parsed.strftime("%H:%M:%S")
         except ValueError:
-            return jsonify({"error": "Format d'heure invalide. Utilisez HH:MM."}), 400
+            raise ValueError("Format d'heure invalide. Utilisez HH:MM.")
     else:
         selected_time = time_choice + ":00"
+    return selected_date, selected_time, series
+
+
+@app.route("/run", methods=["POST"])
+def run_endpoint():
+    # ── Collect form values ──
+    ipp_raw        = request.form.get("ipp_list", "").strip()
+    username       = request.form.get("username", "").strip()
+    password       = request.form.get("password", "")
+    sel_bookings   = request.form.getlist("bookings")
+    urgent         = request.form.get("priority") == "urgent"
+
+    if not username:
+        return jsonify({"error": "Nom d'utilisateur requis."}), 400
+    if not password:
+        return jsonify({"error": "Mot de passe requis."}), 400
+    try:
+        selected_date, selected_time, series = _resolve_schedule(request.form)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
 
     # ── Parse & validate IPP list ──
     cleaned = re.sub(r"\s+", "", ipp_raw)
@@ -691,7 +3650,31 @@ def run_endpoint():
         return jsonify({"error": f"IPP invalide(s) : {', '.join(invalid[:5])}. Seuls les chiffres sont acceptés."}), 400
 
     if not sel_bookings:
-        sel_bookings = list(MENU_CONFIG.keys())
+        sel_bookings = list(_engine().MENU_CONFIG.keys())
+
+    queued = _store_count("queued") if JOB_STORE_PATH else _governor.queued()
+    if queued >= MAX_QUEUED_JOBS:
+        _busy_total.inc(kind="run")
+        return _busy_response(_governor.retry_after())
+
+    # ── Check IPPs against the episodes table (see IPP pre-validation) ──
+    known = _fresh_episodes(username)
+    unknown = None
+    if request.form.get("force") == "1":
+        validation = "ignorée"
+    elif known is not None:
+        validation = "sih"
+        unknown = [ip for ip in ipp_list if ip not in known]
+        _step_seconds.observe(0, step="prevalidate", source="cache")
+        if unknown:
+            return jsonify({
+                "error": f"IPP absent(s) des patients hospitalisés : {', '.join(unknown[:10])}"
+                         + (f" (+{len(unknown) - 10})" if len(unknown) > 10 else "") + ".",
+                "invalid_ipps": unknown,
+            }), 400
+    else:
+        validation = "en attente"
+        _refresh_episodes(username, password)
 
     # ── Create job record ──
     job_id = datetime.now().strftime("%Y%m%d%H%M%S%f")
@@ -703,35 +3686,209 @@ def run_endpoint():
         "time":      selected_time,
         "bookings":  sel_bookings,
         "username":  username,
-        "status":    "running",
+        "status":    "queued",
         "error":     None,
+        "validation": validation,
+        "priority":  "urgent" if urgent else "normal",
     }
-    _add_job(job)
+    if len(series) > 1:
+        job["series"] = series
+    if unknown is not None:
+        job["unknown_ipps"] = unknown
+    plan = _durations.predict(job)
+    if plan is not None:
+        job["predicted_s"] = round(plan["total_s"])
+    active = [j for j in _active_jobs() if j["id"] != job_id] + [job]
+    eta_s = _job_etas(active, time.time()).get(job_id)
+    _enqueue(job, password, urgent)
+    return jsonify({"job_id": job_id, "status": "queued", "validation": validation,
+                    "predicted_s": job.get("predicted_s"), "eta_s": eta_s})
+
+
+# Sweep for patients without bilans and book what they lack in the same job
+# (script.auto_book): one browser session, one job record whose "found" list
+# grows while the sweep runs. With confirm=1 each patient waits for
+# /jobs/<id>/confirm before being booked.
+@app.route("/auto-book", methods=["POST"])
+def auto_book_endpoint():
+    username       = request.form.get("username", "").strip()
+    password       = request.form.get("password", "")
+    filter_option  = request.form.get("filter", "today")
+    sel_bookings   = request.form.getlist("bookings")
+    min_gap_days   = request.form.get("min_gap_days", "0").strip() or "0"
 
-    # ── Run automation in a background thread ──
-    def _bg():
-        try:
-            run_job(ipp_list, selected_date, selected_time, sel_bookings, username, password)
-            _update_job(job_id, "completed")
-        except Exception as exc:
-            _update_job(job_id, "failed", str(exc))
+    if not username:
+        return jsonify({"error": "Nom d'utilisateur requis."}), 400
+    if not password:
+        return jsonify({"error": "Mot de passe requis."}), 400
+    if filter_option not in ("today", "yesterday"):
+        return jsonify({"error": "Option de filtre invalide."}), 400
+    if not min_gap_days.isdigit() or int(min_gap_days) >= _engine().HISTORY_WINDOW_DAYS:
+        return jsonify({"error": f"Écart minimal invalide (0 à {_engine().HISTORY_WINDOW_DAYS - 1} jours)."}), 400
+    try:
+        selected_date, selected_time, series = _resolve_schedule(request.form)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    if not sel_bookings:
+        sel_bookings = list(_engine().MENU_CONFIG.keys())
 
-    threading.Thread(target=_bg, daemon=True).start()
+    queued = _store_count("queued") if JOB_STORE_PATH else _governor.queued()
+    if queued >= MAX_QUEUED_JOBS:
+        _busy_total.inc(kind="auto")
+        return _busy_response(_governor.retry_after())
 
-    return jsonify({"job_id": job_id, "status": "running"})
+    job_id = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    job = {
+        "id":        job_id,
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "kind":      "auto",
+        "filter":    filter_option,
+        "rules":     {"confirm": request.form.get("confirm") == "1", "min_gap_days": int(min_gap_days)},
+        "ipp_list":  [],  # grows as the sweep finds patients to book
+        "found":     [],
+        "date":      selected_date,
+        "time":      selected_time,
+        "bookings":  sel_bookings,
+        "username":  username,
+        "status":    "queued",
+        "error":     None,
+        "priority":  "normal",
+    }
+    if len(series) > 1:
+        job["series"] = series
+    _enqueue(job, password)
+    return jsonify({"job_id": job_id, "status": "queued"})
 
 
 @app.route("/jobs")
 def jobs_endpoint():
-    with _jobs_lock:
-        recent = list(reversed(_jobs[-10:]))
-    return jsonify(recent)
+    recent = _with_etas(_recent_jobs())
+    # Polled every 5 s by each open tab: unchanged lists revalidate to a bodiless 304
+    return _cached_response(json.dumps(recent, ensure_ascii=False), "application/json", "no-cache")
+
+
+def _live_control(job_id):
+    with _controls_lock:
+        return _controls.get(job_id)
+
+
+def _store_request_response(job_id, action, flag, value):
+    """Cancel/pause/resume a job that runs in another worker process (shared store)."""
+    ok, error = _store_request(job_id, action)
+    if not ok:
+        return jsonify({"error": error}), 404 if "introuvable" in error else 409
+    return jsonify({"job_id": job_id, flag: value})
+
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_job_endpoint(job_id):
+    control = _live_control(job_id)
+    if control is None and JOB_STORE_PATH:
+        return _store_request_response(job_id, "cancel", "cancel_requested", True)
+    if control is None:
+        return jsonify({"error": "Travail introuvable ou déjà terminé."}), 404
+    control.cancel()
+    _update_job(job_id, cancel_requested=True)
+    return jsonify({"job_id": job_id, "cancel_requested": True})
+
+
+@app.route("/jobs/<job_id>/pause", methods=["POST"])
+def pause_job_endpoint(job_id):
+    control = _live_control(job_id)
+    if control is None and JOB_STORE_PATH:
+        return _store_request_response(job_id, "pause", "pause_requested", True)
+    if control is None:
+        return jsonify({"error": "Travail introuvable ou déjà terminé."}), 404
+    if control.job["status"] != "running":
+        return jsonify({"error": "Seul un travail en cours peut être mis en pause."}), 409
+    control.pause()
+    _update_job(job_id, pause_requested=True)
+    return jsonify({"job_id": job_id, "pause_requested": True})
+
+
+@app.route("/jobs/<job_id>/resume", methods=["POST"])
+def resume_job_endpoint(job_id):
+    control = _live_control(job_id)
+    if control is None and JOB_STORE_PATH:
+        return _store_request_response(job_id, "resume", "pause_requested", False)
+    if control is None:
+        return jsonify({"error": "Travail introuvable ou déjà terminé."}), 404
+    control.resume()
+    _update_job(job_id, pause_requested=False)
+    return jsonify({"job_id": job_id, "pause_requested": False})
+
+
+@app.route("/jobs/<job_id>/confirm", methods=["POST"])
+def confirm_job_endpoint(job_id):
+    # decision=book or skip for the "ipp" patients an auto-book job holds
+    ipps = request.form.getlist("ipp")
+    approved = request.form.get("decision", "book") == "book"
+    control = _live_control(job_id)
+    if control is None and JOB_STORE_PATH:
+        return jsonify({"error": "Confirmation possible uniquement sur le poste qui exécute ce travail."}), 409
+    if control is None:
+        return jsonify({"error": "Travail introuvable ou déjà terminé."}), 404
+    decided = control.confirm(set(ipps), approved)
+    if not decided:
+        return jsonify({"error": "Aucun de ces patients n'attend de confirmation."}), 409
+    return jsonify({"job_id": job_id, "decided": decided, "decision": "book" if approved else "skip"})
 
 
 @app.route("/toggle-headless", methods=["POST"])
 def toggle_headless_endpoint():
-    _script_mod.HEADLESS = not _script_mod.HEADLESS
-    return jsonify({"headless": _script_mod.HEADLESS})
+    engine = _engine()
+    engine.HEADLESS = not engine.HEADLESS
+    return jsonify({"headless": engine.HEADLESS})
+
+
+@app.route("/toggle-profile", methods=["POST"])
+def toggle_profile_endpoint():
+    engine = _engine()
+    engine.LAUNCH_PROFILE = "standard" if engine.LAUNCH_PROFILE == "lean" else "lean"
+    return jsonify({"profile": engine.LAUNCH_PROFILE})
+
+
+def _asset_cache_snapshot():
+    counts = {outcome: _asset_cache_total.value(outcome=outcome) for outcome in ("hit", "revalidated", "miss")}
+    served = sum(counts.values())
+    return {
+        **counts,
+        "hit_rate": round((counts["hit"] + counts["revalidated"]) / served, 3) if served else None,
+        "bytes_saved": _asset_cache_bytes_saved.value(),
+    }
+
+
+@app.route("/status")
+def status_endpoint():
+    return jsonify({
+        "startup": _startup,
+        "engine_loaded": _engine_mod is not None,
+        "resources": _governor.snapshot(),
+        "watchdog": _watchdog.snapshot(),
+        "eta_model": _durations.snapshot(),
+        "asset_cache": _asset_cache_snapshot(),
+        "sih_load": _sih_load.snapshot(),
+    })
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return app.response_class(_render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/status/trend")
+def status_trend_endpoint():
+    return jsonify(_watchdog.trend())
+
+
+@app.route("/patients/search")
+def patients_search_endpoint():
+    t0 = time.perf_counter()
+    try:
+        results = _search_patients(request.args.get("q", ""))
+    except sqlite3.Error as exc:
+        return jsonify({"error": str(exc)}), 500
+    return jsonify({"patients": results, "took_ms": round((time.perf_counter() - t0) * 1000, 2)})
 
 
 @app.route("/fetch-patients", methods=["POST"])
@@ -740,6 +3897,7 @@ def fetch_patients_endpoint():
     password = request.form.get("password", "")
     filter_option = request.form.get("filter", "today")
     sel_bookings = request.form.getlist("bookings")
+    refresh = request.form.get("refresh") == "1"
 
     if not username:
         return jsonify({"error": "Nom d'utilisateur requis."}), 400
@@ -749,15 +3907,45 @@ def fetch_patients_endpoint():
         return jsonify({"error": "Option de filtre invalide."}), 400
 
     # Derive booking codes from selected analyses
-    booking_codes = list({MENU_CONFIG[b]["code"] for b in sel_bookings if b in MENU_CONFIG})
+    engine = _engine()
+    menu_config = engine.MENU_CONFIG
+    booking_codes = sorted({menu_config[b]["code"] for b in sel_bookings if b in menu_config})
     if not booking_codes:
         booking_codes = ["CYTO"]
+    target_date = date.today() - timedelta(days=1 if filter_option == "yesterday" else 0)
 
-    try:
-        patients = fetch_patients_without_bilans(username, password, filter_option, booking_codes)
-        return jsonify({"patients": patients})
-    except Exception as exc:
-        return jsonify({"error": str(exc)}), 500
+    entry = None if refresh else _cached_matrix(username, password)
+    cached = entry is not None
+    if entry is None:
+        try:
+            ticket = _acquire_slot("fetch", timeout=FETCH_ADMISSION_WAIT_S)
+        except GovernorBusy as busy:
+            return _busy_response(busy.retry_after)
+        tag = f"fetch-{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+        _watchdog.track(tag)
+        try:
+            matrix = _browser_call("fetch_bilan_matrix", username, password, browser_tag=_owned_tag(tag))
+            entry = _store_matrix(username, password, matrix)
+            _index_patients(entry["matrix"])
+            _remember_episodes(username, entry["matrix"])
+            _jobs_total.inc(kind="fetch", status="completed")
+        except Exception as exc:
+            _jobs_total.inc(kind="fetch", status="failed")
+            return jsonify({"error": str(exc)}), 500
+        finally:
+            _watchdog.release(tag)
+            _governor.release(ticket)
+
+    patients = [
+        {"ip": item["ip"], "name": item["name"], **engine.bilan_status(item, booking_codes, target_date)}
+        for item in entry["matrix"]
+    ]
+    return jsonify({
+        "patients": patients,
+        "codes": booking_codes,
+        "swept_at": entry["swept_at"],
+        "cached": cached,
+    })
 
 
 @app.route("/list-patients", methods=["POST"])
@@ -774,19 +3962,65 @@ def list_patients_endpoint():
         return jsonify({"error": "Option de filtre invalide."}), 400
 
     try:
-        patients = fetch_all_patients(username, password, filter_option)
+        ticket = _acquire_slot("list", timeout=FETCH_ADMISSION_WAIT_S)
+    except GovernorBusy as busy:
+        return _busy_response(busy.retry_after)
+    tag = f"list-{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+    _watchdog.track(tag)
+    try:
+        patients = _browser_call("fetch_all_patients", username, password, filter_option,
+                                 browser_tag=_owned_tag(tag))
+        _index_patients(patients)
+        _remember_episodes(username, patients)
+        _jobs_total.inc(kind="list", status="completed")
         return jsonify({"patients": patients})
     except Exception as exc:
+        _jobs_total.inc(kind="list", status="failed")
         return jsonify({"error": str(exc)}), 500
+    finally:
+        _watchdog.release(tag)
+        _governor.release(ticket)
 
 
 # ──────────────────────────────────────────────
 # Entry-point
 # ──────────────────────────────────────────────
 if __name__ == "__main__":
+    _mark_startup("imports_s")
+    parser = argparse.ArgumentParser(description="HOSIX web interface.")
+    parser.add_argument("--store", help="shared SQLite job store (default: $HOSIX_JOB_STORE; none = jobs run here)")
+    parser.add_argument("--worker", action="store_true", help="no web interface: only run jobs from --store")
+    args = parser.parse_args()
+    JOB_STORE_PATH = args.store or JOB_STORE_PATH
+    if args.worker and not JOB_STORE_PATH:
+        parser.error("--worker needs --store or HOSIX_JOB_STORE")
+    if JOB_STORE_PATH and Fernet is None:
+        parser.error("the shared job store needs the cryptography package (pip install cryptography)")
+    if JOB_STORE_PATH:
+        try:
+            _store_key(create=not args.worker)
+        except FileNotFoundError:
+            parser.error(f"--worker needs the store's shared key: HOSIX_STORE_KEY or {_store_key_path()} "
+                         "(written by the web server on first start)")
+        except (OSError, ValueError) as exc:
+            parser.error(f"store key unusable: {exc}")
+
+    launcher_s = _launcher_elapsed()
+    if launcher_s is not None:
+        _startup["launcher_s"] = launcher_s
     configure_console_logging()
-    _script_mod.VERBOSE = LOGGING_ENABLED
     _load_jobs()
+    _mark_startup("jobs_loaded_s")
+
+    if args.worker:
+        _engine()
+        threading.Thread(target=_watchdog.run_forever, daemon=True).start()
+        log_if_enabled(f"  HOSIX travailleur {WORKER_ID} démarré (Ctrl+C pour arrêter).")
+        try:
+            _worker_loop(threading.Event())
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
 
     # Try to determine a LAN IP for convenience
     lan_ip = "localhost"
@@ -797,6 +4031,10 @@ if __name__ == "__main__":
     except Exception:
         pass
 
+    # Bind first so the port is accepting connections before any slow work starts
+    server = make_server("0.0.0.0", 5000, app, threaded=True)
+    _mark_startup("listening_s")
+
     log_if_enabled()
     log_if_enabled("=" * 55)
     log_if_enabled("  HOSIX Web Interface démarré !")
@@ -807,4 +4045,11 @@ if __name__ == "__main__":
     log_if_enabled("=" * 55)
     log_if_enabled()
 
-    app.run(host="0.0.0.0", port=5000, debug=False)
+    threading.Thread(target=_after_listen, daemon=True).start()
+    threading.Thread(target=_watchdog.run_forever, daemon=True).start()
+    if JOB_STORE_PATH:
+        threading.Thread(target=_worker_loop, args=(threading.Event(),), daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass